@@ -0,0 +1,181 @@
+"""
+Benchmark sasstastic builds and downloads using synthetic projects.
+
+Usage: python benchmarks/run.py [--entry-points N] [--partials M] [--depth D] ...
+
+Run "python benchmarks/run.py --help" for all options.
+"""
+import argparse
+import json
+import logging
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import zipfile
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from sasstastic import ConfigModel, compile_sass, download_sass
+from sasstastic.compile import compile_changed
+
+
+def make_project(root: Path, entry_points: int, partials: int, depth: int, rules: int) -> ConfigModel:
+    """
+    Create a build directory where each entry point imports every partial and each partial imports a
+    chain of "depth" nested partials.
+    """
+    rnd = random.Random(123)
+    styles = root / 'styles'
+    (styles / 'partials').mkdir(parents=True)
+
+    def rule_block(name: str) -> str:
+        return '\n'.join(
+            f'.{name}-{i} {{ color: rgb({rnd.randint(0, 255)}, 0, 0); .nested {{ margin: {i}px; }} }}'
+            for i in range(rules)
+        )
+
+    for p in range(partials):
+        for d in range(depth):
+            imp = f'@import "p{p}_{d + 1}";\n' if d + 1 < depth else ''
+            (styles / 'partials' / f'_p{p}_{d}.scss').write_text(f'$v{p}_{d}: {d}px;\n{imp}{rule_block(f"p{p}-{d}")}')
+
+    imports = ''.join(f'@import "partials/p{p}_0";\n' for p in range(partials))
+    for e in range(entry_points):
+        (styles / f'entry{e}.scss').write_text(imports + rule_block(f'e{e}'))
+
+    data = dict(download={'dir': 'styles/.libs', 'sources': []}, build_dir='styles', output_dir='css')
+    data['compile_cache_dir'] = str(root / 'cache')
+    return ConfigModel.parse_obj(root / 'sasstastic.yml', data)
+
+
+def make_zip(path: Path, files: int, file_size: int) -> None:
+    rnd = random.Random(123)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for i in range(files):
+            lines = (f'.x{i}-{j} {{ width: {rnd.random()}px; }}\n' for j in range(file_size // 30))
+            zipf.writestr(f'lib-1.0/scss/sub{i % 10}/_f{i}.scss', ''.join(lines))
+            zipf.writestr(f'lib-1.0/docs/f{i}.md', 'x' * 100)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def timeit(func: Callable[[], None], repeat: int, setup: Callable[[], None] = None) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return times
+
+
+def bench_compile(root: Path, args) -> Dict[str, List[float]]:
+    config = make_project(root, args.entry_points, args.partials, args.depth, args.rules)
+    results = {}
+
+    def clean():
+        for d in (root / 'css', root / 'cache'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    results['cold build'] = timeit(lambda: compile_sass(config, jobs=args.jobs), args.repeat, setup=clean)
+    results['warm build'] = timeit(lambda: compile_sass(config, jobs=args.jobs), args.repeat)
+
+    index = compile_sass(config, jobs=args.jobs)
+    counter = count()
+
+    def rebuild(path: Path):
+        def modify():
+            with path.open('a') as f:
+                f.write(f'.changed-{next(counter)} {{ color: red; }}\n')
+
+        return timeit(lambda: compile_changed(config, {path}, index, jobs=args.jobs), args.repeat, setup=modify)
+
+    # in watch mode, only entry points which import a modified file are rebuilt
+    results['entry point rebuild'] = rebuild((root / 'styles' / 'entry0.scss').absolute())
+    partial_path = root / 'styles' / 'partials' / f'_p0_{args.depth - 1}.scss'
+    results['shared partial rebuild'] = rebuild(partial_path.absolute())
+    return results
+
+
+def bench_download(root: Path, args) -> Dict[str, List[float]]:
+    serve_dir = root / 'serve'
+    serve_dir.mkdir()
+    make_zip(serve_dir / 'lib.zip', args.zip_files, args.zip_file_size)
+    (serve_dir / 'big.css').write_bytes(b'.x { color: red; }\n' * (args.zip_file_size * args.zip_files // 19))
+    handler = partial(QuietHandler, directory=str(serve_dir))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    sources = [
+        {'url': f'{url}/big.css'},
+        {'url': f'{url}/lib.zip', 'extract': {r'lib-1.0/scss/(.+)$': 'lib/', r'lib-1.0/docs/': None}},
+    ]
+    project = root / 'download'
+    config = ConfigModel.parse_obj(
+        project / 'sasstastic.yml',
+        dict(download={'dir': 'libs', 'sources': sources}, build_dir='styles', output_dir='css'),
+    )
+
+    def clean():
+        if config.lock_file.exists():
+            config.lock_file.unlink()
+
+    try:
+        results = {
+            'download and extract': timeit(lambda: download_sass(config), args.repeat, setup=clean),
+            'download up-to-date': timeit(lambda: download_sass(config), args.repeat),
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
+    size = sum(p.stat().st_size for p in serve_dir.iterdir())
+    print(f'download size: {size / 1024 ** 2:0.1f}MB, {args.zip_files} files in zip archive')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sasstastic with synthetic projects.')
+    parser.add_argument('--entry-points', type=int, default=20, help='number of entry points')
+    parser.add_argument('--partials', type=int, default=20, help='number of partials imported by every entry point')
+    parser.add_argument('--depth', type=int, default=5, help='length of the import chain below each partial')
+    parser.add_argument('--rules', type=int, default=20, help='number of rules in each file')
+    parser.add_argument('--zip-files', type=int, default=500, help='number of scss files in the zip archive')
+    parser.add_argument('--zip-file-size', type=int, default=10_000, help='approximate size of each zipped file')
+    parser.add_argument('--jobs', type=int, default=1, help='number of compile worker processes')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times to run each benchmark')
+    parser.add_argument('--json', type=Path, help='write results as JSON to this file')
+    parser.add_argument('--only', choices=['compile', 'download'], help='only run one set of benchmarks')
+    args = parser.parse_args()
+
+    # sasstastic logs every file it compiles and downloads
+    logging.getLogger('sasstastic').setLevel(logging.ERROR)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        if args.only in (None, 'compile'):
+            results.update(bench_compile(root / 'compile', args))
+        if args.only in (None, 'download'):
+            results.update(bench_download(root, args))
+
+    print(f'{"benchmark":<25} {"min":>10} {"median":>10} {"max":>10}')
+    for name, times in results.items():
+        ms = [t * 1000 for t in times]
+        print(f'{name:<25} {min(ms):>8.1f}ms {statistics.median(ms):>8.1f}ms {max(ms):>8.1f}ms')
+
+    if args.json:
+        args.json.write_text(json.dumps({'args': {k: str(v) for k, v in vars(args).items()}, 'results': results}))
+
+
+if __name__ == '__main__':
+    main()
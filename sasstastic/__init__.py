@@ -1,11 +1,16 @@
 # flake8: noqa
+from typing import TYPE_CHECKING
+
 from .common import SasstasticError
-from .compile import compile_sass
-from .config import ConfigModel, load_config
-from .download import download_sass
-from .main import download_and_compile
 from .version import VERSION
 
+if TYPE_CHECKING:
+    from .compile import compile_sass
+    from .config import ConfigModel, load_config
+    from .download import download_sass
+    from .main import download_and_compile, download_and_compile_many
+    from .manifest import load_manifest
+
 __all__ = (
     'download_sass',
     'compile_sass',
@@ -13,5 +18,30 @@ __all__ = (
     'load_config',
     'ConfigModel',
     'download_and_compile',
+    'download_and_compile_many',
+    'load_manifest',
     'VERSION',
 )
+
+# other names are imported on first use so importing sasstastic doesn't import libsass, pydantic etc.
+_lazy_imports = {
+    'compile_sass': '.compile',
+    'ConfigModel': '.config',
+    'load_config': '.config',
+    'download_sass': '.download',
+    'download_and_compile': '.main',
+    'download_and_compile_many': '.main',
+    'load_manifest': '.manifest',
+}
+
+
+def __getattr__(name: str):
+    try:
+        module_name = _lazy_imports[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    from importlib import import_module
+
+    value = getattr(import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+__all__ = ('CompileCache', 'file_hash')
+logger = logging.getLogger('sasstastic.cache')
+
+
+def file_hash(path: Path) -> Optional[str]:
+    try:
+        return hashlib.md5(path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+class CompileCache:
+    """
+    Persistent cache of compiled sass keyed on an entry point and the content of every file it imports.
+
+    Each entry is stored as a separate json file in cache_dir. Entries are looked up by the path of the entry point,
+    then validated by comparing the recorded hash of every dependency with the files on disk, so any change to
+    an imported partial invalidates the entry. When the cache grows beyond max_size bytes, the least recently used
+    entries are deleted.
+    """
+
+    def __init__(self, cache_dir: Path, max_size: int, salt: str):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._salt = salt
+        self._hashes: Dict[Path, Optional[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self._write_failed = False
+
+    def get(self, path: Path) -> Optional[Tuple[str, Optional[str], List[Path]]]:
+        """
+        Find the compiled css, source map and dependencies for path, or None if there's no valid entry.
+        """
+        entry_path = self._entry_path(path)
+        try:
+            entry = json.loads(entry_path.read_text())
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if all(self._hash(Path(p)) == h for p, h in entry['deps'].items()):
+            # update mtime so the entry is considered "recently used" when pruning
+            try:
+                os.utime(entry_path)
+            except OSError as e:
+                logger.debug('compile cache: unable to update %s: %s', entry_path, e)
+            self.hits += 1
+            return entry['css'], entry['map'], [Path(p) for p in entry['deps']]
+        else:
+            self.misses += 1
+            return None
+
+    def set(self, path: Path, dependencies: Iterable[Path], css: str, css_map: Optional[str]) -> None:
+        deps = {str(p): self._hash(p) for p in sorted({path, *dependencies})}
+        entry = json.dumps({'deps': deps, 'css': css, 'map': css_map})
+        entry_path = self._entry_path(path)
+        tmp_path = entry_path.with_suffix('.tmp')
+        try:
+            self._cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp_path.write_text(entry)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            # the cache is only an optimisation, the build continues without it
+            log = logger.debug if self._write_failed else logger.warning
+            log('compile cache: unable to write to %s: %s', self._cache_dir, e)
+            self._write_failed = True
+
+    def prune(self) -> None:
+        """
+        Delete the least recently used entries until the cache is smaller than max_size.
+        """
+        try:
+            entries = [(e.stat(), e) for e in self._cache_dir.glob('*.json')]
+        except OSError:
+            return
+        total = sum(s.st_size for s, _ in entries)
+        if total <= self._max_size:
+            return
+        deleted = 0
+        for s, entry_path in sorted(entries, key=lambda e: e[0].st_mtime_ns):
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning('compile cache: unable to delete entries from %s: %s', self._cache_dir, e)
+                break
+            deleted += 1
+            total -= s.st_size
+            if total <= self._max_size:
+                break
+        logger.debug('compile cache: deleted %d least recently used entries', deleted)
+
+    def _hash(self, path: Path) -> Optional[str]:
+        # files are hashed at most once per build
+        try:
+            return self._hashes[path]
+        except KeyError:
+            h = self._hashes[path] = file_hash(path)
+            return h
+
+    def _entry_path(self, path: Path) -> Path:
+        key = hashlib.md5(f'{self._salt}:{path}'.encode()).hexdigest()
+        return self._cache_dir / f'{key}.json'
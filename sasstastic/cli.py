@@ -1,15 +1,22 @@
+import glob
 import logging
+import sys
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import typer
 
-from .config import SasstasticError, load_config
+from .client import build as client_build, send_request
+from .common import SasstasticError, fmt_size
 from .logs import setup_logging
-from .main import download_and_compile, watch
+from .store import DownloadStore, default_store_dir
 from .version import VERSION
 
-cli = typer.Typer()
+# modules which import libsass, pydantic, httpx etc. are imported inside commands so start-up is fast
+
+cli = typer.Typer(help='Fantastic SASS and SCSS compilation.')
+cache_cli = typer.Typer(help='Manage the download cache shared between projects.')
+cli.add_typer(cache_cli, name='cache')
 logger = logging.getLogger('sasstastic.cli')
 
 
@@ -22,39 +29,179 @@ def version_callback(value: bool):
 OUTPUT_HELP = 'Custom directory to output css files, if omitted the "output_dir" field from the config file is used.'
 DEV_MODE_HELP = 'Whether to compile in development or production mode, if omitted the value is taken from config.'
 WATCH_HELP = 'Whether to watch the config file and build directory then download and compile after file changes.'
+JOBS_HELP = 'Number of worker processes used to compile files in parallel, if omitted the value is taken from config.'
+CACHE_HELP = 'Whether to use the compile and remote caches, "--no-cache" forces every file to be recompiled.'
+PROFILE_HELP = 'Print the time taken to compile, modify and write the slowest files.'
+PROFILE_JSON_HELP = 'Write a JSON report of the time taken to build each file to this path, implies "--profile".'
 VERBOSE_HELP = 'Print more information to the console.'
 VERSION_HELP = 'Show the version and exit.'
+SOCKET_HELP = 'Path of the unix socket to listen on, defaults to ".sasstastic.sock" next to the config file.'
+CLIENT_SOCKET_HELP = 'Path of the unix socket the compile server is listening on.'
+STOP_HELP = 'Stop the compile server instead of building.'
+CACHE_DIR_HELP = 'Directory of the shared download cache, defaults to "$XDG_CACHE_HOME/sasstastic".'
+MAX_SIZE_HELP = 'Maximum size of the shared download cache in MB.'
+
+
+def find_config_paths(args: List[str]) -> List[Path]:
+    """
+    Find config files from paths to files or directories or glob patterns, e.g. "apps/*/sasstastic.yml".
+    """
+    paths = []
+    for arg in args:
+        if glob.has_magic(arg):
+            matches = sorted(glob.glob(arg, recursive=True))
+            if not matches:
+                raise typer.BadParameter(f'no files match "{arg}"', param_hint='CONFIG_PATHS')
+            paths.extend(Path(m) for m in matches)
+        else:
+            path = Path(arg)
+            if not path.exists():
+                raise typer.BadParameter(f'Path "{arg}" does not exist.', param_hint='CONFIG_PATHS')
+            paths.append(path)
+
+    config_paths = []
+    for path in paths:
+        if path.is_dir():
+            path /= 'sasstastic.yml'
+        if path not in config_paths:
+            config_paths.append(path)
+    return config_paths
 
 
 @cli.command()
 def build(
-    config_path: Path = typer.Argument('sasstastic.yml', exists=True, file_okay=True, dir_okay=True, readable=True),
+    config_args: Optional[List[str]] = typer.Argument(None, metavar='CONFIG_PATHS...', show_default=False),
     output_dir: Optional[Path] = typer.Option(
         None, '-o', '--output-dir', file_okay=False, dir_okay=True, readable=True, help=OUTPUT_HELP
     ),
     dev_mode: bool = typer.Option(None, '--dev/--prod', help=DEV_MODE_HELP),
     watch_mode: bool = typer.Option(False, '--watch/--dont-watch', help=WATCH_HELP),
+    jobs: Optional[int] = typer.Option(None, '-j', '--jobs', min=1, help=JOBS_HELP),
+    cache: bool = typer.Option(True, '--cache/--no-cache', help=CACHE_HELP),
+    profile: bool = typer.Option(False, '--profile', help=PROFILE_HELP),
+    profile_json: Optional[Path] = typer.Option(None, '--profile-json', dir_okay=False, help=PROFILE_JSON_HELP),
     verbose: bool = typer.Option(False, help=VERBOSE_HELP),
     version: bool = typer.Option(None, '--version', callback=version_callback, is_eager=True, help=VERSION_HELP),
 ):
     """
-    Fantastic SASS and SCSS compilation.
+    Download and compile SASS and SCSS files.
 
-    Takes a single argument: a path to a sasstastic.yml config file, or a directory containing a sasstastic.yml file.
+    Takes paths to sasstastic.yml config files, directories containing a sasstastic.yml file or glob patterns,
+    by default "sasstastic.yml". Multiple configs are built concurrently in one process.
     """
+    from .config import load_config
+    from .main import download_and_compile, download_and_compile_many, watch
+    from .profiling import BuildProfile
+
+    config_paths = find_config_paths(config_args or ['sasstastic.yml'])
     setup_logging('DEBUG' if verbose else 'INFO')
-    if config_path.is_dir():
-        config_path /= 'sasstastic.yml'
+    if len(config_paths) > 1:
+        single_options = {'--output-dir': output_dir, '--watch': watch_mode, '--profile': profile or profile_json}
+        for option, value in single_options.items():
+            if value:
+                raise typer.BadParameter(f'"{option}" can only be used with a single config file')
+        logger.info('config paths: %s', ', '.join(map(str, config_paths)))
+        try:
+            configs = [load_config(p) for p in config_paths]
+            download_and_compile_many(configs, dev_mode, jobs=jobs, cache=cache)
+        except SasstasticError:
+            raise typer.Exit(1)
+        return
+
+    config_path = config_paths[0]
     logger.info('config path: %s', config_path)
+    build_profile = BuildProfile(json_path=profile_json) if profile or profile_json else None
     try:
         config = load_config(config_path)
         if watch_mode:
-            watch(config, output_dir, dev_mode)
+            watch(config, output_dir, dev_mode, jobs=jobs, cache=cache, profile=build_profile)
         else:
-            download_and_compile(config, output_dir, dev_mode)
+            download_and_compile(config, output_dir, dev_mode, jobs=jobs, cache=cache, profile=build_profile)
     except SasstasticError:
         raise typer.Exit(1)
 
 
+@cli.command()
+def serve(
+    config_path: Path = typer.Argument('sasstastic.yml', exists=True, file_okay=True, dir_okay=True, readable=True),
+    socket_path: Optional[Path] = typer.Option(None, '--socket', dir_okay=False, help=SOCKET_HELP),
+    output_dir: Optional[Path] = typer.Option(
+        None, '-o', '--output-dir', file_okay=False, dir_okay=True, readable=True, help=OUTPUT_HELP
+    ),
+    dev_mode: bool = typer.Option(None, '--dev/--prod', help=DEV_MODE_HELP),
+    jobs: Optional[int] = typer.Option(None, '-j', '--jobs', min=1, help=JOBS_HELP),
+    cache: bool = typer.Option(True, '--cache/--no-cache', help=CACHE_HELP),
+    verbose: bool = typer.Option(False, help=VERBOSE_HELP),
+):
+    """
+    Run a compile server which keeps config and caches in memory and builds when requested by "sasstastic client".
+    """
+    import asyncio
+
+    from .server import CompileServer
+
+    setup_logging('DEBUG' if verbose else 'INFO')
+    if config_path.is_dir():
+        config_path /= 'sasstastic.yml'
+    socket_path = socket_path or config_path.parent / '.sasstastic.sock'
+    server = CompileServer(config_path, socket_path, output_dir, dev_mode, jobs=jobs, cache=cache)
+    try:
+        asyncio.run(server.run())
+    except SasstasticError:
+        raise typer.Exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command()
+def client(
+    paths: Optional[List[Path]] = typer.Argument(None, help='Modified files, if omitted everything is rebuilt.'),
+    socket_path: Path = typer.Option('.sasstastic.sock', '--socket', dir_okay=False, help=CLIENT_SOCKET_HELP),
+    stop: bool = typer.Option(False, '--stop', help=STOP_HELP),
+):
+    """
+    Ask a compile server started with "sasstastic serve" to build.
+    """
+    try:
+        if stop:
+            response = send_request(socket_path, {'command': 'stop'})
+        else:
+            response = client_build(socket_path, paths or ())
+    except (OSError, SasstasticError) as e:
+        typer.secho(f'unable to connect to compile server at {socket_path}: {e}', fg='red', err=True)
+        raise typer.Exit(1)
+    if response.get('output'):
+        print(response['output'])
+    if response['status'] != 'ok':
+        typer.secho(response.get('message') or 'build failed', fg='red', err=True)
+        raise typer.Exit(1)
+
+
+@cache_cli.command('prune')
+def cache_prune(
+    cache_dir: Optional[Path] = typer.Option(None, '--dir', file_okay=False, dir_okay=True, help=CACHE_DIR_HELP),
+    max_size: int = typer.Option(500, '--max-size', min=0, help=MAX_SIZE_HELP),
+):
+    """
+    Delete the least recently used files from the shared download cache.
+    """
+    setup_logging('INFO')
+    cache_dir = cache_dir or default_store_dir()
+    deleted = DownloadStore(cache_dir).prune(max_size * 1024 ** 2)
+    logger.info('%s deleted from %s', fmt_size(deleted), cache_dir)
+
+
+def main(args: Optional[List[str]] = None):
+    """
+    Entry point of the "sasstastic" command, "build" is used if no other command is given so
+    "sasstastic path/to/sasstastic.yml" continues to work.
+    """
+    args = sys.argv[1:] if args is None else args
+    commands = typer.main.get_command(cli).commands
+    if not args or (args[0] not in commands and args[0] != '--help'):
+        args = ['build', *args]
+    cli(args, prog_name='sasstastic')
+
+
 if __name__ == '__main__':
-    cli()
+    main()
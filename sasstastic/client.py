@@ -0,0 +1,64 @@
+"""
+Client for "sasstastic serve", this module only uses the standard library and sasstastic.common so it can be
+imported quickly.
+
+Usage: python -m sasstastic.client [--socket PATH] [MODIFIED_FILE ...]
+"""
+import argparse
+import json
+import socket
+import sys
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+from .common import SasstasticError
+
+__all__ = 'send_request', 'build'
+
+
+def send_request(socket_path: Path, request: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Send a request to a compile server and wait for the response.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise SasstasticError('unix sockets are not available on this platform')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b''.join(chunks))
+
+
+def build(socket_path: Path, paths: Iterable[Path] = (), timeout: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Ask the compile server to build, if paths are given only files which import them are rebuilt.
+    """
+    return send_request(socket_path, {'command': 'build', 'paths': [str(p) for p in paths]}, timeout)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m sasstastic.client', description='Build using "sasstastic serve".')
+    parser.add_argument('paths', nargs='*', type=Path, help='modified files, if omitted everything is rebuilt')
+    parser.add_argument('--socket', type=Path, default=Path('.sasstastic.sock'), help='path of the unix socket')
+    args = parser.parse_args()
+    try:
+        response = build(args.socket, args.paths)
+    except (OSError, SasstasticError) as e:
+        print(f'unable to connect to compile server at {args.socket}: {e}', file=sys.stderr)
+        return 1
+    if response.get('output'):
+        print(response['output'])
+    if response['status'] != 'ok':
+        print(response.get('message') or 'build failed', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
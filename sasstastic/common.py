@@ -2,7 +2,8 @@ import re
 from pathlib import Path
 from typing import Optional
 
-__all__ = ('SasstasticError', 'is_file_path')
+__all__ = 'SasstasticError', 'is_file_path', 'fmt_size', 'remove_file'
+KB, MB = 1024, 1024 ** 2
 
 
 class SasstasticError(RuntimeError):
@@ -11,3 +12,22 @@ class SasstasticError(RuntimeError):
 
 def is_file_path(p: Optional[Path]) -> bool:
     return p is not None and re.search(r'\.[a-zA-Z0-9]{1,5}$', p.name)
+
+
+def fmt_size(num):
+    if num <= KB:
+        return f'{num:0.0f}B'
+    elif num <= MB:
+        return f'{num / KB:0.1f}KB'
+    else:
+        return f'{num / MB:0.1f}MB'
+
+
+def remove_file(path: Path) -> None:
+    """
+    Delete a file if it exists, e.g. when another process might have already deleted it.
+    """
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
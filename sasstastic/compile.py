@@ -1,27 +1,86 @@
+import asyncio
+import filecmp
 import hashlib
 import json
 import logging
+import os
 import re
 import shutil
 import tempfile
-from contextlib import contextmanager
+import threading
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import closing, contextmanager, nullcontext
+from functools import partial
 from pathlib import Path
-from time import time
-from typing import Optional, Union
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, TypeVar, Union
 
 import click
 import sass
 
-from .common import SasstasticError
+from .cache import CompileCache
+from .common import SasstasticError, fmt_size
+from .compress import Compressor
 from .config import ConfigModel
-
-__all__ = ('compile_sass',)
+from .manifest import Manifest, ManifestEntry
+from .profiling import BuildProfile
+from .remote_cache import CacheBackend, RemoteCache, create_backend
+from .replace import Replacer
+from .version import VERSION
+
+__all__ = (
+    'compile_sass',
+    'compile_changed',
+    'compile_sass_async',
+    'compile_changed_async',
+    'BuildCancelled',
+    'DependencyIndex',
+)
 logger = logging.getLogger('sasstastic.compile')
 STARTS_DOWNLOAD = re.compile('^(?:DOWNLOAD|DL)/')
 STARTS_SRC = re.compile('^SRC/')
+PLAIN_CSS_IMPORT = re.compile(r'^(?:url\(|https?://|//)|\.css$')
+SOURCE_MAP_URL = re.compile(r'/\*# sourceMappingURL=\S+ \*/')
+# content of imported files along with their mtime and size, shared by all builds in a process
+SOURCE_CACHE: Dict[Path, Tuple[Tuple[int, int], str]] = {}
+T = TypeVar('T')
+
+
+class BuildCancelled(Exception):
+    """
+    Raised when a build is stopped because its cancel event was set.
+    """
+
+
+def compile_sass(
+    config: ConfigModel,
+    alt_output_dir: Optional[Path] = None,
+    dev_mode: Optional[bool] = None,
+    *,
+    jobs: Optional[int] = None,
+    cache: bool = True,
+    profile: Optional[BuildProfile] = None,
+    executor: Optional[Executor] = None,
+    cancel: Optional[threading.Event] = None,
+    entry_points: Optional[Iterable[Path]] = None,
+    remote_cache: Optional[CacheBackend] = None,
+) -> 'DependencyIndex':
+    """
+    Compile all files in the build directory, returns an index of the files each entry point imports
+    which can be used with compile_changed to rebuild only affected files.
+
+    entry_points avoids searching the build directory, e.g. index.entry_points from a previous build plus
+    any new files, paths which don't exist or don't match "include_files" etc. are ignored.
 
+    If executor is passed, files are compiled using it instead of a new pool of "jobs" workers, so one process
+    pool can be shared by multiple builds. If cancel is set during the build, BuildCancelled is raised and
+    no css files are written to the output directory.
 
-def compile_sass(config: ConfigModel, alt_output_dir: Optional[Path] = None, dev_mode: Optional[bool] = None):
+    remote_cache overrides the backend created from the "remote_cache" setting, output of full builds is
+    fetched from it if the same inputs have been built before, e.g. on another CI runner, or stored in it after
+    compiling. Neither cache is used if cache is False.
+    """
     if dev_mode is None:
         dev_mode = config.dev_mode
     else:
@@ -29,61 +88,299 @@ def compile_sass(config: ConfigModel, alt_output_dir: Optional[Path] = None, dev
     mode = 'dev' if dev_mode else 'prod'
     out_dir: Path = alt_output_dir or config.output_dir
     logger.info('\ncompiling "%s/" to "%s/" (mode: %s)', config.build_dir, out_dir, mode)
+    remote = None
+    if cache and entry_points is None:
+        backend = remote_cache or create_backend(config)
+        remote = backend and RemoteCache(config, dev_mode, out_dir, backend)
     with tmpdir() as tmp_path:
-        SassCompiler(config, tmp_path, dev_mode).build()
-        fast_move(tmp_path, out_dir)
+        compiler = SassCompiler(
+            config, tmp_path, dev_mode, jobs, cache, out_dir=out_dir, profile=profile, executor=executor, cancel=cancel
+        )
+        index_data = remote and remote.pull(tmp_path)
+        if index_data is not None:
+            index = DependencyIndex.load(index_data, remote.root)
+            if dev_mode:
+                # source files are copied straight to the output directory so aren't part of the cached output
+                compiler.sync_sources()
+        else:
+            compiler.build(entry_points)
+            compiler.check_cancelled()
+            index = compiler.index
+            if remote:
+                remote.push(tmp_path, index.dump(remote.root))
+        written, unchanged, deleted = publish(tmp_path, out_dir)
+    logger.info('%d files written to "%s/", %d unchanged, %d deleted', written, out_dir, unchanged, deleted)
+    return index
+
+
+def compile_changed(
+    config: ConfigModel,
+    changed_paths: Set[Path],
+    index: 'DependencyIndex',
+    alt_output_dir: Optional[Path] = None,
+    dev_mode: Optional[bool] = None,
+    *,
+    jobs: Optional[int] = None,
+    cache: bool = True,
+    profile: Optional[BuildProfile] = None,
+    cancel: Optional[threading.Event] = None,
+) -> None:
+    """
+    Recompile just the entry points affected by changed_paths, output is written directly to the output directory
+    and index is updated.
+
+    changed_paths should only contain modified files, if files are added or deleted a full build is required.
+    If cancel is set, BuildCancelled is raised before the next file is compiled.
+    """
+    if dev_mode is None:
+        dev_mode = config.dev_mode
+    out_dir: Path = alt_output_dir or config.output_dir
+    entry_points = index.affected(changed_paths)
+    mode = 'dev' if dev_mode else 'prod'
+    logger.info('\nre-compiling %d of %d files in "%s/" (mode: %s)', len(entry_points), len(index), out_dir, mode)
+    compiler = SassCompiler(config, out_dir, dev_mode, jobs, cache, index, out_dir, profile, cancel=cancel)
+    compiler.rebuild(changed_paths, entry_points)
+
+
+async def compile_sass_async(
+    config: ConfigModel,
+    alt_output_dir: Optional[Path] = None,
+    dev_mode: Optional[bool] = None,
+    *,
+    jobs: Optional[int] = None,
+    cache: bool = True,
+    profile: Optional[BuildProfile] = None,
+    executor: Optional[Executor] = None,
+    entry_points: Optional[Iterable[Path]] = None,
+) -> 'DependencyIndex':
+    """
+    compile_sass which runs in a thread so the event loop isn't blocked.
+
+    If the task is cancelled, the build is stopped before css files are written to the output directory.
+    """
+    func = partial(compile_sass, config, alt_output_dir, dev_mode, jobs=jobs, cache=cache, profile=profile)
+    return await run_cancellable(partial(func, executor=executor, entry_points=entry_points))
+
+
+async def compile_changed_async(
+    config: ConfigModel,
+    changed_paths: Set[Path],
+    index: 'DependencyIndex',
+    alt_output_dir: Optional[Path] = None,
+    dev_mode: Optional[bool] = None,
+    *,
+    jobs: Optional[int] = None,
+    cache: bool = True,
+    profile: Optional[BuildProfile] = None,
+) -> None:
+    """
+    compile_changed which runs in a thread so the event loop isn't blocked.
+
+    If the task is cancelled, the build is stopped before the next file is compiled, files already written
+    are left in place.
+    """
+    func = partial(compile_changed, config, changed_paths, index, alt_output_dir, dev_mode)
+    await run_cancellable(partial(func, jobs=jobs, cache=cache, profile=profile))
+
+
+async def run_cancellable(func: Callable[..., T]) -> T:
+    """
+    Run func in a thread, func should take a "cancel" event which is set if the task is cancelled.
+    """
+    cancel = threading.Event()
+    future = asyncio.get_running_loop().run_in_executor(None, partial(func, cancel=cancel))
+    try:
+        # shield so the future isn't cancelled and can be waited for below
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        cancel.set()
+        # wait for the thread to stop so another build doesn't start while this one is writing files
+        await asyncio.wait([future])
+        # retrieve BuildCancelled so it isn't logged as an unhandled exception
+        future.exception()
+        raise
 
 
 class SassCompiler:
-    def __init__(self, config: ConfigModel, tmp_out_dir: Path, dev_mode: bool):
+    def __init__(
+        self,
+        config: ConfigModel,
+        tmp_out_dir: Path,
+        dev_mode: bool,
+        jobs: Optional[int] = None,
+        cache: bool = True,
+        index: Optional['DependencyIndex'] = None,
+        out_dir: Optional[Path] = None,
+        profile: Optional[BuildProfile] = None,
+        executor: Optional[Executor] = None,
+        cancel: Optional[threading.Event] = None,
+    ):
         self._config = config
-        self._build_dir = config.build_dir
-        self._tmp_out_dir = tmp_out_dir
+        self._profile = profile
+        self._executor = executor
+        self._cancel = cancel
+        self._build_dir = config.build_dir.absolute()
+        self._tmp_out_dir = tmp_out_dir.absolute()
+        # the final output directory, in dev mode source files are copied directly into "out_dir/.src"
+        self._out_dir = out_dir.absolute() if out_dir else self._tmp_out_dir
         self._dev_mode = dev_mode
+        self._jobs = jobs or config.jobs
         self._src_dir = self._build_dir
-        self._replace = config.replace or {}
-        self._download_dir = config.download.dir
-        self._importers = [(5, self._clever_imports)]
+        self._replacer = Replacer(config.replace)
+        self._compressor = Compressor() if config.precompress else None
+        # manifest entries for files compiled in this build, None if compilation failed
+        self._manifest_changes: Dict[str, Optional[ManifestEntry]] = {}
+        self._download_dir = config.download.dir.absolute()
+        # in dev mode, pairs of (copy directory in out_dir, original directory) for source files
+        self._copies: List[Tuple[Path, Path]] = []
+        self.index = index or DependencyIndex()
 
         dir_hash = hashlib.md5(str(self._build_dir).encode()).hexdigest()
         self._size_cache_file = Path(tempfile.gettempdir()) / 'grablib_cache.{}.json'.format(dir_hash)
 
         self._output_style = 'nested' if self._dev_mode else 'compressed'
+        self._cache: Optional[CompileCache] = None
+        if cache:
+            # in dev mode source maps are relative to the output directory so entries can't be shared between them
+            out_dir_salt = str(self._out_dir) if self._dev_mode else None
+            salt = json.dumps([VERSION, sass.__version__, self._output_style, self._dev_mode, out_dir_salt])
+            self._cache = CompileCache(config.compile_cache_dir, config.compile_cache_size, salt)
 
         self._old_size_cache = {}
         self._new_size_cache = {}
         self._errors = 0
         self._files_generated = 0
 
-    def build(self) -> None:
+    def build(self, entry_points: Optional[Iterable[Path]] = None) -> None:
         start = time()
-
         if self._dev_mode:
-            self._src_dir = out_dir_src = self._tmp_out_dir / '.src'
+            self.sync_sources()
 
-            shutil.copytree(str(self._build_dir), str(out_dir_src))
-            files = sum(f.is_file() for f in out_dir_src.glob('**/*'))
-            logger.info('>>  %28s/* ➤ %-30s %3d files', self._build_dir, '.src/', files)
-
-            try:
-                self._download_dir = out_dir_src / self._download_dir.relative_to(self._build_dir)
-            except ValueError:
-                # download dir is not inside the build dir, need to copy libs too
-                out_dir_libs = self._tmp_out_dir / '.libs'
-                shutil.copytree(str(self._download_dir), str(out_dir_libs))
-                files = sum(f.is_file() for f in out_dir_libs.glob('**/*'))
-                logger.info('%28s/* ➤ %-30s %3d files', self._download_dir, '.libs/', files)
-                self._download_dir = out_dir_src
+        finder = EntryPointFinder(self._config, self._src_dir, self._download_dir)
+        if entry_points is None:
+            paths = finder.find()
+        else:
+            entry_points = [p.absolute() for p in entry_points]
+            if self._dev_mode:
+                entry_points = [self._copy_path(p) for p in entry_points]
+            paths = sorted({p for p in entry_points if p and finder.match(p)})
+        self._compile_paths(paths, start)
+
+    def sync_sources(self) -> None:
+        """
+        In dev mode, copy source files into the output directory so source maps can reference them.
+        """
+        self._setup_copies()
+        for copy_dir, original_dir in self._copies:
+            # download dir is only included here if it's not inside the build dir
+            # when the output directory is inside the build directory it mustn't be copied into itself
+            files, updated = sync_dir(original_dir, copy_dir, skip=[self._out_dir])
+            copy_name = f'{copy_dir.name}/'
+            logger.info('>>  %28s/* ➤ %-30s %3d files, %d updated', original_dir, copy_name, files, updated)
+
+    def rebuild(self, changed_paths: Set[Path], entry_points: Set[Path]) -> None:
+        """
+        Recompile entry_points in place, tmp_out_dir should be the real output directory.
+
+        In dev mode changed files are first synced into ".src" or ".libs".
+        """
+        start = time()
+        paths = sorted(entry_points)
+        if self._dev_mode:
+            self._setup_copies()
+            for path in changed_paths:
+                copy_path = self._copy_path(path)
+                if copy_path and path.is_file():
+                    sync_file(path, copy_path)
+            paths = [self._copy_path(p) for p in paths]
+
+        self._compile_paths([p for p in paths if p and p.is_file()], start, in_place=True)
+
+    def _setup_copies(self) -> None:
+        self._src_dir = out_dir_src = self._out_dir / '.src'
+        self._copies = [(out_dir_src, self._build_dir)]
+        if is_relative_to(self._download_dir, self._build_dir):
+            self._download_dir = out_dir_src / self._download_dir.relative_to(self._build_dir)
+        else:
+            self._copies.append((self._out_dir / '.libs', self._download_dir))
+            self._download_dir = self._out_dir / '.libs'
 
+    def _compile_paths(self, paths: List[Path], start: float, in_place: bool = False) -> None:
         if self._size_cache_file.exists():
             with self._size_cache_file.open() as f:
                 self._old_size_cache = json.load(f)
+        if in_place:
+            self._new_size_cache = dict(self._old_size_cache)
 
-        for path in self._src_dir.glob('**/*.*'):
-            self.process_file(path)
-
+        if self._profile:
+            self._profile.reset()
+        importer = CleverImporter(self._build_dir, self._download_dir)
+        cached = self._cached_results(paths) if self._cache else {}
+        try:
+            with closing(self._compile_all([p for p in paths if p not in cached], importer)) as compiled:
+                import_hits, import_misses = self._process_results(paths, cached, compiled, in_place)
+            logger.debug('import cache: %d hits, %d misses', import_hits, import_misses)
+            self._finish(start, in_place)
+        finally:
+            if self._compressor:
+                # if the build failed, compression must stop before the temporary directory is deleted
+                self._compressor.close()
+
+    def check_cancelled(self) -> None:
+        if self._cancel is not None and self._cancel.is_set():
+            raise BuildCancelled()
+
+    def _process_results(
+        self,
+        paths: List[Path],
+        cached: Dict[Path, 'CompileResult'],
+        compiled: Iterator[Tuple['CompileResult', 'CompileStats']],
+        in_place: bool,
+    ) -> Tuple[int, int]:
+        """
+        Write output for each path, compile results are either from the cache or compiled, returns
+        the number of import cache hits and misses.
+        """
+        import_hits, import_misses = 0, 0
+        for path in paths:
+            self.check_cancelled()
+            result = cached.get(path)
+            if result is None:
+                result, stats = next(compiled)
+                import_hits += stats.hits
+                import_misses += stats.misses
+                if self._profile:
+                    self._record_compile(path, result, stats)
+            outputs = self.process_file(path, result)
+            if self._cache and path not in cached:
+                self._cache_result(path, result)
+
+            css, error, dependencies = result
+            if dependencies is not None:
+                dependencies = {self._source_path(p) for p in dependencies}
+            stale = self.index.add(self._source_path(path), dependencies, outputs)
+            if in_place:
+                for rel_path in stale:
+                    try:
+                        (self._tmp_out_dir / rel_path).unlink()
+                    except FileNotFoundError:
+                        # e.g. removed by the user or an earlier build which failed
+                        pass
+        return import_hits, import_misses
+
+    def _finish(self, start: float, in_place: bool) -> None:
+        if self._compressor:
+            self._compressor.wait()
+        if self._config.manifest:
+            self._write_manifest(in_place)
         with self._size_cache_file.open('w') as f:
             json.dump(self._new_size_cache, f, indent=2)
+        if self._cache:
+            logger.debug('compile cache: %d hits, %d misses', self._cache.hits, self._cache.misses)
+            self._cache.prune()
+
+        if self._profile:
+            self._profile.report()
 
         time_taken = (time() - start) * 1000
         plural = '' if self._files_generated == 1 else 's'
@@ -95,83 +392,168 @@ class SassCompiler:
             )
             raise SasstasticError('sass errors')
 
-    def process_file(self, f: Path):
-        if not f.is_file():
-            return
-        if not self._config.include_files.search(f.name):
-            return
-        if self._config.exclude_files and self._config.exclude_files.search(str(f)):
-            return
+    def _cached_results(self, paths: List[Path]) -> Dict[Path, 'CompileResult']:
+        cached = {}
+        for path in paths:
+            hit = self._cache.get(self._source_path(path))
+            if hit:
+                css, css_map, dependencies = hit
+                cached[path] = ((css, css_map) if self._dev_mode else css), None, dependencies
+                if self._profile:
+                    self._profile.file(self._output_paths(path)[0]).cached = True
+        return cached
+
+    def _write_manifest(self, in_place: bool) -> None:
+        path = self._tmp_out_dir / self._config.manifest
+        manifest = Manifest({})
+        if in_place and path.is_file():
+            # only some files have been recompiled, update the existing manifest
+            manifest = Manifest.parse_file(path)
+        manifest.update(self._manifest_changes)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        manifest.save(path)
+
+    def _record_compile(self, path: Path, result: 'CompileResult', stats: 'CompileStats') -> None:
+        f = self._profile.file(self._output_paths(path)[0])
+        f.times['compile'] = stats.time
+        f.imports = stats.imports
+        for p in {path, *(result[2] or ())}:
+            try:
+                f.input_bytes += p.stat().st_size
+            except OSError:
+                pass
 
-        if is_relative_to(f, self._download_dir):
-            return
+    def _timer(self, rel_path: Path, stage: str):
+        return self._profile.time(rel_path, stage) if self._profile else nullcontext()
 
+    def _output_paths(self, f: Path) -> Tuple[Path, Path, Optional[Path]]:
         rel_path = f.relative_to(self._src_dir)
         css_path = (self._tmp_out_dir / rel_path).with_suffix('.css')
-
         map_path = css_path.with_name(css_path.name + '.map') if self._dev_mode else None
-
-        try:
-            css = sass.compile(
-                filename=str(f),
-                source_map_filename=map_path and str(map_path),
-                output_style=self._output_style,
-                precision=10,
-                importers=self._importers,
-            )
-        except sass.CompileError as e:
-            self._errors += 1
-            logger.error('%s compile error:\n%s', f, e)
+        return rel_path, css_path, map_path
+
+    def _compile_all(
+        self, paths: List[Path], importer: 'CleverImporter'
+    ) -> Iterator[Tuple['CompileResult', 'CompileStats']]:
+        """
+        Compile each path, if more than one job is configured files are compiled in a pool of worker processes,
+        if an executor was passed to compile_sass, it's always used.
+
+        Results are always returned in the same order as paths so logging and error counts are deterministic.
+        Results are yielded as they're ready, if the generator is closed early files waiting to be compiled
+        are cancelled.
+        """
+        # source maps are generated relative to their final location in out_dir
+        map_paths = [self._output_paths(p)[2] for p in paths]
+        map_paths = [m and self._out_dir / m.relative_to(self._tmp_out_dir) for m in map_paths]
+        args = [(p, m, self._output_style, importer) for p, m in zip(paths, map_paths)]
+        if not args:
             return
+        elif self._executor is not None:
+            yield from self._executor.map(compile_with_stats, *zip(*args))
+        elif self._jobs == 1 or len(paths) < 2:
+            yield from (compile_with_stats(*a) for a in args)
+        else:
+            logger.debug('compiling %d files with %d workers', len(paths), self._jobs)
+            with ProcessPoolExecutor(max_workers=min(self._jobs, len(paths))) as executor:
+                yield from executor.map(compile_with_stats, *zip(*args))
+
+    def _cache_result(self, path: Path, result: 'CompileResult') -> None:
+        css, error, dependencies = result
+        if error or dependencies is None:
+            # either compilation failed or not all imports could be resolved, don't cache
+            return
+        css_map = None
+        if self._dev_mode:
+            css, css_map = css
+        self._cache.set(self._source_path(path), [self._source_path(p) for p in dependencies], css, css_map)
+
+    def _source_path(self, p: Path) -> Path:
+        """
+        Find the original location of a file, in dev mode files are compiled from copies in ".src" or ".libs".
+        """
+        for copy_dir, original_dir in self._copies:
+            if is_relative_to(p, copy_dir):
+                return original_dir / p.relative_to(copy_dir)
+        return p
+
+    def _copy_path(self, p: Path) -> Optional[Path]:
+        """
+        Find the location of a source file's copy in dev mode, this is the inverse of _source_path.
+        """
+        for copy_dir, original_dir in self._copies:
+            if is_relative_to(p, original_dir):
+                return copy_dir / p.relative_to(original_dir)
+
+    def process_file(self, f: Path, result: 'CompileResult') -> List[Path]:
+        """
+        Write the compiled css and source map, returns the paths created relative to the output directory.
+
+        css is encoded once, the bytes are used for the size, hash, manifest, compression and writing, so a large
+        file is held in memory as few times as possible.
+        """
+        rel_path, css_path, map_path = self._output_paths(f)
+        css, error, _ = result
+        if error:
+            self._manifest_changes[str(css_path.relative_to(self._tmp_out_dir))] = None
+            self._errors += 1
+            logger.error('%s compile error:\n%s', f, error)
+            return []
 
-        log_msg = None
         file_hashes = self._config.file_hashes
+        css_map = None
+        # css before and after encoding, used for logging even if something fails
+        content: Union[str, bytes] = ''
         try:
             css_path.parent.mkdir(parents=True, exist_ok=True)
             if self._dev_mode:
                 css, css_map = css
 
                 if file_hashes:
-                    css_path = insert_hash(css_path, css)
-                    map_path = insert_hash(map_path, css)
+                    with self._timer(rel_path, 'hash'):
+                        hash_ = content_hash(css)
+                        css_path = insert_hash(css_path, hash_=hash_)
+                        map_path = insert_hash(map_path, hash_=hash_)
                     file_hashes = False
 
                 # correct the link to map file in css
-                css = re.sub(r'/\*# sourceMappingURL=\S+ \*/', f'/*# sourceMappingURL={map_path.name} */', css)
-                map_path.write_text(css_map)
-            css, log_msg = self._regex_modify(rel_path, css)
+                css = fix_source_map_url(css, map_path.name)
+
+                with self._timer(rel_path, 'write'):
+                    write_file(map_path, css_map)
+            content = css
+            with self._timer(rel_path, 'replace'):
+                css = self._replacer(rel_path, css)
+            content = css_bytes = css.encode()
+            del css
         finally:
-            self._log_file_creation(rel_path, css_path, css)
-            if log_msg:
-                logger.debug(log_msg)
+            self._log_file_creation(rel_path, css_path, content)
 
         if file_hashes:
-            css_path = insert_hash(css_path, css)
-        css_path.write_text(css)
+            with self._timer(rel_path, 'hash'):
+                css_path = insert_hash(css_path, css_bytes)
+        outputs = [css_path] if map_path is None else [css_path, map_path]
+        if self._config.manifest:
+            name = str(self._output_paths(f)[1].relative_to(self._tmp_out_dir))
+            output_path = str(css_path.relative_to(self._tmp_out_dir))
+            self._manifest_changes[name] = ManifestEntry.from_content(output_path, css_bytes)
+        if self._compressor:
+            # compare with the published file before it's replaced in case the build is in place
+            previous = self._out_dir / css_path.relative_to(self._tmp_out_dir)
+            outputs += self._compressor.submit(css_path, css_bytes, previous)
+        with self._timer(rel_path, 'write'):
+            write_file(css_path, css_bytes)
+        if self._profile:
+            self._profile.file(rel_path).output_bytes = len(css_bytes) + (map_path.stat().st_size if css_map else 0)
         self._files_generated += 1
+        return [p.relative_to(self._tmp_out_dir) for p in outputs]
 
-    def _regex_modify(self, rel_path, css):
-        log_msg = None
-
-        for path_regex, regex_map in self._replace.items():
-            if re.search(path_regex, str(rel_path)):
-                logger.debug('%s has regex replace matches for "%s"', rel_path, path_regex)
-                for pattern, repl in regex_map.items():
-                    hash1 = hash(css)
-                    css = re.sub(pattern, repl, css)
-                    if hash(css) == hash1:
-                        log_msg = '  "{}" ➤ "{}" didn\'t modify the source'.format(pattern, repl)
-                    else:
-                        log_msg = '  "{}" ➤ "{}" modified the source'.format(pattern, repl)
-        return css, log_msg
-
-    def _log_file_creation(self, rel_path, css_path, css):
+    def _log_file_creation(self, rel_path: Path, css_path: Path, content: Union[str, bytes]) -> None:
         src, dst = str(rel_path), str(css_path.relative_to(self._tmp_out_dir))
 
-        size = len(css.encode())
-        p = str(css_path)
-        self._new_size_cache[p] = size
-        old_size = self._old_size_cache.get(p)
+        size = len(content) if isinstance(content, bytes) else len(content.encode())
+        self._new_size_cache[dst] = size
+        old_size = self._old_size_cache.get(dst)
         c = None
         if old_size:
             change_p = (size - old_size) / old_size * 100
@@ -182,14 +564,264 @@ class SassCompiler:
         if c is None:
             logger.info('>>  %30s ➤ %-30s %9s', src, dst, fmt_size(size))
 
-    def _clever_imports(self, src_path):
-        _new_path = None
+
+class DependencyIndex:
+    """
+    Records the files imported by each entry point and the outputs it generated, plus a reverse index
+    of the entry points which import each file.
+    """
+
+    def __init__(self):
+        self._dependencies: Dict[Path, Optional[Set[Path]]] = {}
+        self._dependents: Dict[Path, Set[Path]] = defaultdict(set)
+        self._outputs: Dict[Path, List[Path]] = {}
+
+    def __len__(self) -> int:
+        return len(self._dependencies)
+
+    @property
+    def entry_points(self) -> List[Path]:
+        return list(self._dependencies)
+
+    def __contains__(self, path: Path) -> bool:
+        """
+        Whether path is an entry point or imported by one.
+        """
+        return path in self._dependencies or path in self._dependents
+
+    def add(self, entry_point: Path, dependencies: Optional[Set[Path]], outputs: List[Path]) -> Set[Path]:
+        """
+        Record dependencies and outputs for an entry point, dependencies should be None if they're unknown.
+
+        Returns any outputs from a previous build which weren't generated this time.
+        """
+        for p in self._dependencies.get(entry_point) or ():
+            self._dependents[p].discard(entry_point)
+        self._dependencies[entry_point] = dependencies
+        for p in dependencies or ():
+            self._dependents[p].add(entry_point)
+        self._dependents[entry_point].add(entry_point)
+
+        old_outputs = self._outputs.get(entry_point, [])
+        self._outputs[entry_point] = outputs
+        return set(old_outputs) - set(outputs)
+
+    def dump(self, root: Path) -> Dict[str, Any]:
+        """
+        Convert the index to JSON compatible data with paths relative to root, see load.
+        """
+        rel = partial(os.path.relpath, start=root)
+        return {
+            rel(e): {
+                'dependencies': None if deps is None else sorted(map(rel, deps)),
+                'outputs': [p.as_posix() for p in self._outputs[e]],
+            }
+            for e, deps in self._dependencies.items()
+        }
+
+    @classmethod
+    def load(cls, data: Dict[str, Any], root: Path) -> 'DependencyIndex':
+        index = cls()
+        for e, v in data.items():
+            deps = v['dependencies']
+            index.add(root / e, None if deps is None else {root / p for p in deps}, [Path(p) for p in v['outputs']])
+        return index
+
+    def affected(self, changed_paths: Iterable[Path]) -> Set[Path]:
+        """
+        Find entry points which import any of changed_paths, entry points with unknown dependencies are always included.
+        """
+        entry_points = {e for e, deps in self._dependencies.items() if deps is None}
+        for p in changed_paths:
+            entry_points.update(self._dependents.get(p, ()))
+        return entry_points
+
+
+class EntryPointFinder:
+    """
+    Find entry points in src_dir using os.scandir, directories matching "exclude_dirs" and the download directory
+    are skipped without being read.
+
+    "exclude_dirs" is searched for in each directory's path relative to src_dir, e.g. "vendor/icons".
+    """
+
+    def __init__(self, config: ConfigModel, src_dir: Path, download_dir: Path):
+        self._include_files = config.include_files
+        self._exclude_files = config.exclude_files
+        self._exclude_dirs = config.exclude_dirs
+        self._src_dir = src_dir
+        self._download_dir = str(download_dir)
+
+    def find(self) -> List[Path]:
+        paths = []
+        # pairs of (absolute path, path relative to src_dir) of directories to search
+        stack = [(str(self._src_dir), '')]
+        while stack:
+            dir_path, rel_dir = stack.pop()
+            try:
+                entries = list(os.scandir(dir_path))
+            except OSError:
+                continue
+            for entry in entries:
+                rel_path = f'{rel_dir}{entry.name}'
+                if entry.is_dir(follow_symlinks=False):
+                    if not self._skip_dir(entry.path, rel_path):
+                        stack.append((entry.path, f'{rel_path}/'))
+                elif self._match_file(entry.name, entry.path) and entry.is_file():
+                    paths.append(Path(entry.path))
+        return sorted(paths)
+
+    def match(self, path: Path) -> bool:
+        """
+        Whether path would be found by find().
+        """
+        if not is_relative_to(path, self._src_dir) or path == self._src_dir:
+            return False
+        rel_dirs = path.relative_to(self._src_dir).parts[:-1]
+        for i in range(len(rel_dirs)):
+            dir_path = self._src_dir.joinpath(*rel_dirs[: i + 1])
+            if self._skip_dir(str(dir_path), '/'.join(rel_dirs[: i + 1])):
+                return False
+        return self._match_file(path.name, str(path)) and path.is_file()
+
+    def _skip_dir(self, path: str, rel_path: str) -> bool:
+        return path == self._download_dir or bool(self._exclude_dirs and self._exclude_dirs.search(rel_path))
+
+    def _match_file(self, name: str, path: str) -> bool:
+        if '.' not in name or not self._include_files.search(name):
+            return False
+        return not (self._exclude_files and self._exclude_files.search(path))
+
+
+CompileResult = Tuple[Union[str, Tuple[str, str], None], Optional[str], Optional[List[Path]]]
+
+
+def compile_file(path: Path, map_path: Optional[Path], output_style: str, importer: 'CleverImporter') -> CompileResult:
+    """
+    Compile a single sass file, returns a tuple of (css or (css, source map), error message, dependencies).
+
+    dependencies is the list of files imported while compiling, or None if not all imports could be resolved.
+
+    This may be called in a worker process, so arguments and result must be picklable.
+    """
+    importer.reset()
+    try:
+        css = sass.compile(
+            filename=str(path),
+            source_map_filename=map_path and str(map_path),
+            output_style=output_style,
+            precision=10,
+            importers=[(5, importer)],
+        )
+    except sass.CompileError as e:
+        return None, str(e), None
+    else:
+        return css, None, sorted(importer.dependencies) if importer.complete else None
+
+
+class CompileStats(NamedTuple):
+    time: float
+    imports: int
+    hits: int
+    misses: int
+
+
+def compile_with_stats(*args) -> Tuple[CompileResult, CompileStats]:
+    """
+    Call compile_file, also returns the time taken and how many imports were resolved.
+
+    Import cache hits and misses are returned since in a worker process the importer is a copy.
+    """
+    importer: CleverImporter = args[-1]
+    hits, misses = importer.hits, importer.misses
+    start = perf_counter()
+    result = compile_file(*args)
+    stats = CompileStats(perf_counter() - start, importer.imports, importer.hits - hits, importer.misses - misses)
+    return result, stats
+
+
+class CleverImporter:
+    """
+    Sass importer which resolves "SRC/" and "DOWNLOAD/" (or "DL/") prefixes to the build and download directories.
+
+    Every import is also resolved to a file and recorded in "dependencies" so compiled output can be cached.
+
+    The content of imported scss files is returned from SOURCE_CACHE, so files imported by many entry points
+    are only read once per process, "hits" and "misses" count how often the cache was used.
+    """
+
+    def __init__(self, build_dir: Path, download_dir: Path):
+        self._build_dir = build_dir
+        self._download_dir = download_dir
+        self.dependencies: Set[Path] = set()
+        self.complete = True
+        self.imports = 0
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self) -> None:
+        self.dependencies = set()
+        self.complete = True
+        self.imports = 0
+
+    def __call__(self, src_path: str, prev: str):
+        self.imports += 1
         if STARTS_SRC.match(src_path):
-            _new_path = self._build_dir / STARTS_SRC.sub('', src_path)
+            new_path = self._build_dir / STARTS_SRC.sub('', src_path)
         elif STARTS_DOWNLOAD.match(src_path):
-            _new_path = self._download_dir / STARTS_DOWNLOAD.sub('', src_path)
+            new_path = self._download_dir / STARTS_DOWNLOAD.sub('', src_path)
+        elif PLAIN_CSS_IMPORT.search(src_path):
+            # plain css import which libsass leaves in the output
+            return None
+        else:
+            path = self._record(Path(prev).parent / src_path)
+            # if the file isn't found, libsass resolves relative imports itself
+            return path and self._load(path)
+
+        path = self._record(new_path)
+        return self._load(path) if path else [(str(new_path),)]
 
-        return _new_path and [(str(_new_path),)]
+    def _record(self, import_path: Path) -> Optional[Path]:
+        path = resolve_import(import_path)
+        if path is None:
+            self.complete = False
+        else:
+            self.dependencies.add(path)
+        return path
+
+    def _load(self, path: Path) -> List[Tuple[str, ...]]:
+        if path.suffix != '.scss':
+            # libsass parses contents returned by importers as scss, so let it load other files
+            return [(str(path),)]
+        try:
+            st = path.stat()
+        except OSError:
+            return [(str(path),)]
+
+        key = st.st_mtime_ns, st.st_size
+        cached = SOURCE_CACHE.get(path)
+        if cached and cached[0] == key:
+            self.hits += 1
+            contents = cached[1]
+        else:
+            self.misses += 1
+            contents = path.read_text()
+            SOURCE_CACHE[path] = key, contents
+        return [(str(path), contents)]
+
+
+def resolve_import(path: Path) -> Optional[Path]:
+    """
+    Find the file libsass would load for an import, following the same rules for partials, extensions and index files.
+    """
+    if path.name.endswith(('.scss', '.sass')):
+        candidates = [path.with_name('_' + path.name), path]
+    else:
+        candidates = [
+            path.with_name(f'{prefix}{path.name}{ext}') for ext in ('.scss', '.sass', '.css') for prefix in ('_', '')
+        ]
+        candidates += [path / f'{prefix}index{ext}' for ext in ('.scss', '.sass') for prefix in ('_', '')]
+    return next((p for p in candidates if p.is_file()), None)
 
 
 @contextmanager
@@ -201,49 +833,169 @@ def tmpdir():
         shutil.rmtree(d)
 
 
-def _move_dir(src: str, dst: str, exists: bool):
-    if exists:
-        shutil.rmtree(dst)
-    shutil.move(src, dst)
+def sync_dir(src_dir: Path, dst_dir: Path, skip: Iterable[Path] = ()) -> Tuple[int, int]:
+    """
+    Make dst_dir a mirror of src_dir, files are only written if they're new or their size or modification
+    time has changed. Files in dst_dir which are not in src_dir are deleted.
 
+    Directories in skip aren't copied, e.g. the output directory which may be inside src_dir.
 
-def fast_move(src_dir: Path, dst_dir: Path):
+    Returns a tuple of (number of files, number of files updated).
     """
-    Move all files and directories from src_dir to dst_dir, files are moved first. This tries to be relatively fast.
+    files, updated = 0, 0
+    expected = set()
+    src_dir = src_dir.absolute()
+    skip_dirs = {os.path.abspath(d) for d in skip}
+    for root, dir_names, file_names in os.walk(src_dir):
+        # prune in place so os.walk doesn't descend into skipped directories
+        dir_names[:] = [d for d in dir_names if os.path.join(root, d) not in skip_dirs]
+        root_path = Path(root)
+        for name in file_names:
+            src = root_path / name
+            dst = dst_dir / src.relative_to(src_dir)
+            expected.add(dst)
+            files += 1
+            updated += sync_file(src, dst)
+
+    for root, _, file_names in os.walk(dst_dir):
+        for name in file_names:
+            p = Path(root) / name
+            if p not in expected:
+                p.unlink()
+    return files, updated
+
+
+def sync_file(src: Path, dst: Path) -> bool:
     """
+    Update dst to match src if it's size or modification time differs, dst is hardlinked to src if possible,
+    otherwise src is copied. dst is always replaced atomically, never modified in place.
 
-    to_move = []
-    to_rename = []
-    for src_path in src_dir.iterdir():
-        if src_path.is_file():
-            to_rename.append((src_path, dst_dir / src_path.relative_to(src_dir)))
-        else:
-            assert src_path.is_dir(), src_path
-            dst = dst_dir / src_path.relative_to(src_dir)
-            to_move.append((str(src_path), str(dst), dst.exists()))
+    Returns True if dst was updated.
+    """
+    src_stat = src.stat()
+    try:
+        dst_stat = dst.stat()
+    except FileNotFoundError:
+        pass
+    else:
+        if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino) or (
+            (dst_stat.st_size, dst_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns)
+        ):
+            return False
 
-    dst_dir.mkdir(parents=True, exist_ok=True)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dst = dst.with_name(f'.{dst.name}.tmp')
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        # hardlinks aren't supported, or src and dst are on different file systems
+        shutil.copy2(str(src), str(tmp_dst))
+    os.replace(tmp_dst, dst)
+    return True
+
+
+def publish(src_dir: Path, dst_dir: Path) -> Tuple[int, int, int]:
+    """
+    Move all files from src_dir to dst_dir, only files whose content has changed are written and each is replaced
+    atomically so a web server never sees a missing or partially written file.
+
+    Once new files are in place, files in dst_dir which weren't generated are deleted from directories which
+    exist in src_dir, files in the root of dst_dir and other directories are left alone.
+
+    Returns a tuple of (files written, files unchanged, files deleted).
+    """
     s = time()
-    # files in the root of src_dir are moved first, these are generally the scss files which
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    written, unchanged = 0, 0
+    generated = set()
+    # os.walk is top down so files in the root of src_dir are moved first, these are generally the css files which
     # should be updated first to avoid styles not changing when a browser reloads
-    for src, dst in to_rename:
-        src.rename(dst)
-    for src, dst, exists in to_move:
-        if exists:
-            shutil.rmtree(dst)
-        shutil.move(src, dst)
-    logger.debug('filed from %s/ to %s/ in %0.1fms', src_dir, dst_dir, (time() - s) * 1000)
+    for root, _, file_names in os.walk(src_dir):
+        for name in file_names:
+            src = Path(root) / name
+            dst = dst_dir / src.relative_to(src_dir)
+            generated.add(dst)
+            if dst.is_file() and dst.stat().st_size == src.stat().st_size and filecmp.cmp(src, dst, shallow=False):
+                unchanged += 1
+            else:
+                replace_file(src, dst)
+                written += 1
+
+    deleted = 0
+    for sub_dir in (dst_dir / p.name for p in src_dir.iterdir() if p.is_dir()):
+        for root, _, file_names in os.walk(sub_dir):
+            for name in file_names:
+                p = Path(root) / name
+                if p not in generated:
+                    p.unlink()
+                    deleted += 1
+    logger.debug('published %s/ to %s/ in %0.1fms', src_dir, dst_dir, (time() - s) * 1000)
+    return written, unchanged, deleted
+
+
+def write_file(path: Path, content: Union[str, bytes]) -> None:
+    """
+    Write content to a temporary file then rename it to path so the file is replaced atomically,
+    this matters when rebuilding in place.
 
+    Strings are encoded in chunks so a large file isn't copied in memory.
+    """
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    with tmp_path.open('wb') as f:
+        if isinstance(content, bytes):
+            f.write(content)
+        else:
+            for chunk in str_chunks(content):
+                f.write(chunk)
+    os.replace(tmp_path, path)
 
-def insert_hash(path: Path, content: Union[str, bytes], *, hash_length=7):
+
+def str_chunks(s: str, size: int = 1024 ** 2) -> Iterator[bytes]:
+    """
+    Encode s as utf-8 in chunks of "size" characters.
     """
-    Insert a hash based on the content into the path after the first dot.
+    for i in range(0, len(s), size):
+        yield s[i : i + size].encode()
+
+
+def content_hash(content: Union[str, bytes]) -> str:
+    if isinstance(content, bytes):
+        return hashlib.md5(content).hexdigest()
+    h = hashlib.md5()
+    for chunk in str_chunks(content):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def fix_source_map_url(css: str, map_name: str) -> str:
+    """
+    Correct the link to the map file at the end of css, css is only copied if the link needs changing.
+    """
+    m = SOURCE_MAP_URL.search(css, max(0, len(css) - 1024))
+    new_comment = f'/*# sourceMappingURL={map_name} */'
+    if m is None or m.group() == new_comment:
+        return css
+    return ''.join((css[: m.start()], new_comment, css[m.end() :]))
+
+
+def replace_file(src: Path, dst: Path) -> None:
+    """
+    Move src to dst atomically, src is first moved to a temporary file in the same directory as dst.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dst = dst.with_name(f'.{dst.name}.tmp')
+    shutil.move(str(src), str(tmp_dst))
+    os.replace(tmp_dst, dst)
+
+
+def insert_hash(path: Path, content: Union[str, bytes, None] = None, *, hash_length=7, hash_: str = None):
+    """
+    Insert a hash based on the content into the path after the first dot, hash_ may be passed if it's
+    already known.
 
     hash_length 7 matches git commit short references
     """
-    if isinstance(content, str):
-        content = content.encode()
-    hash_ = hashlib.md5(content).hexdigest()[:hash_length]
+    hash_ = (hash_ or content_hash(content))[:hash_length]
     if '.' in path.name:
         new_name = re.sub(r'\.', f'.{hash_}.', path.name, count=1)
     else:
@@ -251,22 +1003,5 @@ def insert_hash(path: Path, content: Union[str, bytes], *, hash_length=7):
     return path.with_name(new_name)
 
 
-KB, MB = 1024, 1024 ** 2
-
-
-def fmt_size(num):
-    if num <= KB:
-        return f'{num:0.0f}B'
-    elif num <= MB:
-        return f'{num / KB:0.1f}KB'
-    else:
-        return f'{num / MB:0.1f}MB'
-
-
 def is_relative_to(p1: Path, p2: Path) -> bool:
-    try:
-        p1.relative_to(p2)
-    except ValueError:
-        return False
-    else:
-        return True
+    return p1 == p2 or p2 in p1.parents
@@ -0,0 +1,113 @@
+import gzip
+import io
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = ('Compressor',)
+logger = logging.getLogger('sasstastic.compress')
+
+
+def gzip_compress(content: bytes) -> bytes:
+    # mtime=0 so output only changes if content changes
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buffer.getvalue()
+
+
+def brotli_compress(content: bytes) -> bytes:
+    return brotli.compress(content, mode=brotli.MODE_TEXT)
+
+
+class Compressor:
+    """
+    Write gzip and, if the "brotli" package is installed, brotli compressed copies of css files for servers
+    which can serve precompressed files, e.g. nginx's "gzip_static".
+
+    Compression happens in a thread pool since zlib and brotli release the GIL. If a file's content is the same
+    as the previously published version, the existing compressed files are reused.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self._formats: List[Tuple[str, Callable[[bytes], bytes]]] = [('.gz', gzip_compress)]
+        if brotli:
+            self._formats.append(('.br', brotli_compress))
+        self._max_workers = max_workers
+        self._executor = None
+        self._futures: List[Future] = []
+        self.compressed = 0
+        self.reused = 0
+
+    def submit(self, path: Path, content: bytes, previous: Path) -> List[Path]:
+        """
+        Create compressed versions of path, previous is the published file which path will replace.
+
+        Returns the paths of compressed files which will be created.
+        """
+        paths = [path.with_name(path.name + ext) for ext, _ in self._formats]
+        prev_paths = [previous.with_name(previous.name + ext) for ext, _ in self._formats]
+        if all(p.is_file() for p in prev_paths) and same_content(previous, content):
+            self.reused += 1
+            if previous != path:
+                for p, prev_p in zip(paths, prev_paths):
+                    link_file(prev_p, p)
+            return paths
+
+        self.compressed += 1
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        for p, (_, compress) in zip(paths, self._formats):
+            self._futures.append(self._executor.submit(write_compressed, p, compress, content))
+        return paths
+
+    def wait(self) -> None:
+        """
+        Wait for all files to be written, raises any error from compression.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            futures, self._futures = self._futures, []
+            for f in futures:
+                f.result()
+        logger.debug('precompressed files: %d files compressed, %d reused', self.compressed, self.reused)
+
+    def close(self) -> None:
+        """
+        Stop compressing, e.g. if the build failed, files which haven't started are cancelled and files being
+        compressed are finished so nothing is written after this returns.
+        """
+        if self._executor is not None:
+            for f in self._futures:
+                f.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._futures = []
+
+
+def write_compressed(path: Path, compress: Callable[[bytes], bytes], content: bytes) -> None:
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    tmp_path.write_bytes(compress(content))
+    os.replace(tmp_path, path)
+
+
+def same_content(path: Path, content: bytes) -> bool:
+    try:
+        return path.stat().st_size == len(content) and path.read_bytes() == content
+    except OSError:
+        return False
+
+
+def link_file(src: Path, dst: Path) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        dst.write_bytes(src.read_bytes())
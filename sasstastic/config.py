@@ -4,10 +4,11 @@ from pathlib import Path
 from typing import Any, Dict, List, Optional, Pattern
 
 import yaml
-from pydantic import BaseModel, HttpUrl, ValidationError, validator
+from pydantic import BaseModel, HttpUrl, PositiveFloat, PositiveInt, ValidationError, confloat, conint, validator
 from pydantic.error_wrappers import display_errors
 
 from .common import SasstasticError, is_file_path
+from .store import default_store_dir
 
 try:
     from yaml import CLoader as Loader
@@ -16,6 +17,7 @@ except ImportError:
 
 __all__ = 'SourceModel', 'DownloadModel', 'ConfigModel', 'load_config'
 logger = logging.getLogger('sasstastic.config')
+WATCH_BACKENDS = 'auto', 'inotify', 'poll'
 
 
 class SourceModel(BaseModel):
@@ -58,6 +60,20 @@ class SourceModel(BaseModel):
 class DownloadModel(BaseModel):
     dir: Path
     sources: List[SourceModel]
+    # maximum number of sources downloaded at once, and from any one host
+    max_concurrency: PositiveInt = 8
+    max_per_host: PositiveInt = 4
+    # timeout for connecting and reading in seconds
+    timeout: PositiveFloat = 30
+    # failed downloads are retried after retry_delay seconds, then twice that, and so on
+    retries: conint(ge=0) = 3
+    retry_delay: PositiveFloat = 0.5
+    # check sources which are up-to-date locally for changes upstream using conditional requests
+    revalidate: bool = False
+    # share downloaded files between projects, by default in $XDG_CACHE_HOME/sasstastic
+    shared_cache: bool = False
+    shared_cache_dir: Optional[Path] = None
+    shared_cache_size: PositiveInt = 500 * 1024 ** 2
 
 
 class ConfigModel(BaseModel):
@@ -67,11 +83,45 @@ class ConfigModel(BaseModel):
     lock_file: Path = Path('.sasstastic.lock')
     include_files: Pattern = re.compile(r'^[^_].+\.(?:css|sass|scss)$')
     exclude_files: Optional[Pattern] = None
+    # directories to skip when searching build_dir for files to compile, matched against paths relative to build_dir
+    exclude_dirs: Optional[Pattern] = None
     replace: Optional[Dict[Pattern, Dict[Pattern, str]]] = None
     file_hashes: bool = False
+    # write gzip and brotli compressed copies of css files, brotli requires the "brotli" package
+    precompress: bool = False
+    # path of a JSON manifest mapping css files to their hashed names, relative to output_dir
+    manifest: Optional[Path] = None
     dev_mode: bool = True
+    jobs: PositiveInt = 1
+    compile_cache_dir: Path = default_store_dir() / 'compile'
+    compile_cache_size: PositiveInt = 100 * 1024 ** 2
+    # share the output of builds between machines, e.g. CI runners, either a directory (e.g. on a network file
+    # system) or a URL supporting GET and PUT, output is stored by a hash of every input file and the config
+    remote_cache: Optional[str] = None
+    # headers for remote cache requests, environment variables like "$TOKEN" are replaced in values
+    remote_cache_headers: Dict[str, str] = {}
+    # set to false to only read from the remote cache, e.g. when building pull requests
+    remote_cache_push: bool = True
+    # how files are watched in watch mode: "auto" uses inotify on Linux and polls for changes elsewhere
+    watch_backend: str = 'auto'
+    # seconds to wait for further changes before building in watch mode
+    watch_debounce: confloat(ge=0) = 0.1
+    # files and directories not to watch, matched against their paths
+    watch_ignore: Optional[Pattern] = None
     config_file: Path
 
+    @validator('manifest')
+    def check_manifest(cls, v):
+        if v is not None and v.is_absolute():
+            raise ValueError('manifest path is relative to output_dir and may not be absolute')
+        return v
+
+    @validator('watch_backend')
+    def check_watch_backend(cls, v):
+        if v not in WATCH_BACKENDS:
+            raise ValueError(f'must be one of: {", ".join(WATCH_BACKENDS)}')
+        return v
+
     @classmethod
     def parse_obj(cls, config_file: Path, obj: Dict[str, Any]) -> 'ConfigModel':
         if isinstance(obj, dict):
@@ -90,6 +140,9 @@ class ConfigModel(BaseModel):
 
         if not m.lock_file.is_absolute():
             m.lock_file = config_directory / m.lock_file
+
+        if not m.compile_cache_dir.is_absolute():
+            m.compile_cache_dir = config_directory / m.compile_cache_dir
         return m
 
 
@@ -2,32 +2,109 @@ import asyncio
 import hashlib
 import json
 import logging
+import os
 import re
+import shutil
+import stat
+import uuid
 import zipfile
-from io import BytesIO
-from itertools import chain
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Set, Tuple
+from typing import TYPE_CHECKING, Dict, Match, NamedTuple, Optional, Pattern, Set, Tuple, Union
 
-from httpx import AsyncClient
+from .common import SasstasticError, is_file_path, remove_file
+from .config import ConfigModel, DownloadModel, SourceModel
+from .store import DownloadStore, default_store_dir
 
-from .common import SasstasticError, is_file_path
-from .config import ConfigModel, SourceModel
+if TYPE_CHECKING:
+    from httpx import AsyncClient
 
-__all__ = ('download_sass', 'Downloader')
+__all__ = 'download_sass', 'Downloader', 'DownloadLimits', 'create_client'
 logger = logging.getLogger('sasstastic.download')
+# partial downloads are kept here so they can be resumed if a download fails, the directory is per user
+PARTIAL_DIR = default_store_dir() / 'partial'
+CHUNK_SIZE = 64 * 1024
+# status codes which indicate a temporary problem so the request should be retried
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# regexes using these can't be combined since group numbers change, named groups are removed before combining
+NUMBERED_GROUP_REF = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+NAMED_GROUP = re.compile(r'(?<!\\)\(\?P<\w+>')
 
 
 def download_sass(config: ConfigModel):
     asyncio.run(Downloader(config).download())
 
 
+def create_client(config: DownloadModel) -> 'AsyncClient':
+    # httpx is slow to import, so it's only imported when something needs downloading
+    from httpx import AsyncClient, Limits
+
+    limits = Limits(max_connections=config.max_concurrency, max_keepalive_connections=config.max_concurrency)
+    return AsyncClient(timeout=config.timeout, limits=limits)
+
+
+class DownloadLimits:
+    """
+    Limit the number of concurrent requests in total and to each host.
+
+    Downloaders for multiple configs can share one instance so the limits apply to all of their requests,
+    it must be created inside the running event loop.
+    """
+
+    def __init__(self, max_concurrency: int, max_per_host: int):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_per_host = max_per_host
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def host_semaphore(self, host: str) -> asyncio.Semaphore:
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._host_semaphores[host] = asyncio.Semaphore(self._max_per_host)
+        return semaphore
+
+
+class RetryableError(Exception):
+    pass
+
+
+class ResumeFailed(Exception):
+    pass
+
+
+class Download(NamedTuple):
+    path: Path
+    hash: str
+    validators: Dict[str, str]
+
+
 class Downloader:
-    def __init__(self, config: ConfigModel):
+    def __init__(
+        self,
+        config: ConfigModel,
+        client: Optional['AsyncClient'] = None,
+        *,
+        store: Optional[DownloadStore] = None,
+        url_locks: Optional[Dict[str, asyncio.Lock]] = None,
+        limits: Optional[DownloadLimits] = None,
+    ):
+        """
+        If client is passed it's used for requests and not closed, so it can be reused for multiple downloads.
+
+        store and url_locks let downloaders for multiple configs share files: while a url is being downloaded
+        other downloaders wait for its lock then find the file in the store. store is only used if the shared
+        cache isn't enabled in config. If limits is passed it's used instead of the limits from config.
+        """
+        self._config = config.download
         self._download_dir = config.download.dir
         self._sources = config.download.sources
-        self._client = AsyncClient()
+        self._client = client
         self._lock_check = LockCheck(self._download_dir, config.lock_file)
+        self._store = store
+        if self._config.shared_cache:
+            self._store = DownloadStore(self._config.shared_cache_dir or default_store_dir())
+        self._url_locks = {} if url_locks is None else url_locks
+        self._limits = limits
 
     async def download(self):
         if not self._sources:
@@ -35,77 +112,360 @@ class Downloader:
             return
 
         to_download = [s for s in self._sources if self._lock_check.should_download(s)]
-        if to_download:
+        to_revalidate = []
+        if self._config.revalidate:
+            # sources with unchanged local files are checked for changes upstream with conditional requests
+            to_revalidate = [s for s in self._sources if s not in to_download and self._lock_check.validators(s)]
+        if to_download or to_revalidate:
             logger.info(
-                '\ndownloading %d files to %s, %d up-to-date',
+                '\ndownloading %d files to %s, %d up-to-date, %d to check for changes',
                 len(to_download),
                 self._download_dir,
-                len(self._sources) - len(to_download),
+                len(self._sources) - len(to_download) - len(to_revalidate),
+                len(to_revalidate),
             )
+            if self._limits is None:
+                # semaphores must be created inside the running event loop
+                self._limits = DownloadLimits(self._config.max_concurrency, self._config.max_per_host)
+            own_client = self._client is None
+            if own_client:
+                self._client = create_client(self._config)
             try:
-                await asyncio.gather(*[self._download_source(s) for s in to_download])
+                await asyncio.gather(
+                    *[self._download_source(s) for s in to_download],
+                    *[self._download_source(s, revalidate=True) for s in to_revalidate],
+                )
             finally:
-                await self._client.aclose()
+                if own_client:
+                    await self._client.aclose()
+                    self._client = None
             self._lock_check.save()
+            if self._config.shared_cache:
+                self._store.prune(self._config.shared_cache_size)
         else:
             logger.info('\nno new files to download, %d up-to-date', len(self._sources))
+            if self._lock_check.modified:
+                self._lock_check.save()
         self._lock_check.delete_stale()
 
-    async def _download_source(self, s: SourceModel):
-        logger.debug('%s: downloading...', s.url)
-        r = await self._client.get(s.url)
-        if r.status_code != 200:
-            logger.error('Error downloading %r, unexpected status code: %s', s.url, r.status_code)
-            raise SasstasticError(f'unexpected status code {r.status_code}')
+    async def _download_source(self, s: SourceModel, revalidate: bool = False):
+        """
+        Download a source, if revalidate is True the local files are up-to-date so a conditional request is made
+        and nothing is done if the source hasn't changed.
+        """
+        url_lock = self._url_locks.get(s.url)
+        if url_lock is None:
+            url_lock = self._url_locks[s.url] = asyncio.Lock()
+        async with url_lock:
+            download = await self._fetch(s, revalidate)
+        if download is None:
+            logger.debug('%s: not modified', s.url)
+            return
 
+        self._lock_check.record_validators(s, download.validators)
         loop = asyncio.get_running_loop()
         if s.extract is None:
-            path = await loop.run_in_executor(None, self._save_file, s.to, r.content)
-            self._lock_check.record(s, s.to, r.content)
+            path = await loop.run_in_executor(None, self._save_file, s.to, download)
+            self._lock_check.record(s, s.to, download.hash)
             logger.info('>>  downloaded %s ➤ %s', s.url, path)
         else:
-            count = await loop.run_in_executor(None, self._extract_zip, s, r.content)
+            try:
+                count = await loop.run_in_executor(None, self._extract_zip, s, download.path)
+            finally:
+                if not self._store:
+                    download.path.unlink()
             logger.info('>>  downloaded %s ➤ extract %d files', s.url, count)
 
-    def _extract_zip(self, s: SourceModel, content: bytes):
-        zcopied = 0
-        with zipfile.ZipFile(BytesIO(content)) as zipf:
-            logger.debug('%s: %d files in zip archive', s.url, len(zipf.namelist()))
+    async def _fetch(self, s: SourceModel, revalidate: bool) -> Optional[Download]:
+        """
+        Download a source or find it in the store, returns None if revalidate is True and the source hasn't changed.
+
+        If there's a store it's checked before downloading and new downloads are added to it.
+        """
+        stored = self._store and self._store.get(s.url)
+        if stored and not revalidate and not self._config.revalidate:
+            logger.debug('%s: found in shared store', s.url)
+            return stored
 
-            for filepath in zipf.namelist():
-                if filepath.endswith('/'):
+        validators = self._lock_check.validators(s) if revalidate else stored and stored.validators
+        async with self._limits.semaphore, self._limits.host_semaphore(s.url.host):
+            download = await self._download_retry(s, validators)
+
+        if download is None:
+            if not revalidate:
+                logger.debug('%s: not modified, using shared store', s.url)
+            return None if revalidate else stored
+        elif self._store:
+            return self._store.add(s.url, download.path, download.hash, download.validators)
+        else:
+            return download
+
+    async def _download_retry(self, s: SourceModel, validators: Optional[Dict[str, str]]) -> Optional[Download]:
+        """
+        Download a source, retrying with exponential backoff on network errors and temporary server errors.
+
+        Partial downloads are kept so retries resume where the previous attempt stopped.
+        """
+        from httpx import HTTPError
+
+        for attempt in range(self._config.retries + 1):
+            logger.debug('%s: downloading...', s.url)
+            try:
+                try:
+                    return await self._stream_to_file(s, validators)
+                except ResumeFailed as e:
+                    # the partial file has been deleted so the whole file is downloaded
+                    logger.warning('%s: %s, downloading from the start', s.url, e)
+                    return await self._stream_to_file(s, validators)
+            except (HTTPError, RetryableError) as e:
+                if attempt == self._config.retries:
+                    logger.error('Error downloading %r after %d attempts: %r', s.url, attempt + 1, e)
+                    raise SasstasticError(f'error downloading {s.url}')
+                delay = self._config.retry_delay * 2 ** attempt
+                logger.warning('%s: %r, retrying in %0.1fs', s.url, e, delay)
+                await asyncio.sleep(delay)
+
+    async def _stream_to_file(self, s: SourceModel, validators: Optional[Dict[str, str]]) -> Optional[Download]:
+        """
+        Stream the response body to a file in chunks, returns the file path, md5 hash of the content
+        and the response's validators, or None if validators were given and the source hasn't changed.
+
+        If a partial file exists from a previous failed attempt, the download is resumed with a range request.
+        "If-Range" is used so the server returns the whole file if it's changed since the partial download.
+        """
+        url = s.url
+        PARTIAL_DIR.mkdir(parents=True, exist_ok=True)
+        part_path = partial_path(self._download_dir, s)
+        meta_path = part_path.with_suffix('.json')
+        headers, offset = request_headers(validators, part_path, meta_path)
+        async with self._client.stream('GET', url, headers=headers) as r:
+            h = hashlib.md5()
+            if r.status_code == 304 and validators:
+                return None
+            elif r.status_code == 206 and r.headers.get('content-range', '').startswith(f'bytes {offset}-'):
+                logger.debug('%s: resuming download from %d bytes', url, offset)
+                with part_path.open('rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        h.update(chunk)
+                mode = 'ab'
+            elif offset and r.status_code in {206, 416}:
+                # the partial file is already complete or the server returned a different range
+                remove_file(part_path)
+                remove_file(meta_path)
+                raise ResumeFailed(f'unable to resume download, status code {r.status_code}')
+            elif r.status_code == 200:
+                mode = 'wb'
+                validator = resume_validator(r.headers)
+                if validator:
+                    meta_path.write_text(json.dumps(validator))
+                else:
+                    remove_file(meta_path)
+            elif r.status_code in RETRY_STATUS_CODES:
+                raise RetryableError(f'unexpected status code {r.status_code}')
+            else:
+                logger.error('Error downloading %r, unexpected status code: %s', url, r.status_code)
+                raise SasstasticError(f'unexpected status code {r.status_code}')
+
+            with part_path.open(mode) as f:
+                async for chunk in r.aiter_bytes():
+                    f.write(chunk)
+                    h.update(chunk)
+
+            new_validators = {'etag': r.headers.get('etag'), 'last_modified': r.headers.get('last-modified')}
+
+        remove_file(meta_path)
+        # move the finished file to a unique path so nothing else can append to or move it
+        download_path = part_path.with_name(f'{part_path.stem}.{uuid.uuid4().hex}.download')
+        try:
+            os.replace(part_path, download_path)
+        except FileNotFoundError:
+            raise RetryableError('partial download was removed by another process')
+        return Download(download_path, h.hexdigest(), {k: v for k, v in new_validators.items() if v})
+
+    def _extract_zip(self, s: SourceModel, zip_path: Path) -> int:
+        """
+        Extract files matching the source's "extract" rules, returns the number of files extracted.
+
+        Files are decompressed and written in a thread pool, files which are unchanged since the last
+        download aren't rewritten.
+        """
+        matcher = ExtractMatcher(s.extract)
+        previous = self._lock_check.files(s)
+        with zipfile.ZipFile(zip_path) as zipf:
+            members = zipf.infolist()
+            logger.debug('%s: %d files in zip archive', s.url, len(members))
+
+            # if multiple files are extracted to the same path, the last wins
+            targets: Dict[Path, zipfile.ZipInfo] = {}
+            for info in members:
+                if info.is_dir():
+                    continue
+                m = matcher.match(info.filename)
+                if m is None:
+                    logger.debug('%s: "%s" no target found', s.url, info.filename)
                     continue
-                regex_pattern, match, file_path = None, None, None
-                for r, t in s.extract.items():
-                    match = r.match(filepath)
-                    if match:
-                        regex_pattern, file_path = r, t
-                        break
-                if regex_pattern is None:
-                    logger.debug('%s: "%s" no target found', s.url, filepath)
-                elif file_path is None:
-                    logger.debug('%s: "%s" skipping (regex: "%s")', s.url, filepath, regex_pattern)
+                regex_pattern, file_path, match = m
+                if file_path is None:
+                    logger.debug('%s: "%s" skipping (regex: "%s")', s.url, info.filename, regex_pattern)
                 else:
                     if not is_file_path(file_path):
                         file_name = match.groupdict().get('filename') or match.groups()[-1]
                         file_path = file_path / file_name
-                    logger.debug('%s: "%s" ➤ "%s" (regex: "%s")', s.url, filepath, file_path, regex_pattern)
-                    content = zipf.read(filepath)
-                    self._lock_check.record(s, file_path, content)
-                    self._save_file(file_path, content)
-                    zcopied += 1
-        return zcopied
-
-    def _save_file(self, save_to: Path, content) -> Path:
+                    logger.debug('%s: "%s" ➤ "%s" (regex: "%s")', s.url, info.filename, file_path, regex_pattern)
+                    targets[file_path] = info
+
+            def extract(item: Tuple[Path, zipfile.ZipInfo]) -> Tuple[str, bool]:
+                file_path, info = item
+                return self._extract_file(zipf, info, file_path, previous.get(str(file_path)))
+
+            with ThreadPoolExecutor() as executor:
+                results = list(executor.map(extract, targets.items()))
+
+        written = 0
+        for file_path, (content_hash, changed) in zip(targets, results):
+            self._lock_check.record(s, file_path, content_hash)
+            written += changed
+        logger.debug('%s: %d files extracted, %d unchanged', s.url, written, len(targets) - written)
+        return len(targets)
+
+    def _extract_file(
+        self, zipf: zipfile.ZipFile, info: zipfile.ZipInfo, save_to: Path, previous: Optional['FileRecord']
+    ) -> Tuple[str, bool]:
+        """
+        Decompress a file from the zip archive in chunks, returns the md5 hash of its content and whether
+        the file was written.
+
+        If previous is the lock file record for the path and the file matches it and the zip file's CRC,
+        the file isn't written.
+        """
         p = self._download_dir / save_to
+        if previous is not None:
+            record = self._lock_check.check_file(*previous)
+            if record is not None and same_crc(p, info):
+                return record[1], False
+
         p.parent.mkdir(parents=True, exist_ok=True)
-        p.write_bytes(content)
+        h = hashlib.md5()
+        with zipf.open(info) as src, p.open('wb') as dst:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                dst.write(chunk)
+                h.update(chunk)
+        return h.hexdigest(), True
+
+    def _save_file(self, save_to: Path, download: Download) -> Path:
+        p = self._download_dir / save_to
+        if self._store:
+            self._store.materialise(download, p)
+        else:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(download.path), str(p))
         return p
 
 
+def request_headers(
+    validators: Optional[Dict[str, str]], part_path: Path, meta_path: Path
+) -> Tuple[Dict[str, str], int]:
+    """
+    Headers for a conditional request if there are validators, otherwise for a range request to resume
+    a partial download if there is one, returns the headers and the offset to resume from.
+    """
+    headers = {}
+    if validators:
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+    elif part_path.is_file() and meta_path.is_file():
+        offset = part_path.stat().st_size
+        return {'Range': f'bytes={offset}-', 'If-Range': json.loads(meta_path.read_text())}, offset
+    return headers, 0
+
+
+def partial_path(download_dir: Path, s: SourceModel) -> Path:
+    """
+    Path of the partial file used while downloading a source, it includes the download directory so projects
+    downloading the same source at the same time use different files.
+    """
+    key = json.dumps([str(download_dir.absolute()), LockCheck.hash_source(s)])
+    return PARTIAL_DIR / f'{hashlib.md5(key.encode()).hexdigest()}.part'
+
+
+def resume_validator(headers) -> Optional[str]:
+    """
+    Find the value to use as "If-Range" when resuming a download of this response, or None if it can't be resumed.
+    """
+    if headers.get('content-encoding'):
+        # content is decoded as it's written so offsets in the partial file can't be used for range requests
+        return None
+    return headers.get('etag') or headers.get('last-modified')
+
+
+class ExtractMatcher:
+    """
+    Find the first of a source's "extract" rules which matches each file in a zip archive.
+
+    Rules are combined into one regex so each file is matched once rather than against every rule in turn,
+    if the rules can't be combined, e.g. because they use backreferences, they're tried one at a time.
+    """
+
+    def __init__(self, extract: Dict[Pattern, Optional[Path]]):
+        self._rules = list(extract.items())
+        self._combined: Optional[Pattern] = None
+        # group number of each rule in the combined regex ➤ index of the rule
+        self._group_rules: Dict[int, int] = {}
+        combinable = all(r.flags == re.UNICODE and not NUMBERED_GROUP_REF.search(r.pattern) for r, _ in self._rules)
+        if len(self._rules) > 1 and combinable:
+            try:
+                self._combined = re.compile('|'.join(f'({NAMED_GROUP.sub("(", r.pattern)})' for r, _ in self._rules))
+            except re.error:
+                pass
+            else:
+                group = 1
+                for i, (r, _) in enumerate(self._rules):
+                    self._group_rules[group] = i
+                    group += r.groups + 1
+
+    def match(self, name: str) -> Optional[Tuple[Pattern, Optional[Path], Match]]:
+        if self._combined is None:
+            for r, t in self._rules:
+                m = r.match(name)
+                if m:
+                    return r, t, m
+            return None
+
+        m = self._combined.match(name)
+        if m is None:
+            return None
+        # the rule's group closes after any groups inside it, so it's always the last matched group
+        r, t = self._rules[self._group_rules[m.lastindex]]
+        return r, t, r.match(name)
+
+
+def same_crc(path: Path, info: zipfile.ZipInfo) -> bool:
+    """
+    Whether the file at path has the same size and CRC32 as a file in a zip archive.
+    """
+    try:
+        if path.stat().st_size != info.file_size:
+            return False
+        crc = 0
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+    except OSError:
+        return False
+    return crc == info.CRC
+
+
+# path, md5 hash, and optionally size and mtime_ns of a downloaded file
+FileRecord = Union[Tuple[str, str], Tuple[str, str, int, int]]
+
+
 class LockCheck:
     """
     Avoid downloading unchanged files by consulting a "lock file" cache.
+
+    Files are only hashed if their size or modification time has changed since they were recorded.
     """
 
     file_description = (
@@ -117,50 +477,106 @@ class LockCheck:
     def __init__(self, root_dir: Path, lock_file: Path):
         self._root_dir = root_dir
         self._lock_file = lock_file
+        self._cache: Dict[str, Set[FileRecord]] = {}
+        # ETag and Last-Modified headers for each source, used to make conditional requests
+        self._validators: Dict[str, Dict[str, str]] = {}
         if lock_file.is_file():
             lines = (ln for ln in lock_file.read_text().split('\n') if not re.match(r'\s*#', ln))
             c = json.loads('\n'.join(lines))
-            self._cache: Dict[str, Set[Tuple[str, str]]] = {k: {tuple(f) for f in v} for k, v in c.items()}
-        else:
-            self._cache = {}
+            for k, v in c.items():
+                if isinstance(v, list):
+                    # lock file from an older version of sasstastic
+                    v = {'files': v}
+                self._cache[k] = {tuple(f) for f in v.pop('files')}
+                self._validators[k] = v
         self._active: Set[str] = set()
+        self._recorded: Set[str] = set()
+        # whether file records have changed and the lock file should be saved
+        self.modified = False
 
     def should_download(self, s: SourceModel) -> bool:
-        k = self._hash_source(s)
+        k = self.hash_source(s)
         files = self._cache.get(k)
         if files is None:
             return True
         else:
             self._active.add(k)
-            return not any(self._file_unchanged(*v) for v in files)
+            checked = set()
+            for f in files:
+                r = self.check_file(*f)
+                if r is None:
+                    return True
+                checked.add(r)
+            if checked != files:
+                self._cache[k] = checked
+                self.modified = True
+            return False
+
+    def files(self, s: SourceModel) -> Dict[str, FileRecord]:
+        """
+        Records of files from the last download of a source, keyed by path.
+        """
+        return {f[0]: f for f in self._cache.get(self.hash_source(s), ())}
 
-    def record(self, s: SourceModel, path: Path, content: bytes):
-        k = self._hash_source(s)
-        r = str(path), hashlib.md5(content).hexdigest()
+    def validators(self, s: SourceModel) -> Dict[str, str]:
+        return self._validators.get(self.hash_source(s), {})
+
+    def record(self, s: SourceModel, path: Path, file_hash: str):
+        k = self.hash_source(s)
+        st = (self._root_dir / path).stat()
+        r = str(path), file_hash, st.st_size, st.st_mtime_ns
         self._active.add(k)
-        files = self._cache.get(k)
-        if files is None:
-            self._cache[k] = {r}
-        else:
-            files.add(r)
+        if k not in self._recorded:
+            # first file recorded for this source in this run, forget files from previous downloads
+            self._recorded.add(k)
+            self._cache[k] = set()
+        self._cache[k].add(r)
+
+    def record_validators(self, s: SourceModel, validators: Dict[str, str]):
+        self._validators[self.hash_source(s)] = validators
 
     def save(self):
-        lines = ',\n'.join(f'  "{k}": {json.dumps(sorted(v))}' for k, v in self._cache.items() if k in self._active)
+        lines = ',\n'.join(
+            f'  "{k}": {json.dumps({"files": sorted(v), **self._validators.get(k, {})})}'
+            for k, v in self._cache.items()
+            if k in self._active
+        )
         self._lock_file.write_text(f'{self.file_description}\n{{\n{lines}\n}}')
 
     def delete_stale(self):
-        d_files = set(chain.from_iterable((p for p, _ in f) for u, f in self._cache.items() if u in self._active))
-        for p in self._root_dir.glob('**/*'):
-            rel_path = str(p.relative_to(self._root_dir))
-            if rel_path not in d_files and p.is_file():
-                p.unlink()
-                logger.info('>>  %s stale and deleted', rel_path)
+        d_files = {f[0] for u, files in self._cache.items() if u in self._active for f in files}
+        for dir_path, _, file_names in os.walk(self._root_dir):
+            for file_name in file_names:
+                p = Path(dir_path) / file_name
+                rel_path = str(p.relative_to(self._root_dir))
+                if rel_path not in d_files:
+                    p.unlink()
+                    logger.info('>>  %s stale and deleted', rel_path)
 
-    def _file_unchanged(self, path: str, file_hash: str) -> bool:
-        p = self._root_dir / path
-        return p.is_file() and hashlib.md5(p.read_bytes()).hexdigest() == file_hash
+    def check_file(self, path: str, file_hash: str, size: int = None, mtime_ns: int = None) -> Optional[FileRecord]:
+        """
+        Check a file is unchanged, returns an up-to-date record for the file or None if it's changed or missing.
+        """
+        try:
+            st = (self._root_dir / path).stat()
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or (size is not None and st.st_size != size):
+            return None
+        elif st.st_mtime_ns == mtime_ns:
+            return path, file_hash, size, mtime_ns
+
+        # the file might have been touched without being modified, e.g. by a fresh checkout
+        h = hashlib.md5()
+        with open(self._root_dir / path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+        if h.hexdigest() == file_hash:
+            return path, file_hash, st.st_size, st.st_mtime_ns
+        else:
+            return None
 
     @staticmethod
-    def _hash_source(s: SourceModel):
+    def hash_source(s: SourceModel):
         j = str(s.url), None if s.extract is None else {str(k): str(v) for k, v in s.extract.items()}, str(s.to)
         return hashlib.md5(json.dumps(j).encode()).hexdigest()
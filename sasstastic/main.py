@@ -1,58 +1,249 @@
 import asyncio
 import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from time import perf_counter
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
 
-import watchgod
-
-from .compile import compile_sass
+from .common import SasstasticError
+from .compile import DependencyIndex, compile_changed_async, compile_sass, compile_sass_async
 from .config import ConfigModel, load_config
-from .download import Downloader, download_sass
+from .download import Downloader, DownloadLimits, create_client, download_sass
+from .profiling import BuildProfile
+from .store import DownloadStore
+
+if TYPE_CHECKING:
+    from httpx import AsyncClient
+
+    from .watch import Change, Watcher
 
 logger = logging.getLogger('sasstastic.main')
-__all__ = 'download_and_compile', 'watch', 'awatch'
+__all__ = 'download_and_compile', 'download_and_compile_many', 'watch', 'awatch'
 
 
-def download_and_compile(config: ConfigModel, alt_output_dir: Optional[Path] = None, dev_mode: Optional[bool] = None):
+def download_and_compile(
+    config: ConfigModel,
+    alt_output_dir: Optional[Path] = None,
+    dev_mode: Optional[bool] = None,
+    *,
+    jobs: Optional[int] = None,
+    cache: bool = True,
+    profile: Optional[BuildProfile] = None,
+):
     logger.info('build path:  %s/', config.build_dir)
     logger.info('output path: %s/', alt_output_dir or config.output_dir)
 
     download_sass(config)
-    compile_sass(config, alt_output_dir, dev_mode)
+    compile_sass(config, alt_output_dir, dev_mode, jobs=jobs, cache=cache, profile=profile)
+
+
+def download_and_compile_many(
+    configs: List[ConfigModel], dev_mode: Optional[bool] = None, *, jobs: Optional[int] = None, cache: bool = True
+):
+    """
+    Download and compile multiple projects concurrently in one process.
+
+    All downloads share one http client and sources used by multiple configs are only downloaded once,
+    all compilation uses one pool of "jobs" worker processes, by default one per CPU.
+    """
+    asyncio.run(adownload_and_compile_many(configs, dev_mode, jobs=jobs, cache=cache))
+
+
+async def adownload_and_compile_many(
+    configs: List[ConfigModel], dev_mode: Optional[bool] = None, *, jobs: Optional[int] = None, cache: bool = True
+):
+    start = perf_counter()
+    loop = asyncio.get_running_loop()
+    url_locks: Dict[str, asyncio.Lock] = {}
+    # the client and request limits are shared, so the longest timeout and the lowest limits are used
+    download_config = configs[0].download.copy(
+        update=dict(
+            timeout=max(c.download.timeout for c in configs),
+            max_concurrency=min(c.download.max_concurrency for c in configs),
+            max_per_host=min(c.download.max_per_host for c in configs),
+        )
+    )
+    limits = DownloadLimits(download_config.max_concurrency, download_config.max_per_host)
+
+    async def build(config: ConfigModel) -> Tuple[Optional[int], float]:
+        build_start = perf_counter()
+        try:
+            await Downloader(config, client, store=store, url_locks=url_locks, limits=limits).download()
+            compile_ = partial(compile_sass, config, None, dev_mode, cache=cache, executor=executor)
+            index = await loop.run_in_executor(None, compile_)
+        except SasstasticError:
+            return None, perf_counter() - build_start
+        else:
+            return len(index), perf_counter() - build_start
+
+    with tempfile.TemporaryDirectory() as tmp, ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        # downloads are only kept for this batch, so they're not made read only
+        store = DownloadStore(Path(tmp), read_only=False)
+        async with create_client(download_config) as client:
+            results = await asyncio.gather(*[build(c) for c in configs])
+
+    failed = sum(files is None for files, _ in results)
+    time_taken = (perf_counter() - start) * 1000
+    logger.info('\nbuilt %d of %d configs in %0.0fms', len(configs) - failed, len(configs), time_taken)
+    for config, (files, build_time) in zip(configs, results):
+        status = 'failed' if files is None else f'{files} files'
+        logger.info('>>  %-60s %12s %8.0fms', config.config_file, status, build_time * 1000)
+    if failed:
+        raise SasstasticError(f'{failed} of {len(configs)} builds failed')
 
 
-def watch(config: ConfigModel, alt_output_dir: Optional[Path] = None, dev_mode: Optional[bool] = None):
+def watch(
+    config: ConfigModel,
+    alt_output_dir: Optional[Path] = None,
+    dev_mode: Optional[bool] = None,
+    *,
+    jobs: Optional[int] = None,
+    cache: bool = True,
+    profile: Optional[BuildProfile] = None,
+):
     try:
-        asyncio.run(awatch(config, alt_output_dir, dev_mode))
+        asyncio.run(awatch(config, alt_output_dir, dev_mode, jobs=jobs, cache=cache, profile=profile))
     except KeyboardInterrupt:
         pass
 
 
-async def awatch(config: ConfigModel, alt_output_dir: Optional[Path] = None, dev_mode: Optional[bool] = None):
+async def awatch(
+    config: ConfigModel,
+    alt_output_dir: Optional[Path] = None,
+    dev_mode: Optional[bool] = None,
+    *,
+    jobs: Optional[int] = None,
+    cache: bool = True,
+    profile: Optional[BuildProfile] = None,
+):
     logger.info('build path:  %s/', config.build_dir)
     logger.info('output path: %s/', alt_output_dir or config.output_dir)
 
-    await Downloader(config).download()
-    compile_sass(config, alt_output_dir, dev_mode)
+    # the http client is reused for downloads each time the config file changes
+    async with create_client(config.download) as client:
+        await Downloader(config, client).download()
+        index = await compile_sass_async(config, alt_output_dir, dev_mode, jobs=jobs, cache=cache, profile=profile)
+        rebuilder = Rebuilder(config, client, index, alt_output_dir, dev_mode, jobs=jobs, cache=cache, profile=profile)
+        await rebuilder.run()
 
-    config_file = str(config.config_file)
-    async for changes in watch_multiple(config_file, config.build_dir):
+
+class Rebuilder:
+    """
+    Download and compile after files change in watch mode.
+
+    Builds run in a task so the event loop isn't blocked. If more changes are detected while a build is running
+    or waiting to start, it's cancelled and a new build is started for all changes, so a burst of changes results
+    in one build.
+    """
+
+    def __init__(
+        self,
+        config: ConfigModel,
+        client: 'AsyncClient',
+        index: DependencyIndex,
+        alt_output_dir: Optional[Path] = None,
+        dev_mode: Optional[bool] = None,
+        **compile_kwargs,
+    ):
+        self._config = config
+        self._client = client
+        self._index = index
+        self._alt_output_dir = alt_output_dir
+        self._dev_mode = dev_mode
+        self._compile_kwargs = compile_kwargs
+        # changes which haven't been built yet, changes are only removed once a build succeeds
+        self._pending: Set[Tuple['Change', str]] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self) -> None:
+        changes_iter = self._watch().__aiter__()
+        next_changes = asyncio.ensure_future(changes_iter.__anext__())
+        try:
+            while True:
+                waiting = {next_changes} if self._task is None else {next_changes, self._task}
+                done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if self._task in done:
+                    task, self._task = self._task, None
+                    # raise any errors from the build
+                    task.result()
+                if next_changes in done:
+                    self._pending |= next_changes.result()
+                    next_changes = asyncio.ensure_future(changes_iter.__anext__())
+                    await self._restart()
+        finally:
+            next_changes.cancel()
+            await self._stop()
+
+    def _watch(self) -> 'Watcher':
+        from .watch import Watcher
+
+        config = self._config
+        # sasstastic writes to the download and output directories, watching them would trigger more builds
+        ignore_dirs = [config.download.dir, self._alt_output_dir or config.output_dir]
+        return Watcher(
+            [config.config_file, config.build_dir],
+            ignore_dirs=ignore_dirs,
+            ignore=config.watch_ignore,
+            debounce=config.watch_debounce,
+            backend=config.watch_backend,
+        )
+
+    async def _restart(self) -> None:
+        if self._task is not None:
+            logger.debug('more changes detected, restarting build')
+            await self._stop()
+        self._task = asyncio.ensure_future(self._build(set(self._pending)))
+
+    async def _stop(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.wait([task])
+            if not task.cancelled():
+                # the build finished before it could be cancelled
+                task.result()
+
+    async def _build(self, changes: Set[Tuple['Change', str]]) -> None:
+        config_file = str(self._config.config_file)
         changed_paths = {c[1] for c in changes}
-        if config_file in changed_paths:
+        config_changed = config_file in changed_paths
+        if config_changed:
             logger.info('changes detected in config file, downloading sources...')
-            config = load_config(config.config_file)
-            await Downloader(config).download()
+            self._config = load_config(self._config.config_file)
+            await Downloader(self._config, self._client).download()
 
         if changed_paths != {config_file}:
-            logger.info('changes detected in the build directory, re-compiling...')
-            compile_sass(config, alt_output_dir, dev_mode)
+            await self._compile(changes, config_changed)
+        self._pending -= changes
 
+    async def _compile(self, changes: Set[Tuple['Change', str]], config_changed: bool) -> None:
+        from .watch import Change
 
-async def watch_multiple(*paths):
-    watchers = [watchgod.awatch(p) for p in paths]
-    while True:
-        done, pending = await asyncio.wait([w.__anext__() for w in watchers], return_when=asyncio.FIRST_COMPLETED)
-        for t in pending:
-            t.cancel()
-        for t in done:
-            yield t.result()
+        args = self._config, self._alt_output_dir, self._dev_mode
+        if config_changed:
+            logger.info('re-compiling...')
+            self._index = await compile_sass_async(*args, **self._compile_kwargs)
+        elif any(change != Change.modified for change, _ in changes):
+            # files have been added or deleted, the set of entry points and imports may have changed,
+            # entry points from the last build are updated instead of searching the build directory again
+            logger.info('changes detected in the build directory, re-compiling...')
+            entry_points: Optional[Set[Path]] = set(self._index.entry_points)
+            for change, p in changes:
+                path = Path(p).absolute()
+                if path.is_dir():
+                    # inotify may report a directory if events were lost, search the build directory again
+                    entry_points = None
+                    break
+                elif change == Change.deleted:
+                    entry_points.discard(path)
+                else:
+                    entry_points.add(path)
+            self._index = await compile_sass_async(*args, entry_points=entry_points, **self._compile_kwargs)
+        else:
+            modified = {Path(p).absolute() for _, p in changes}
+            await compile_changed_async(
+                self._config, modified, self._index, self._alt_output_dir, self._dev_mode, **self._compile_kwargs
+            )
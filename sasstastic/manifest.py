@@ -0,0 +1,84 @@
+import base64
+import hashlib
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterator, NamedTuple, Optional, Union
+
+__all__ = 'Manifest', 'ManifestEntry', 'load_manifest'
+
+
+class ManifestEntry(NamedTuple):
+    # path of the output file relative to the output directory, including the hash if "file_hashes" is set
+    path: str
+    size: int
+    # subresource integrity digest, e.g. for <link integrity="...">
+    integrity: str
+
+    @classmethod
+    def from_content(cls, path: str, content: bytes) -> 'ManifestEntry':
+        digest = base64.b64encode(hashlib.sha384(content).digest()).decode()
+        return cls(path, len(content), f'sha384-{digest}')
+
+
+class Manifest:
+    """
+    Mapping of css files to their output path, size and integrity digest, keyed by the path the file would
+    have without a hash, e.g. "main.css" ➤ ManifestEntry("main.<hash>.css", ...).
+    """
+
+    def __init__(self, entries: Dict[str, ManifestEntry]):
+        self._entries = entries
+
+    @classmethod
+    def parse_file(cls, path: Path) -> 'Manifest':
+        data = json.loads(path.read_text())
+        return cls({k: ManifestEntry(**v) for k, v in data.items()})
+
+    def save(self, path: Path) -> None:
+        """
+        Write the manifest to a temporary file then rename it to path so it's replaced atomically.
+        """
+        data = {k: v._asdict() for k, v in sorted(self._entries.items())}
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        tmp_path.write_text(json.dumps(data, indent=2))
+        os.replace(tmp_path, path)
+
+    def update(self, changes: Dict[str, Optional[ManifestEntry]]) -> None:
+        """
+        Update entries, entries set to None are removed.
+        """
+        for k, v in changes.items():
+            if v is None:
+                self._entries.pop(k, None)
+            else:
+                self._entries[k] = v
+
+    def path(self, name: str) -> str:
+        """
+        Find the output path of a css file, e.g. manifest.path('main.css') == 'main.<hash>.css'.
+        """
+        return self._entries[name].path
+
+    def __getitem__(self, name: str) -> ManifestEntry:
+        return self._entries[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@lru_cache(maxsize=None)
+def load_manifest(path: Union[str, Path]) -> Manifest:
+    """
+    Load a manifest written by sasstastic, the file is only read the first time a path is loaded.
+
+    Use load_manifest.cache_clear() to reload manifests, e.g. after a deploy.
+    """
+    return Manifest.parse_file(Path(path))
@@ -0,0 +1,89 @@
+import json
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional
+
+__all__ = 'BuildProfile', 'FileProfile'
+logger = logging.getLogger('sasstastic.profiling')
+STAGES = 'compile', 'replace', 'hash', 'write'
+
+
+class FileProfile:
+    """
+    Time spent on each stage of building one entry point along with its import count and input and output size.
+    """
+
+    def __init__(self):
+        self.times: Dict[str, float] = dict.fromkeys(STAGES, 0.0)
+        self.cached = False
+        self.imports = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    @property
+    def total(self) -> float:
+        return sum(self.times.values())
+
+    def dict(self) -> dict:
+        return {
+            'total_ms': round(self.total * 1000, 3),
+            **{f'{k}_ms': round(v * 1000, 3) for k, v in self.times.items()},
+            'cached': self.cached,
+            'imports': self.imports,
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+        }
+
+
+class BuildProfile:
+    """
+    Per file timings for a build, used by the "--profile" option.
+
+    After each build the slowest "top" files are logged and if json_path is set a report is written there.
+    """
+
+    def __init__(self, top: int = 10, json_path: Optional[Path] = None):
+        self.top = top
+        self.json_path = json_path
+        self.files: Dict[str, FileProfile] = {}
+
+    def reset(self) -> None:
+        self.files = {}
+
+    def file(self, path) -> FileProfile:
+        key = str(path)
+        f = self.files.get(key)
+        if f is None:
+            f = self.files[key] = FileProfile()
+        return f
+
+    @contextmanager
+    def time(self, path, stage: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.file(path).times[stage] += perf_counter() - start
+
+    def report(self) -> None:
+        files: List = sorted(self.files.items(), key=lambda kv: kv[1].total, reverse=True)
+        top = min(self.top, len(files))
+        logger.info('\nprofile: slowest %d of %d files, times in ms, sizes in bytes', top, len(files))
+        logger.info('%-40s %9s %9s %9s %9s %7s %9s %9s', 'file', *STAGES, 'imports', 'in', 'out')
+        for path, f in files[: self.top]:
+            logger.info(
+                '%-40s %9.1f %9.1f %9.1f %9.1f %7d %9d %9d%s',
+                path,
+                *(f.times[s] * 1000 for s in STAGES),
+                f.imports,
+                f.input_bytes,
+                f.output_bytes,
+                ' (cached)' if f.cached else '',
+            )
+
+        if self.json_path:
+            data = {'files': {path: f.dict() for path, f in files}}
+            self.json_path.write_text(json.dumps(data, indent=2))
+            logger.info('profile report written to %s', self.json_path)
@@ -0,0 +1,247 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import tarfile
+import uuid
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Optional
+
+import sass
+
+from .cache import file_hash
+from .common import SasstasticError, fmt_size
+from .compress import brotli
+from .config import ConfigModel
+from .version import VERSION
+
+__all__ = 'CacheBackend', 'DirectoryBackend', 'HttpBackend', 'RemoteCache', 'create_backend'
+logger = logging.getLogger('sasstastic.remote_cache')
+INDEX_NAME = 'index.json'
+OUTPUT_DIR = 'output'
+
+
+class CacheBackend:
+    """
+    Storage for build outputs shared between machines, e.g. CI runners.
+
+    To use other storage, subclass this and implement get and put, then pass an instance to compile_sass
+    as "remote_cache". Both should raise SasstasticError if the storage can't be reached.
+    """
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Find the data stored for key, or None if there isn't any.
+        """
+        raise NotImplementedError
+
+    def put(self, key: str, data: bytes) -> None:
+        raise NotImplementedError
+
+
+class DirectoryBackend(CacheBackend):
+    """
+    Store build outputs as files in a directory, e.g. on a network file system mounted by all CI runners.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return (self.directory / f'{key}.tar.gz').read_bytes()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            raise SasstasticError(f'unable to read from {self.directory}: {e}')
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self.directory / f'{key}.tar.gz'
+        # unique temporary name since other machines may be writing the same key
+        tmp_path = self.directory / f'.{key}.{uuid.uuid4().hex}.tmp'
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            raise SasstasticError(f'unable to write to {self.directory}: {e}')
+
+
+class HttpBackend(CacheBackend):
+    """
+    Store build outputs on an HTTP server, outputs are fetched with GET "<url>/<key>.tar.gz" and
+    uploaded with PUT to the same URL, e.g. nginx with WebDAV or an S3 compatible server.
+    """
+
+    def __init__(self, url: str, headers: Optional[Dict[str, str]] = None, timeout: float = 30):
+        self.url = url.rstrip('/')
+        self._headers = headers or {}
+        self._timeout = timeout
+
+    def get(self, key: str) -> Optional[bytes]:
+        r = self._request('GET', key)
+        if r.status_code == 404:
+            return None
+        self._check_status(r)
+        return r.content
+
+    def put(self, key: str, data: bytes) -> None:
+        self._check_status(self._request('PUT', key, content=data))
+
+    def _request(self, method: str, key: str, **kwargs):
+        import httpx
+
+        url = f'{self.url}/{key}.tar.gz'
+        try:
+            return httpx.request(method, url, headers=self._headers, timeout=self._timeout, **kwargs)
+        except httpx.HTTPError as e:
+            raise SasstasticError(f'{method} {url} failed: {e!r}')
+
+    def _check_status(self, r) -> None:
+        if not r.is_success:
+            raise SasstasticError(f'{r.request.method} {r.url} failed, unexpected response {r.status_code}')
+
+
+def create_backend(config: ConfigModel) -> Optional[CacheBackend]:
+    if config.remote_cache is None:
+        return None
+    elif re.match('https?://', config.remote_cache):
+        headers = {k: os.path.expandvars(v) for k, v in config.remote_cache_headers.items()}
+        return HttpBackend(config.remote_cache, headers)
+    else:
+        directory = Path(os.path.expanduser(config.remote_cache))
+        if not directory.is_absolute():
+            directory = config.config_file.parent / directory
+        return DirectoryBackend(directory)
+
+
+class RemoteCache:
+    """
+    Share the output of full builds between machines so identical inputs are never compiled twice.
+
+    Outputs are stored as a tar file keyed by a hash of every file in the build and download directories plus
+    all settings which affect output. Errors reading or writing the cache are logged and the build continues.
+    """
+
+    def __init__(self, config: ConfigModel, dev_mode: bool, out_dir: Path, backend: CacheBackend):
+        self._config = config
+        self._dev_mode = dev_mode
+        # the output directory is skipped when hashing inputs in case it's inside the build directory
+        self._out_dir = out_dir.absolute()
+        self._backend = backend
+        # paths in the dependency index are stored relative to this directory so they're portable
+        self.root = config.config_file.parent.absolute()
+        self._key: Optional[str] = None
+
+    def pull(self, out_dir: Path) -> Optional[Dict[str, Any]]:
+        """
+        Extract cached output into out_dir, returns the dependency index data or None if the build isn't cached.
+        """
+        start = perf_counter()
+        try:
+            data = self._backend.get(self.key)
+        except SasstasticError as e:
+            logger.warning('unable to read from the remote cache: %s', e)
+            return None
+        if data is None:
+            logger.debug('remote cache: no output for %s', self.key)
+            return None
+
+        try:
+            with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+                index_data = json.load(tar.extractfile(INDEX_NAME))
+                members = [m for m in tar.getmembers() if m.isfile() and m.name.startswith(f'{OUTPUT_DIR}/')]
+                for m in members:
+                    path = out_dir / m.name[len(OUTPUT_DIR) + 1 :]
+                    if not is_within(path, out_dir):
+                        raise ValueError(f'invalid path "{m.name}"')
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    path.write_bytes(tar.extractfile(m).read())
+        except (tarfile.TarError, KeyError, ValueError, OSError) as e:
+            logger.warning('invalid output in the remote cache for %s: %s', self.key, e)
+            return None
+        time_taken = (perf_counter() - start) * 1000
+        logger.info('%d files (%s) from the remote cache in %0.0fms', len(members), fmt_size(len(data)), time_taken)
+        return index_data
+
+    def push(self, out_dir: Path, index_data: Dict[str, Any]) -> None:
+        """
+        Upload the output of a successful build along with its dependency index.
+        """
+        if not self._config.remote_cache_push:
+            return
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+            index_bytes = json.dumps(index_data).encode()
+            info = tarfile.TarInfo(INDEX_NAME)
+            info.size = len(index_bytes)
+            tar.addfile(info, io.BytesIO(index_bytes))
+            for root, _, file_names in os.walk(out_dir):
+                for name in sorted(file_names):
+                    path = Path(root) / name
+                    tar.add(path, f'{OUTPUT_DIR}/{path.relative_to(out_dir).as_posix()}')
+        data = buffer.getvalue()
+        try:
+            self._backend.put(self.key, data)
+        except SasstasticError as e:
+            logger.warning('unable to write to the remote cache: %s', e)
+        else:
+            logger.debug('remote cache: %s written for %s', fmt_size(len(data)), self.key)
+
+    @property
+    def key(self) -> str:
+        if self._key is None:
+            self._key = self._build_key()
+        return self._key
+
+    def _build_key(self) -> str:
+        config = self._config
+        build_dir = config.build_dir.absolute()
+        download_dir = config.download.dir.absolute()
+        settings = {
+            'versions': [VERSION, sass.__version__, brotli is not None],
+            'dev_mode': self._dev_mode,
+            'dirs': [os.path.relpath(d, self.root) for d in (build_dir, download_dir)],
+            # in dev mode source maps are relative to the output directory
+            'out_dir': os.path.relpath(self._out_dir, self.root) if self._dev_mode else None,
+            'include_files': config.include_files.pattern,
+            'exclude_files': config.exclude_files and config.exclude_files.pattern,
+            'exclude_dirs': config.exclude_dirs and config.exclude_dirs.pattern,
+            'replace': [[k.pattern, [[p.pattern, r] for p, r in v.items()]] for k, v in (config.replace or {}).items()],
+            'file_hashes': config.file_hashes,
+            'precompress': config.precompress,
+            'manifest': config.manifest and str(config.manifest),
+        }
+        h = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+        dirs = [build_dir] if is_within(download_dir, build_dir) else [build_dir, download_dir]
+        for d in dirs:
+            for path in sorted(walk_files(d, skip=self._out_dir)):
+                h.update(f'{os.path.relpath(path, self.root)}:{file_hash(Path(path))}\n'.encode())
+        return h.hexdigest()
+
+
+def walk_files(directory: Path, skip: Path):
+    """
+    Find all files in directory, except those in skip.
+    """
+    stack = [str(directory)]
+    skip_str = str(skip)
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path != skip_str:
+                    stack.append(entry.path)
+            elif entry.is_file():
+                yield entry.path
+
+
+def is_within(path: Path, directory: Path) -> bool:
+    path, directory = os.path.abspath(path), os.path.abspath(directory)
+    return path == directory or path.startswith(directory + os.sep)
@@ -0,0 +1,126 @@
+import logging
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Pattern, Tuple, Union
+
+__all__ = ('Replacer',)
+logger = logging.getLogger('sasstastic.replace')
+# a pattern which matches only itself, e.g. "foo\.bar" but not "foo.bar" or "\d"
+LITERAL_REGEX = re.compile(r'(?:[^.^$*+?{}\[\]|()\\]|\\[^A-Za-z0-9])*')
+Rule = Tuple[Pattern, str]
+
+
+class Replacer:
+    """
+    Apply the regex replacements from the "replace" config to compiled css.
+
+    Rules are selected by matching the file's path against the path regexes, the result is cached so the
+    selection happens once per path per build. Consecutive literal rules are combined into a single alternation
+    which is applied in one pass over the css provided the result is the same as applying them one by one.
+    """
+
+    def __init__(self, replace: Optional[Dict[Pattern, Dict[Pattern, str]]]):
+        self._replace = replace or {}
+        self._steps: Dict[str, List[Union[Rule, 'LiteralGroup']]] = {}
+
+    def __call__(self, rel_path, css: str) -> str:
+        rel_path = str(rel_path)
+        steps = self._steps.get(rel_path)
+        if steps is None:
+            steps = self._steps[rel_path] = self._build_steps(rel_path)
+
+        for step in steps:
+            if isinstance(step, LiteralGroup):
+                css = step.apply(css)
+            else:
+                pattern, repl = step
+                css, count = pattern.subn(repl, css)
+                logger.debug('  "%s" ➤ "%s" %d replacements', pattern.pattern, repl, count)
+        return css
+
+    def _build_steps(self, rel_path: str) -> List[Union[Rule, 'LiteralGroup']]:
+        steps = []
+        group = LiteralGroup()
+        for path_regex, regex_map in self._replace.items():
+            if not path_regex.search(rel_path):
+                continue
+            logger.debug('%s has regex replace matches for "%s"', rel_path, path_regex.pattern)
+            for pattern, repl in regex_map.items():
+                literal = as_literal(pattern, repl)
+                if literal is not None and group.add(pattern, literal, repl):
+                    continue
+                if group:
+                    steps.append(group.finish())
+                    group = LiteralGroup()
+                if literal is None or not group.add(pattern, literal, repl):
+                    steps.append((pattern, repl))
+        if group:
+            steps.append(group.finish())
+        return steps
+
+
+class LiteralGroup:
+    """
+    Literal replacements applied in a single pass.
+
+    A rule is only added if the result of the combined pass is guaranteed to match applying the rules in order:
+    no two literals can overlap and no later literal can match text inserted by an earlier replacement.
+    """
+
+    def __init__(self):
+        self._rules: List[Rule] = []
+        self._replacements: Dict[str, str] = {}
+        self._pattern: Optional[Pattern] = None
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    def add(self, pattern: Pattern, literal: str, repl: str) -> bool:
+        for other, other_repl in self._replacements.items():
+            # if other_repl is empty, removing text could join its neighbours into a match for literal
+            if not other_repl or overlaps(literal, other) or overlaps(literal, other_repl):
+                return False
+        self._rules.append((pattern, repl))
+        self._replacements[literal] = repl
+        return True
+
+    def finish(self) -> Union[Rule, 'LiteralGroup']:
+        if len(self._rules) == 1:
+            # a single rule is applied as normal
+            return self._rules[0]
+        self._pattern = re.compile('|'.join(re.escape(literal) for literal in self._replacements))
+        return self
+
+    def apply(self, css: str) -> str:
+        counts = Counter()
+
+        def repl(m):
+            s = m.group()
+            counts[s] += 1
+            return self._replacements[s]
+
+        css = self._pattern.sub(repl, css)
+        for literal, r in self._replacements.items():
+            logger.debug('  "%s" ➤ "%s" %d replacements', literal, r, counts[literal])
+        return css
+
+
+def as_literal(pattern: Pattern, repl: str) -> Optional[str]:
+    """
+    Return the string matched by pattern if it can only match that string and repl contains no group
+    references or escapes, otherwise None.
+    """
+    if pattern.flags & ~re.UNICODE or '\\' in repl or not pattern.pattern:
+        return None
+    if LITERAL_REGEX.fullmatch(pattern.pattern):
+        return re.sub(r'\\(.)', r'\1', pattern.pattern)
+    return None
+
+
+def overlaps(a: str, b: str) -> bool:
+    """
+    Whether a match for a and a match for b could share any characters.
+    """
+    if a in b or b in a:
+        return True
+    return any(a.endswith(b[:i]) or b.endswith(a[:i]) for i in range(1, min(len(a), len(b))))
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+from .common import SasstasticError
+from .compile import DependencyIndex, compile_changed, compile_sass
+from .config import ConfigModel, load_config
+from .download import Downloader
+
+__all__ = ('CompileServer',)
+logger = logging.getLogger('sasstastic.server')
+
+
+class CompileServer:
+    """
+    Long running process which compiles on request, requests are received over a unix socket.
+
+    Keeping the process running means config, the dependency index and caches of imported files stay in memory
+    so rebuilds are fast. Each request and response is a single line of JSON, see sasstastic.client.
+    """
+
+    def __init__(
+        self,
+        config_path: Path,
+        socket_path: Path,
+        alt_output_dir: Optional[Path] = None,
+        dev_mode: Optional[bool] = None,
+        *,
+        jobs: Optional[int] = None,
+        cache: bool = True,
+    ):
+        self._config_path = config_path
+        self._socket_path = socket_path
+        self._alt_output_dir = alt_output_dir
+        self._dev_mode = dev_mode
+        self._jobs = jobs
+        self._cache = cache
+        self._config: Optional[ConfigModel] = None
+        self._config_mtime: Optional[int] = None
+        self._index: Optional[DependencyIndex] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._stop: Optional[asyncio.Event] = None
+
+    async def run(self) -> None:
+        if not hasattr(socket, 'AF_UNIX'):
+            logger.error('the compile server requires unix sockets which are not available on this platform')
+            raise SasstasticError('unix sockets are not available')
+        self._lock = asyncio.Lock()
+        self._stop = asyncio.Event()
+        await self._load_config()
+        try:
+            # build once so caches are warm before the first request
+            await asyncio.get_running_loop().run_in_executor(None, self._compile, None)
+        except SasstasticError:
+            pass
+        if self._socket_path.exists():
+            self._socket_path.unlink()
+        server = await asyncio.start_unix_server(self._handle, path=str(self._socket_path))
+        logger.info('listening on %s', self._socket_path)
+        try:
+            await self._stop.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            if self._socket_path.exists():
+                self._socket_path.unlink()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            line = await reader.readline()
+            try:
+                request = json.loads(line)
+                command = request['command']
+            except (ValueError, KeyError, TypeError):
+                response = {'status': 'error', 'message': 'invalid request'}
+            else:
+                response = await self._dispatch(command, request)
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _dispatch(self, command: str, request: Dict[str, Any]) -> Dict[str, Any]:
+        if command == 'ping':
+            return {'status': 'ok'}
+        elif command == 'stop':
+            self._stop.set()
+            return {'status': 'ok'}
+        elif command == 'build':
+            async with self._lock:
+                return await self._build(request.get('paths'))
+        else:
+            return {'status': 'error', 'message': f'unknown command "{command}"'}
+
+    async def _build(self, paths: Optional[List[str]]) -> Dict[str, Any]:
+        start = perf_counter()
+        handler = CaptureHandler()
+        sasstastic_logger = logging.getLogger('sasstastic')
+        sasstastic_logger.addHandler(handler)
+        try:
+            if await self._load_config():
+                # config has changed, everything needs rebuilding
+                paths = None
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._compile, paths)
+        except SasstasticError as e:
+            status, message = 'error', str(e)
+        except Exception as e:
+            logger.exception('error building')
+            status, message = 'error', repr(e)
+        else:
+            status, message = 'ok', None
+        finally:
+            sasstastic_logger.removeHandler(handler)
+        time_ms = round((perf_counter() - start) * 1000, 1)
+        return {'status': status, 'message': message, 'time_ms': time_ms, 'output': '\n'.join(handler.lines)}
+
+    def _compile(self, paths: Optional[List[str]]) -> None:
+        kwargs = dict(jobs=self._jobs, cache=self._cache)
+        changed = {Path(p).absolute() for p in paths or ()}
+        if self._index is None or not changed or not all(p in self._index and p.is_file() for p in changed):
+            # no paths given, or files might have been added or deleted
+            self._index = None
+            self._index = compile_sass(self._config, self._alt_output_dir, self._dev_mode, **kwargs)
+        else:
+            compile_changed(self._config, changed, self._index, self._alt_output_dir, self._dev_mode, **kwargs)
+
+    async def _load_config(self) -> bool:
+        """
+        Load the config file if it's changed and download sources, returns True if the config was reloaded.
+        """
+        try:
+            mtime = os.stat(self._config_path).st_mtime_ns
+        except OSError:
+            raise SasstasticError(f'unable to read config file {self._config_path}')
+        if mtime == self._config_mtime:
+            return False
+        self._config = load_config(self._config_path)
+        self._config_mtime = mtime
+        self._index = None
+        await Downloader(self._config).download()
+        return True
+
+
+class CaptureHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines: List[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        msg = record.getMessage().strip('\n')
+        # ">>" is used by ClickHandler to highlight messages
+        self.lines.append(msg[2:] if msg.startswith('>>') else msg)
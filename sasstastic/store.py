@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import uuid
+from pathlib import Path
+from time import time
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+
+from .common import remove_file
+
+__all__ = 'DownloadStore', 'StoreEntry', 'default_store_dir'
+logger = logging.getLogger('sasstastic.store')
+# seconds after which files being added to the store are assumed to be complete or abandoned
+TMP_MAX_AGE = 3600
+
+
+def default_store_dir() -> Path:
+    cache_home = os.getenv('XDG_CACHE_HOME')
+    return (Path(cache_home) if cache_home else Path.home() / '.cache') / 'sasstastic'
+
+
+class StoreEntry(NamedTuple):
+    path: Path
+    hash: str
+    validators: Dict[str, str]
+
+
+class DownloadStore:
+    """
+    Content addressed store of downloaded files shared between projects.
+
+    File content is saved in "blobs/<md5 of content>", "urls/<md5 of url>.json" records which blob was downloaded
+    from a url along with the ETag and Last-Modified headers of the response. Blobs are read only since they
+    may be hardlinked into projects, unless read_only is False, e.g. for a temporary store used by one batch build.
+    """
+
+    def __init__(self, root: Path, read_only: bool = True):
+        self._blobs = root / 'blobs'
+        self._urls = root / 'urls'
+        self._read_only = read_only
+
+    def get(self, url: str) -> Optional[StoreEntry]:
+        url_path = self._url_path(url)
+        try:
+            data = json.loads(url_path.read_text())
+        except (OSError, ValueError):
+            return None
+        blob_path = self._blobs / data['hash']
+        if not blob_path.is_file():
+            return None
+        # the url file's mtime records when the entry was last used
+        try:
+            os.utime(url_path)
+        except OSError:
+            # e.g. a read only shared store, the entry can still be used
+            pass
+        return StoreEntry(blob_path, data['hash'], data['validators'])
+
+    def add(self, url: str, path: Path, content_hash: str, validators: Dict[str, str]) -> StoreEntry:
+        """
+        Move the file at path into the store, returns the new entry.
+        """
+        self._blobs.mkdir(parents=True, exist_ok=True)
+        self._urls.mkdir(parents=True, exist_ok=True)
+        blob_path = self._blobs / content_hash
+        if blob_path.exists():
+            path.unlink()
+        else:
+            # unique temporary name since other processes might be adding the same file
+            tmp_path = self._blobs / f'{content_hash}.{uuid.uuid4().hex}.tmp'
+            shutil.move(str(path), str(tmp_path))
+            if self._read_only:
+                tmp_path.chmod(stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_path, blob_path)
+
+        url_path = self._url_path(url)
+        tmp_path = url_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps({'url': url, 'hash': content_hash, 'validators': validators}))
+        os.replace(tmp_path, url_path)
+        return StoreEntry(blob_path, content_hash, validators)
+
+    @staticmethod
+    def materialise(entry: StoreEntry, dst: Path) -> None:
+        """
+        Create dst from a stored file, using a hardlink if possible otherwise a copy.
+        """
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dst = dst.with_name(f'.{dst.name}.tmp')
+        try:
+            os.link(entry.path, tmp_dst)
+        except OSError:
+            shutil.copyfile(str(entry.path), str(tmp_dst))
+        os.replace(tmp_dst, dst)
+
+    def prune(self, max_size: int) -> int:
+        """
+        Delete the least recently used entries until the total size of stored files is no more than max_size.
+
+        Returns the number of bytes deleted.
+        """
+        url_entries = []
+        for url_path in self._urls.glob('*.json'):
+            try:
+                url_entries.append((url_path.stat().st_mtime, url_path, json.loads(url_path.read_text())['hash']))
+            except (OSError, ValueError, KeyError):
+                remove_file(url_path)
+        url_entries.sort()
+
+        blob_refs: Dict[str, int] = {}
+        for *_, h in url_entries:
+            blob_refs[h] = blob_refs.get(h, 0) + 1
+        blob_sizes, recent_blobs = self._scan_blobs()
+        total = sum(blob_sizes.values())
+        deleted = 0
+
+        def delete_blob(h: str) -> None:
+            nonlocal total, deleted
+            size = blob_sizes.pop(h, 0)
+            total -= size
+            deleted += size
+            remove_file(self._blobs / h)
+
+        # blobs which no url refers to
+        for h in [h for h in blob_sizes if h not in blob_refs and h not in recent_blobs]:
+            delete_blob(h)
+
+        for _, url_path, h in url_entries:
+            if total <= max_size:
+                break
+            remove_file(url_path)
+            blob_refs[h] -= 1
+            if not blob_refs[h] and h in blob_sizes:
+                delete_blob(h)
+        return deleted
+
+    def _scan_blobs(self) -> Tuple[Dict[str, int], Set[str]]:
+        """
+        Find the size of each blob and which blobs have been added recently, another process might be adding them
+        so their url files may not have been written yet. Abandoned temporary files are deleted.
+        """
+        blob_sizes: Dict[str, int] = {}
+        recent_blobs: Set[str] = set()
+        now = time()
+        for p in self._blobs.glob('*'):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            if p.suffix == '.tmp':
+                # files still being added are left alone unless they've been abandoned
+                if now - st.st_mtime > TMP_MAX_AGE:
+                    remove_file(p)
+            elif stat.S_ISREG(st.st_mode):
+                blob_sizes[p.name] = st.st_size
+                if now - st.st_mtime <= TMP_MAX_AGE:
+                    recent_blobs.add(p.name)
+        return blob_sizes, recent_blobs
+
+    def _url_path(self, url: str) -> Path:
+        return self._urls / f'{hashlib.md5(url.encode()).hexdigest()}.json'
@@ -0,0 +1,354 @@
+import asyncio
+import ctypes
+import logging
+import os
+import re
+import struct
+import sys
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Pattern, Set, Tuple, Union
+
+from watchgod import Change
+from watchgod.watcher import DefaultDirWatcher, DefaultWatcher
+
+from .common import SasstasticError
+
+__all__ = 'Watcher', 'WatchFilter', 'InotifyWatcher', 'PollingWatcher', 'Change'
+logger = logging.getLogger('sasstastic.watch')
+FileChanges = Set[Tuple[Change, str]]
+# seconds between checks when polling for changes
+POLL_INTERVAL = 0.4
+# changes are released after this many seconds even if files keep changing
+MAX_DEBOUNCE = 2
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+EXISTS_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatchFilter:
+    """
+    Decide which files and directories are watched, the same files are ignored as by watchgod plus any
+    directories in ignore_dirs and paths matching the ignore regex.
+    """
+
+    ignored_dir_names = DefaultDirWatcher.ignored_dirs
+    ignored_file_regexes = tuple(re.compile(r) for r in DefaultWatcher.ignored_file_regexes)
+
+    def __init__(self, ignore_dirs: Iterable[Path] = (), ignore: Optional[Pattern] = None):
+        self._ignore_dirs = {os.path.abspath(d) for d in ignore_dirs}
+        self._ignore = ignore
+
+    def dir(self, path: str) -> bool:
+        if os.path.basename(path) in self.ignored_dir_names or os.path.abspath(path) in self._ignore_dirs:
+            return False
+        return not (self._ignore and self._ignore.search(path))
+
+    def file(self, path: str) -> bool:
+        name = os.path.basename(path)
+        if any(r.search(name) for r in self.ignored_file_regexes):
+            return False
+        return not (self._ignore and self._ignore.search(path))
+
+
+class Watcher:
+    """
+    Watch files and directories for changes, directories are watched recursively.
+
+    inotify is used on Linux, otherwise or if backend is "poll" the file system is polled for changes.
+    Changes are released once there have been no more changes for "debounce" seconds.
+    """
+
+    def __init__(
+        self,
+        paths: List[Union[Path, str]],
+        *,
+        ignore_dirs: Iterable[Path] = (),
+        ignore: Optional[Pattern] = None,
+        debounce: float = 0.1,
+        backend: str = 'auto',
+    ):
+        self._debounce = debounce
+        watch_filter = WatchFilter(ignore_dirs, ignore)
+        paths = [str(p) for p in paths]
+        self._inotify: Optional[InotifyWatcher] = None
+        self._polling: Optional[PollingWatcher] = None
+        if backend != 'poll':
+            try:
+                self._inotify = InotifyWatcher(paths, watch_filter)
+            except OSError as e:
+                if backend == 'inotify':
+                    raise SasstasticError(f'unable to watch files with inotify: {e}')
+                logger.debug('inotify not available, polling for changes: %s', e)
+        if self._inotify is None:
+            self._polling = PollingWatcher(paths, watch_filter)
+        self.backend = 'poll' if self._inotify is None else 'inotify'
+
+    def __aiter__(self) -> AsyncIterator[FileChanges]:
+        return self._watch_inotify() if self._inotify else self._watch_polling()
+
+    async def _watch_inotify(self) -> AsyncIterator[FileChanges]:
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        loop.add_reader(self._inotify.fileno(), ready.set)
+        try:
+            while True:
+                await ready.wait()
+                deadline = loop.time() + MAX_DEBOUNCE
+                while ready.is_set() and loop.time() < deadline:
+                    ready.clear()
+                    self._inotify.read()
+                    try:
+                        await asyncio.wait_for(ready.wait(), self._debounce)
+                    except asyncio.TimeoutError:
+                        pass
+                changes = self._inotify.pop_changes()
+                if changes:
+                    yield changes
+        finally:
+            loop.remove_reader(self._inotify.fileno())
+            self._inotify.close()
+
+    async def _watch_polling(self) -> AsyncIterator[FileChanges]:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            changes = await loop.run_in_executor(None, self._polling.check)
+            deadline = loop.time() + MAX_DEBOUNCE
+            while changes and loop.time() < deadline:
+                await asyncio.sleep(self._debounce)
+                new_changes = await loop.run_in_executor(None, self._polling.check)
+                if not new_changes:
+                    break
+                changes |= new_changes
+            if changes:
+                yield changes
+
+
+class PollingWatcher(DefaultWatcher):
+    """
+    watchgod's watcher extended to check multiple paths and use WatchFilter.
+    """
+
+    def __init__(self, paths: List[str], watch_filter: WatchFilter):
+        self._paths = paths
+        self._filter = watch_filter
+        super().__init__(paths[0])
+
+    def should_watch_dir(self, entry: os.DirEntry) -> bool:
+        return self._filter.dir(entry.path)
+
+    def should_watch_file(self, entry: os.DirEntry) -> bool:
+        return self._filter.file(entry.path)
+
+    def _walk(self, path: str, changes: FileChanges, new_files: Dict[str, float]) -> None:
+        for p in self._paths:
+            try:
+                super()._walk(p, changes, new_files)
+            except OSError:
+                # e.g. the config file is being replaced
+                pass
+
+
+class InotifyWatcher:
+    """
+    Watch for changes using inotify, every directory is watched so new, modified and deleted files are reported
+    without walking the file system. File paths are watched by watching their directory.
+
+    Changes are reported like watchgod: as the difference between the files before and after a batch of events,
+    e.g. a file which is deleted then written again, as some editors do when saving, is "modified".
+    """
+
+    def __init__(self, paths: List[str], watch_filter: WatchFilter):
+        self._libc = load_libc()
+        self._filter = watch_filter
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise errno_error('inotify_init1')
+        # watch descriptor ➤ directory path
+        self._dirs: Dict[int, str] = {}
+        # watch descriptors of directories watched recursively
+        self._trees: Set[int] = set()
+        # watch descriptor ➤ names of files watched directly ➤ their path
+        self._file_paths: Dict[int, Dict[str, str]] = {}
+        self.files: Set[str] = set()
+        # paths with events since changes were last popped ➤ whether the file existed before the events
+        self._touched: Dict[str, bool] = {}
+        try:
+            for path in paths:
+                if not os.path.isdir(path):
+                    wd = self._add_watch(os.path.dirname(path) or '.')
+                    self._file_paths.setdefault(wd, {})[os.path.basename(path)] = path
+                    if os.path.isfile(path):
+                        self.files.add(path)
+            for path in paths:
+                if os.path.isdir(path):
+                    self._add_tree(path)
+        except OSError:
+            self.close()
+            raise
+        # files found when adding watches already existed
+        self._touched = {}
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def read(self) -> None:
+        """
+        Read and process all available events.
+        """
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name_start = offset + EVENT_HEADER.size
+                name = os.fsdecode(data[name_start : name_start + length].rstrip(b'\0'))
+                offset = name_start + length
+                self._process_event(wd, mask, name)
+
+    def pop_changes(self) -> FileChanges:
+        changes = set()
+        for path, existed in self._touched.items():
+            exists = path in self.files
+            if existed and exists:
+                changes.add((Change.modified, path))
+            elif existed:
+                changes.add((Change.deleted, path))
+            elif exists:
+                changes.add((Change.added, path))
+        self._touched = {}
+        return changes
+
+    def _process_event(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            logger.debug('inotify event queue overflowed, checking all files')
+            self._rescan()
+            return
+        elif mask & IN_IGNORED:
+            # the directory has been deleted or moved
+            self._remove_wd(wd)
+            return
+
+        dir_path = self._dirs.get(wd)
+        if dir_path is None or not name:
+            return
+        file_paths = self._file_paths.get(wd)
+        if file_paths and name in file_paths:
+            self._file_event(file_paths[name], mask)
+        elif wd not in self._trees:
+            return
+        elif mask & IN_ISDIR:
+            path = os.path.join(dir_path, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if self._filter.dir(path):
+                    self._add_tree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._remove_tree(path)
+        else:
+            path = os.path.join(dir_path, name)
+            if self._filter.file(path):
+                self._file_event(path, mask)
+
+    def _file_event(self, path: str, mask: int) -> None:
+        self._touched.setdefault(path, path in self.files)
+        if mask & EXISTS_MASK:
+            self.files.add(path)
+        else:
+            self.files.discard(path)
+
+    def _add_tree(self, root: str) -> None:
+        """
+        Watch root and all directories inside it, files found are recorded as added if root is new.
+        """
+        stack = [root]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                wd = self._add_watch(dir_path)
+                entries = list(os.scandir(dir_path))
+            except (FileNotFoundError, NotADirectoryError):
+                # deleted since its parent was read
+                continue
+            self._trees.add(wd)
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if self._filter.dir(entry.path):
+                        stack.append(entry.path)
+                elif self._filter.file(entry.path):
+                    self._file_event(entry.path, IN_CREATE)
+
+    def _remove_tree(self, root: str) -> None:
+        prefix = root + os.sep
+        for path in [p for p in self.files if p.startswith(prefix)]:
+            self._file_event(path, IN_DELETE)
+        for wd, dir_path in list(self._dirs.items()):
+            if dir_path == root or dir_path.startswith(prefix):
+                # moved directories are still watched, deleted directories are already removed
+                self._libc.inotify_rm_watch(self._fd, wd)
+                self._remove_wd(wd)
+
+    def _remove_wd(self, wd: int) -> None:
+        self._dirs.pop(wd, None)
+        self._trees.discard(wd)
+        self._file_paths.pop(wd, None)
+
+    def _rescan(self) -> None:
+        """
+        Find files after events have been lost, every file is reported as changed.
+        """
+        for path in self.files:
+            self._touched.setdefault(path, True)
+        self.files = set()
+        for file_paths in self._file_paths.values():
+            self.files.update(p for p in file_paths.values() if os.path.isfile(p))
+        for wd in list(self._trees):
+            dir_path = self._dirs.get(wd)
+            if dir_path is not None:
+                self._add_tree(dir_path)
+
+    def _add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise errno_error(path)
+        self._dirs[wd] = path
+        return wd
+
+
+def load_libc() -> ctypes.CDLL:
+    if not sys.platform.startswith('linux'):
+        raise OSError('inotify is only available on Linux')
+    libc = ctypes.CDLL(None, use_errno=True)
+    try:
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except AttributeError:
+        raise OSError('inotify functions not found in libc')
+    return libc
+
+
+def errno_error(path: str) -> OSError:
+    errno = ctypes.get_errno()
+    return OSError(errno, os.strerror(errno), path)
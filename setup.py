@@ -43,16 +43,17 @@ setup(
     package_data={'sasstastic': ['py.typed']},
     entry_points="""
         [console_scripts]
-        sasstastic=sasstastic.__main__:cli
+        sasstastic=sasstastic.__main__:main
     """,
     python_requires='>=3.7',
     zip_safe=True,
     install_requires=[
         'libsass>=0.20.0',
-        'httpx>=0.12.1',
+        'httpx>=0.18.0',
         'pydantic>=1.5',
         'PyYAML>=5.3.1',
         'typer>=0.1.0',
         'watchgod>=0.6',
     ],
+    extras_require={'brotli': ['brotli>=1.0.7']},
 )
@@ -0,0 +1,108 @@
+import hashlib
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import pytest
+
+
+class FileServer:
+    """
+    Minimal HTTP server serving files from memory, supports ETags, range requests and uploading files with PUT.
+    """
+
+    def __init__(self):
+        self.files: Dict[str, bytes] = {}
+        self.requests: List[Dict[str, str]] = []
+        # status codes to respond with before serving files normally
+        self.errors: List[int] = []
+        # extra headers to send with files, e.g. {'/foo.css': {'Content-Encoding': 'gzip'}}
+        self.headers: Dict[str, Dict[str, str]] = {}
+        # numbers of bytes to send before closing the connection, to simulate failing downloads
+        self.truncate: List[int] = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def record(self, method: str):
+                headers = {k.lower(): v for k, v in self.headers.items()}
+                server.requests.append({'method': method, 'path': self.path, **headers})
+
+            def do_GET(self):
+                self.record('GET')
+                if server.errors:
+                    self.send_response(server.errors.pop(0))
+                    self.end_headers()
+                    return
+                content = server.files.get(self.path)
+                if content is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+                if self.headers.get('if-none-match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                extra_headers = server.headers.get(self.path, {})
+                m = re.match(r'bytes=(\d+)-$', self.headers.get('range', ''))
+                start = 0
+                if m and self.headers.get('if-range') in (None, etag, extra_headers.get('Last-Modified')):
+                    start = int(m.group(1))
+                    if start >= len(content):
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{len(content)}')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+                else:
+                    self.send_response(200)
+                self.send_header('ETag', etag)
+                for k, v in extra_headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(content) - start))
+                self.end_headers()
+                if server.truncate:
+                    self.wfile.write(content[start : start + server.truncate.pop(0)])
+                    self.close_connection = True
+                else:
+                    self.wfile.write(content[start:])
+
+            def do_PUT(self):
+                self.record('PUT')
+                content = self.rfile.read(int(self.headers['content-length']))
+                if server.errors:
+                    self.send_response(server.errors.pop(0))
+                else:
+                    server.files[self.path] = content
+                    self.send_response(201)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.01,), daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture(name='server')
+def _fix_server():
+    with FileServer() as server:
+        yield server
+
+
+@pytest.fixture(autouse=True)
+def _fix_partial_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr('sasstastic.download.PARTIAL_DIR', tmp_path / 'partial')
@@ -1,6 +1,8 @@
+import pytest
 from typer.testing import CliRunner
 
-from sasstastic.cli import cli
+from sasstastic.cli import cli, main
+from sasstastic.store import DownloadStore
 
 runner = CliRunner()
 
@@ -9,3 +11,61 @@ def test_print_commands():
     result = runner.invoke(cli, ['--help'])
     assert result.exit_code == 0
     assert 'Fantastic SASS and SCSS compilation' in result.output
+
+
+def test_build_default_command(tmp_path, mocker):
+    download_and_compile = mocker.patch('sasstastic.main.download_and_compile')
+    config = 'download:\n  dir: libs\n  sources: []\nbuild_dir: styles\noutput_dir: css\n'
+    (tmp_path / 'sasstastic.yml').write_text(config)
+    with pytest.raises(SystemExit) as exc_info:
+        main([str(tmp_path), '--prod'])
+    assert exc_info.value.code == 0
+    assert download_and_compile.call_count == 1
+    assert download_and_compile.call_args[0][2] is False
+
+
+def test_cache_prune(tmp_path):
+    store = DownloadStore(tmp_path)
+    src = tmp_path / 'foo.css'
+    src.write_bytes(b'x' * 2 * 1024 ** 2)
+    store.add('https://example.com/foo.css', src, 'abc', {})
+    result = runner.invoke(cli, ['cache', 'prune', '--dir', str(tmp_path), '--max-size', '1'])
+    assert result.exit_code == 0, result.output
+    assert store.get('https://example.com/foo.css') is None
+
+
+def make_project(path, url, scss):
+    path.mkdir()
+    config = (
+        f'download:\n  dir: libs\n  sources:\n  - url: {url}\n'
+        f'build_dir: styles\noutput_dir: css\ncompile_cache_dir: {path / "cache"}\n'
+    )
+    (path / 'sasstastic.yml').write_text(config)
+    (path / 'styles').mkdir()
+    (path / 'styles' / 'main.scss').write_text(scss)
+
+
+def test_build_multiple(tmp_path, server):
+    server.files['/vars.scss'] = b'$colour: red;'
+    make_project(tmp_path / 'a', f'{server.url}/vars.scss', '@import "DL/vars";\n.a { color: $colour; }')
+    make_project(tmp_path / 'b', f'{server.url}/vars.scss', '@import "DL/vars";\n.b { color: $colour; }')
+    with pytest.raises(SystemExit) as exc_info:
+        main([str(tmp_path / '*'), '--prod', '-j', '2'])
+    assert exc_info.value.code == 0
+    # the source is shared by both configs so it's only downloaded once
+    assert len(server.requests) == 1
+    assert (tmp_path / 'a' / 'css' / 'main.css').read_text() == '.a{color:red}\n'
+    assert (tmp_path / 'b' / 'css' / 'main.css').read_text() == '.b{color:red}\n'
+
+
+def test_build_multiple_error(tmp_path, server):
+    server.files['/vars.scss'] = b'$colour: red;'
+    make_project(tmp_path / 'a', f'{server.url}/vars.scss', '@import "DL/vars";\n.a { color: $colour; }')
+    make_project(tmp_path / 'b', f'{server.url}/vars.scss', '.b { color: $missing; }')
+    result = runner.invoke(cli, ['build', str(tmp_path / 'a'), str(tmp_path / 'b'), '--prod'])
+    assert result.exit_code == 1
+    assert (tmp_path / 'a' / 'css' / 'main.css').read_text() == '.a{color:red}\n'
+
+    result = runner.invoke(cli, ['build', str(tmp_path / 'a'), str(tmp_path / 'b'), '--watch'])
+    assert result.exit_code == 2
+    assert '"--watch" can only be used with a single config file' in result.output
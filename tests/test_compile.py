@@ -0,0 +1,406 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import pytest
+import sass
+
+import sasstastic.compile
+import sasstastic.compress
+from sasstastic import ConfigModel, SasstasticError, compile_sass, load_manifest
+from sasstastic.compile import (
+    BuildCancelled,
+    EntryPointFinder,
+    SassCompiler,
+    compile_changed,
+    compile_sass_async,
+    publish,
+    sync_dir,
+)
+from sasstastic.profiling import BuildProfile
+
+
+def build_project(root: Path, **config) -> ConfigModel:
+    styles = root / 'styles'
+    (styles / 'sub').mkdir(parents=True)
+    (styles / '.libs').mkdir()
+    (styles / 'main.scss').write_text('@import "sub/a";\n@import "DL/lib";\n.x {color: red}\n')
+    (styles / 'other.scss').write_text('@import "sub/a";\n.y {color: red}\n')
+    (styles / 'sub' / '_a.scss').write_text('.a {color: blue}\n')
+    (styles / '.libs' / '_lib.scss').write_text('.lib {color: green}\n')
+    data = dict(
+        download={'dir': 'styles/.libs', 'sources': []},
+        build_dir='styles',
+        output_dir='css',
+        compile_cache_dir='.cache',
+        **config,
+    )
+    return ConfigModel.parse_obj(root / 'sasstastic.yml', data)
+
+
+def output_files(d: Path):
+    return {str(p.relative_to(d)): p.read_text() for p in sorted(d.glob('**/*')) if p.is_file()}
+
+
+@pytest.mark.parametrize('dev_mode', [True, False])
+def test_parallel_matches_serial(tmp_path, mocker, dev_mode):
+    config = build_project(tmp_path)
+    compile_sass(config, tmp_path / 'serial', dev_mode, cache=False)
+    pool = mocker.spy(sasstastic.compile, 'ProcessPoolExecutor')
+    compile_sass(config, tmp_path / 'parallel', dev_mode, jobs=2, cache=False)
+    assert pool.call_count == 1
+    serial = output_files(tmp_path / 'serial')
+    assert 'main.css' in serial
+    assert '.lib' in serial['main.css']
+    assert output_files(tmp_path / 'parallel') == serial
+
+
+def test_parallel_errors(tmp_path, caplog):
+    config = build_project(tmp_path, jobs=2)
+    (tmp_path / 'styles' / 'broken.scss').write_text('.x {')
+    with pytest.raises(SasstasticError):
+        compile_sass(config)
+    assert 'broken.scss compile error' in caplog.text
+    assert '2 css files generated' in caplog.text
+
+
+@pytest.mark.parametrize('dev_mode', [True, False])
+def test_compile_cache(tmp_path, mocker, dev_mode):
+    config = build_project(tmp_path)
+    compile_sass(config, dev_mode=dev_mode)
+    first = output_files(tmp_path / 'css')
+
+    spy = mocker.spy(sass, 'compile')
+    compile_sass(config, dev_mode=dev_mode)
+    assert spy.call_count == 0
+    assert output_files(tmp_path / 'css') == first
+
+    (tmp_path / 'styles' / '.libs' / '_lib.scss').write_text('.lib {color: purple}\n')
+    compile_sass(config, dev_mode=dev_mode)
+    # only main.scss imports _lib.scss
+    assert [Path(c.kwargs['filename']).name for c in spy.call_args_list] == ['main.scss']
+    assert 'purple' in (tmp_path / 'css' / 'main.css').read_text()
+
+    compile_sass(config, dev_mode=dev_mode, cache=False)
+    assert spy.call_count == 3
+
+    # in dev mode cached source maps are only used for the same output directory
+    compile_sass(config, tmp_path / 'other', dev_mode)
+    assert spy.call_count == (5 if dev_mode else 3)
+
+
+def test_compile_cache_unusable(tmp_path, caplog):
+    caplog.set_level(logging.WARNING)
+    (tmp_path / 'notadir').write_text('x')
+    config = build_project(tmp_path)
+    config.compile_cache_dir = tmp_path / 'notadir'
+    compile_sass(config, dev_mode=False)
+    compile_sass(config, dev_mode=False)
+    assert 'main.css' in output_files(tmp_path / 'css')
+    # the cache is skipped, a warning is logged once per build
+    messages = [r.getMessage() for r in caplog.records]
+    assert len(messages) == 2
+    assert messages[0].startswith(f'compile cache: unable to write to {tmp_path / "notadir"}: ')
+
+
+@pytest.mark.parametrize('dev_mode', [True, False])
+def test_compile_changed(tmp_path, mocker, dev_mode):
+    config = build_project(tmp_path, file_hashes=True)
+    index = compile_sass(config, dev_mode=dev_mode, cache=False)
+    assert len(index) == 2
+    before = output_files(tmp_path / 'css')
+
+    spy = mocker.spy(sass, 'compile')
+    lib = (tmp_path / 'styles' / '.libs' / '_lib.scss').absolute()
+    lib.write_text('.lib {color: purple}\n')
+    compile_changed(config, {lib}, index, dev_mode=dev_mode, cache=False)
+    assert [Path(c.kwargs['filename']).name for c in spy.call_args_list] == ['main.scss']
+
+    after = output_files(tmp_path / 'css')
+    changed = {k for k in after.keys() ^ before.keys() if not k.startswith('.src/')}
+    # old hashed main.css was deleted, new one was created, other.css wasn't touched
+    assert len(changed) == (4 if dev_mode else 2)
+    assert all(k.startswith('main.') for k in changed)
+    if dev_mode:
+        assert 'purple' in after['.src/.libs/_lib.scss']
+
+    # changes to unrelated files don't cause rebuilds
+    compile_changed(config, {tmp_path / 'styles' / 'foobar.txt'}, index, dev_mode=dev_mode, cache=False)
+    assert spy.call_count == 1
+
+    # stale outputs which have already been deleted are ignored
+    for p in (tmp_path / 'css').glob('main.*'):
+        p.unlink()
+    lib.write_text('.lib {color: orange}\n')
+    compile_changed(config, {lib}, index, dev_mode=dev_mode, cache=False)
+    main_css = [v for k, v in output_files(tmp_path / 'css').items() if re.fullmatch(r'main\.\w+\.css', k)]
+    assert len(main_css) == 1 and 'orange' in main_css[0]
+
+
+def test_sync_dir(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    (src / 'a').mkdir(parents=True)
+    (src / 'x.scss').write_text('x')
+    (src / 'a' / 'y.scss').write_text('y')
+    assert sync_dir(src, dst) == (2, 2)
+    assert (dst / 'a' / 'y.scss').read_text() == 'y'
+
+    (dst / 'stale.scss').write_text('stale')
+    assert sync_dir(src, dst) == (2, 0)
+    assert not (dst / 'stale.scss').exists()
+
+    (src / 'x.scss').unlink()
+    (src / 'x.scss').write_text('changed')
+    assert sync_dir(src, dst) == (2, 1)
+    assert (dst / 'x.scss').read_text() == 'changed'
+
+
+def test_output_dir_in_build_dir(tmp_path):
+    config = build_project(tmp_path)
+    config.output_dir = out_dir = tmp_path / 'styles' / 'css'
+    compile_sass(config, dev_mode=True, cache=False)
+    compile_sass(config, dev_mode=True, cache=False)
+    # the output directory isn't copied into itself
+    assert sorted(output_files(out_dir / '.src')) == ['.libs/_lib.scss', 'main.scss', 'other.scss', 'sub/_a.scss']
+    assert '.lib' in (out_dir / 'main.css').read_text()
+    assert not (out_dir / 'css').exists()
+
+
+def test_publish(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'a.css').write_text('a')
+    (src / 'sub' / 'b.css').write_text('b')
+    (dst / 'sub').mkdir(parents=True)
+    (dst / 'a.css').write_text('a')
+    (dst / 'sub' / 'b.css').write_text('old')
+    (dst / 'sub' / 'stale.css').write_text('stale')
+    (dst / 'other.txt').write_text('other')
+    inode = (dst / 'a.css').stat().st_ino
+
+    assert publish(src, dst) == (1, 1, 1)
+    assert output_files(dst) == {'a.css': 'a', 'sub/b.css': 'b', 'other.txt': 'other'}
+    assert (dst / 'a.css').stat().st_ino == inode
+
+
+def test_import_cache(tmp_path, caplog):
+    caplog.set_level('DEBUG', 'sasstastic')
+    config = build_project(tmp_path)
+    (tmp_path / 'styles' / 'old.sass').write_text('@import "sub/a"\n.z\n  color: red\n')
+    compile_sass(config, dev_mode=False, cache=False)
+    # sub/_a.scss is imported by three files but only read once
+    assert 'import cache: 2 hits, 2 misses' in caplog.text
+    assert '.a{color:blue}' in (tmp_path / 'css' / 'old.css').read_text()
+
+    (tmp_path / 'styles' / 'sub' / '_a.scss').write_text('.a {color: orange}\n')
+    compile_sass(config, dev_mode=False, cache=False)
+    assert '.a{color:orange}' in (tmp_path / 'css' / 'old.css').read_text()
+    assert '.a{color:orange}' in (tmp_path / 'css' / 'main.css').read_text()
+
+
+def test_profile(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    config = build_project(tmp_path)
+    profile = BuildProfile(top=1, json_path=tmp_path / 'profile.json')
+    compile_sass(config, dev_mode=True, profile=profile)
+    assert 'profile: slowest 1 of 2 files' in caplog.text
+    report = json.loads((tmp_path / 'profile.json').read_text())
+    assert set(report['files']) == {'main.scss', 'other.scss'}
+    main = report['files']['main.scss']
+    assert main['imports'] == 2
+    assert main['cached'] is False
+    assert main['compile_ms'] > 0
+    styles = tmp_path / 'styles'
+    inputs = styles / 'main.scss', styles / 'sub' / '_a.scss', styles / '.libs' / '_lib.scss'
+    assert main['input_bytes'] == sum(p.stat().st_size for p in inputs)
+    outputs = tmp_path / 'css' / 'main.css', tmp_path / 'css' / 'main.css.map'
+    assert main['output_bytes'] == sum(p.stat().st_size for p in outputs)
+
+    compile_sass(config, dev_mode=True, profile=profile)
+    report = json.loads((tmp_path / 'profile.json').read_text())
+    assert report['files']['main.scss']['cached'] is True
+
+
+@pytest.mark.parametrize('dev_mode', [True, False])
+def test_precompress(tmp_path, mocker, dev_mode):
+    config = build_project(tmp_path, precompress=True)
+    index = compile_sass(config, dev_mode=dev_mode)
+    css_dir = tmp_path / 'css'
+    main_css = (css_dir / 'main.css').read_bytes()
+    assert gzip.decompress((css_dir / 'main.css.gz').read_bytes()) == main_css
+    assert (css_dir / 'other.css.gz').exists()
+    assert not (css_dir / 'main.css.map.gz').exists()
+    gz_inode = (css_dir / 'main.css.gz').stat().st_ino
+
+    # unchanged output isn't compressed again
+    spy = mocker.spy(gzip, 'GzipFile')
+    compile_sass(config, dev_mode=dev_mode)
+    assert spy.call_count == 0
+    assert (css_dir / 'main.css.gz').stat().st_ino == gz_inode
+
+    lib = (tmp_path / 'styles' / '.libs' / '_lib.scss').absolute()
+    lib.write_text('.lib {color: purple}\n')
+    compile_changed(config, {lib}, index, dev_mode=dev_mode)
+    assert spy.call_count == 1
+    assert b'purple' in gzip.decompress((css_dir / 'main.css.gz').read_bytes())
+
+
+def test_precompress_cancelled(tmp_path, mocker):
+    config = build_project(tmp_path, precompress=True)
+    cancel = threading.Event()
+    writing = []
+
+    def slow_write(path, compress, content):
+        writing.append(path)
+        time.sleep(0.1)
+        writing.remove(path)
+
+    mocker.patch('sasstastic.compress.write_compressed', side_effect=slow_write)
+    submit = sasstastic.compress.Compressor.submit
+
+    def submit_then_cancel(*args):
+        cancel.set()
+        return submit(*args)
+
+    mocker.patch.object(sasstastic.compress.Compressor, 'submit', submit_then_cancel)
+    with pytest.raises(BuildCancelled):
+        compile_sass(config, cancel=cancel)
+    # compression has stopped before the temporary directory was deleted
+    assert writing == []
+
+
+def test_manifest(tmp_path):
+    config = build_project(tmp_path, file_hashes=True, manifest='assets/manifest.json')
+    index = compile_sass(config, dev_mode=False)
+    manifest_path = tmp_path / 'css' / 'assets' / 'manifest.json'
+    manifest = load_manifest(manifest_path)
+    assert set(manifest) == {'main.css', 'other.css'}
+    main = manifest['main.css']
+    assert re.fullmatch(r'main\.[a-f0-9]+\.css', manifest.path('main.css'))
+    content = (tmp_path / 'css' / main.path).read_bytes()
+    assert main.size == len(content)
+    assert main.integrity == 'sha384-' + base64.b64encode(hashlib.sha384(content).digest()).decode()
+    # the manifest is cached
+    assert load_manifest(manifest_path) is manifest
+
+    lib = (tmp_path / 'styles' / '.libs' / '_lib.scss').absolute()
+    lib.write_text('.lib {color: purple}\n')
+    compile_changed(config, {lib}, index, dev_mode=False)
+    load_manifest.cache_clear()
+    new_manifest = load_manifest(manifest_path)
+    assert new_manifest.path('main.css') != main.path
+    assert (tmp_path / 'css' / new_manifest.path('main.css')).is_file()
+    assert new_manifest['other.css'] == manifest['other.css']
+
+
+def test_compile_sass_async(tmp_path):
+    config = build_project(tmp_path)
+    index = asyncio.run(compile_sass_async(config, tmp_path / 'async'))
+    assert len(index) == 2
+    compile_sass(config, tmp_path / 'sync')
+    assert output_files(tmp_path / 'async') == output_files(tmp_path / 'sync')
+
+
+def test_cancel(tmp_path):
+    config = build_project(tmp_path)
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(BuildCancelled):
+        compile_sass(config, cancel=cancel)
+    assert list((tmp_path / 'css').glob('**/*.css')) == []
+
+
+def test_compile_sass_async_cancel(tmp_path, mocker):
+    config = build_project(tmp_path)
+    started = threading.Event()
+
+    def slow_compile(**kwargs):
+        started.set()
+        time.sleep(0.1)
+        return sass_compile(**kwargs)
+
+    sass_compile = sass.compile
+    mock_compile = mocker.patch('sasstastic.compile.sass.compile', side_effect=slow_compile)
+
+    async def run():
+        task = asyncio.ensure_future(compile_sass_async(config))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    # the build stops after the file being compiled when the task was cancelled, no css is written
+    assert mock_compile.call_count == 1
+    assert list((tmp_path / 'css').glob('**/*.css')) == []
+
+
+def test_find_entry_points(tmp_path, mocker):
+    config = build_project(tmp_path, exclude_dirs='^vendor($|/)', exclude_files='skip')
+    styles = (tmp_path / 'styles').absolute()
+    paths = 'vendor/lib.scss', 'sub/vendor/lib.scss', 'sub/deep/deep.sass', 'skip.scss', 'noext', '.hidden/hidden.css'
+    for path in paths:
+        (styles / path).parent.mkdir(parents=True, exist_ok=True)
+        (styles / path).write_text('.x {color: red}\n')
+    (styles / '.libs' / 'lib.scss').write_text('.x {color: red}\n')
+
+    scandir = mocker.spy(os, 'scandir')
+    finder = EntryPointFinder(config, styles, styles / '.libs')
+    found = finder.find()
+    assert [str(p.relative_to(styles)) for p in found] == [
+        '.hidden/hidden.css',
+        'main.scss',
+        'other.scss',
+        'sub/deep/deep.sass',
+        'sub/vendor/lib.scss',
+    ]
+    scanned = {Path(c[0][0]).relative_to(styles) for c in scandir.call_args_list}
+    # excluded directories are never read
+    assert scanned == {Path('.'), Path('sub'), Path('sub/deep'), Path('sub/vendor'), Path('.hidden')}
+
+    all_files = [p for p in styles.glob('**/*') if p.is_file()]
+    assert sorted(p for p in all_files if finder.match(p)) == found
+
+
+def test_compile_entry_points(tmp_path):
+    config = build_project(tmp_path)
+    styles = tmp_path / 'styles'
+    entry_points = [styles / 'main.scss', styles / 'missing.scss', styles / 'sub' / '_a.scss']
+    for dev_mode in (False, True):
+        index = compile_sass(config, dev_mode=dev_mode, entry_points=entry_points)
+        assert index.entry_points == [(styles / 'main.scss').absolute()]
+        assert [p.name for p in (tmp_path / 'css').glob('*.css')] == ['main.css']
+
+
+@pytest.mark.parametrize('dev_mode,file_hashes,max_copies', [(False, True, 1.3), (True, False, 1.3), (True, True, 2.3)])
+def test_process_file_memory(tmp_path, dev_mode, file_hashes, max_copies):
+    config = build_project(tmp_path, file_hashes=file_hashes, manifest='manifest.json')
+    compiler = SassCompiler(config, tmp_path / 'out', dev_mode=dev_mode)
+    css = ''.join(f'.rule-{i}{{color:red}}' for i in range(200_000))
+    css_map = '{"version": 3, "mappings": "' + 'AAAA;' * 200_000 + '"}'
+    if dev_mode:
+        css += '\n/*# sourceMappingURL=main.css.map */'
+        result = (css, css_map), None, []
+    else:
+        result = css, None, []
+    path = (tmp_path / 'styles' / 'main.scss').absolute()
+
+    tracemalloc.start()
+    try:
+        compiler.process_file(path, result)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # css is encoded once and the source map is written in chunks, the css is only copied before encoding
+    # if the source map link needs changing for a hashed file name
+    assert peak < len(css) * max_copies
+    assert len(list((tmp_path / 'out').glob('main*.css'))) == 1
@@ -0,0 +1,343 @@
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import zipfile
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from sasstastic import ConfigModel, SasstasticError, download_sass
+from sasstastic.download import Downloader, DownloadLimits, ExtractMatcher, LockCheck, create_client, partial_path
+from sasstastic.store import DownloadStore
+
+
+def make_zip(files: Dict[str, str]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for name, content in files.items():
+            zipf.writestr(name, content)
+    return buffer.getvalue()
+
+
+def downloaded_files(d: Path):
+    return {str(p.relative_to(d)): p.read_text() for p in sorted(d.glob('**/*')) if p.is_file()}
+
+
+def make_config(root: Path, sources, **download) -> ConfigModel:
+    data = dict(download={'dir': 'libs', 'sources': sources, **download}, build_dir='styles', output_dir='css')
+    return ConfigModel.parse_obj(root / 'sasstastic.yml', data)
+
+
+def test_download_and_extract(tmp_path, server):
+    server.files['/styles/foo.css'] = b'.foo {color: red}'
+    server.files['/lib.zip'] = make_zip({'lib-1.0/scss/_a.scss': '.a {}', 'lib-1.0/scss/b/_c.scss': '.c {}'})
+    sources = [
+        {'url': f'{server.url}/styles/foo.css'},
+        {'url': f'{server.url}/lib.zip', 'extract': {'lib-1.0/scss/(.+)$': 'lib/'}},
+    ]
+    config = make_config(tmp_path, sources)
+    download_sass(config)
+    assert downloaded_files(tmp_path / 'libs') == {
+        'foo.css': '.foo {color: red}',
+        'lib/_a.scss': '.a {}',
+        'lib/b/_c.scss': '.c {}',
+    }
+    assert config.lock_file.is_file()
+    assert not list((tmp_path / 'partial').iterdir())
+
+    # everything is up to date, no requests are made
+    server.requests.clear()
+    download_sass(config)
+    assert server.requests == []
+
+
+def test_resume_download(tmp_path, server):
+    content = b'.foo {color: red}' * 1000
+    server.files['/foo.css'] = content
+    config = make_config(tmp_path, [{'url': f'{server.url}/foo.css'}])
+
+    # simulate an interrupted download
+    part_path = partial_path(config.download.dir, config.download.sources[0])
+    part_path.parent.mkdir()
+    part_path.write_bytes(content[:5000])
+    part_path.with_suffix('.json').write_text(json.dumps('"{}"'.format(hashlib.md5(content).hexdigest())))
+
+    download_sass(config)
+    assert server.requests[0]['range'] == 'bytes=5000-'
+    assert (tmp_path / 'libs' / 'foo.css').read_bytes() == content
+    assert not part_path.exists()
+
+    # content has changed since the partial download, the whole file is downloaded
+    (tmp_path / 'libs' / 'foo.css').unlink()
+    part_path.write_bytes(b'different')
+    part_path.with_suffix('.json').write_text(json.dumps('"old-etag"'))
+    download_sass(config)
+    assert (tmp_path / 'libs' / 'foo.css').read_bytes() == content
+
+
+def test_resume_complete(tmp_path, server):
+    content = b'.foo {color: red}' * 1000
+    server.files['/foo.css'] = content
+    config = make_config(tmp_path, [{'url': f'{server.url}/foo.css'}], retries=0)
+
+    # the download finished but the partial file wasn't removed
+    part_path = partial_path(config.download.dir, config.download.sources[0])
+    part_path.parent.mkdir()
+    part_path.write_bytes(content)
+    part_path.with_suffix('.json').write_text(json.dumps('"{}"'.format(hashlib.md5(content).hexdigest())))
+
+    download_sass(config)
+    assert [r.get('range') for r in server.requests] == [f'bytes={len(content)}-', None]
+    assert (tmp_path / 'libs' / 'foo.css').read_bytes() == content
+    assert list(part_path.parent.iterdir()) == []
+
+
+def test_no_resume_encoded(tmp_path, server):
+    content = b''.join(hashlib.sha256(str(i).encode()).hexdigest().encode() for i in range(2000))
+    server.files['/foo.css'] = gzip.compress(content)
+    server.headers['/foo.css'] = {'Content-Encoding': 'gzip', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    server.truncate = [20000]
+    config = make_config(tmp_path, [{'url': f'{server.url}/foo.css'}], retry_delay=0.01)
+    download_sass(config)
+    # the partial file contains decoded content so its size can't be used as an offset in the encoded content
+    assert len(server.requests) == 2
+    assert 'range' not in server.requests[1]
+    assert (tmp_path / 'libs' / 'foo.css').read_bytes() == content
+    assert hashlib.md5(content).hexdigest() in config.lock_file.read_text()
+
+
+def test_concurrent_projects(tmp_path, server):
+    content = b'.foo {color: red}' * 10000
+    server.files['/foo.css'] = content
+    configs = [make_config(tmp_path / name, [{'url': f'{server.url}/foo.css'}]) for name in ('a', 'b')]
+    source = configs[0].download.sources[0]
+    assert partial_path(configs[0].download.dir, source) != partial_path(configs[1].download.dir, source)
+
+    threads = [threading.Thread(target=download_sass, args=(config,)) for config in configs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    for config in configs:
+        assert (config.download.dir / 'foo.css').read_bytes() == content
+    assert list((tmp_path / 'partial').iterdir()) == []
+
+
+def test_shared_limits(tmp_path, server, mocker):
+    sources = []
+    for i in range(4):
+        server.files[f'/{i}.css'] = b'.foo {color: red}'
+        sources.append({'url': f'{server.url}/{i}.css'})
+    configs = [make_config(tmp_path / name, sources) for name in ('a', 'b')]
+
+    active = max_active = 0
+    stream_to_file = Downloader._stream_to_file
+
+    async def count_active(self, *args):
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        try:
+            await asyncio.sleep(0.02)
+            return await stream_to_file(self, *args)
+        finally:
+            active -= 1
+
+    mocker.patch.object(Downloader, '_stream_to_file', count_active)
+
+    async def run():
+        limits = DownloadLimits(max_concurrency=2, max_per_host=4)
+        async with create_client(configs[0].download) as client:
+            await asyncio.gather(*[Downloader(c, client, limits=limits).download() for c in configs])
+
+    asyncio.run(run())
+    # the limit applies to both downloaders together
+    assert max_active == 2
+    assert len(server.requests) == 8
+
+
+def test_retry(tmp_path, server):
+    server.files['/foo.css'] = b'.foo {color: red}'
+    server.errors = [503, 502]
+    config = make_config(tmp_path, [{'url': f'{server.url}/foo.css'}], retry_delay=0.01)
+    download_sass(config)
+    assert len(server.requests) == 3
+    assert (tmp_path / 'libs' / 'foo.css').read_bytes() == b'.foo {color: red}'
+
+
+def test_retries_exhausted(tmp_path, server):
+    server.files['/foo.css'] = b'.foo {color: red}'
+    server.errors = [503, 503, 503]
+    config = make_config(tmp_path, [{'url': f'{server.url}/foo.css'}], retries=2, retry_delay=0.01)
+    with pytest.raises(SasstasticError):
+        download_sass(config)
+    assert len(server.requests) == 3
+
+
+def test_no_retry_not_found(tmp_path, server):
+    config = make_config(tmp_path, [{'url': f'{server.url}/foo.css'}], retry_delay=0.01)
+    with pytest.raises(SasstasticError):
+        download_sass(config)
+    assert len(server.requests) == 1
+
+
+def test_revalidate(tmp_path, server):
+    server.files['/foo.css'] = b'.foo {color: red}'
+    config = make_config(tmp_path, [{'url': f'{server.url}/foo.css'}], revalidate=True)
+    download_sass(config)
+    assert '"etag"' in config.lock_file.read_text()
+
+    server.requests.clear()
+    download_sass(config)
+    assert len(server.requests) == 1
+    assert server.requests[0]['if-none-match'] == '"{}"'.format(hashlib.md5(b'.foo {color: red}').hexdigest())
+    assert (tmp_path / 'libs' / 'foo.css').read_bytes() == b'.foo {color: red}'
+
+    server.files['/foo.css'] = b'.foo {color: blue}'
+    download_sass(config)
+    assert (tmp_path / 'libs' / 'foo.css').read_bytes() == b'.foo {color: blue}'
+    lock = config.lock_file.read_text()
+    assert hashlib.md5(b'.foo {color: blue}').hexdigest() in lock
+    assert hashlib.md5(b'.foo {color: red}').hexdigest() not in lock
+
+
+def test_old_lock_file(tmp_path, server):
+    server.files['/foo.css'] = b'.foo {color: red}'
+    config = make_config(tmp_path, [{'url': f'{server.url}/foo.css'}])
+    (tmp_path / 'libs').mkdir()
+    (tmp_path / 'libs' / 'foo.css').write_bytes(b'.foo {color: red}')
+    key = LockCheck.hash_source(config.download.sources[0])
+    config.lock_file.write_text(json.dumps({key: [['foo.css', hashlib.md5(b'.foo {color: red}').hexdigest()]]}))
+
+    download_sass(config)
+    assert server.requests == []
+
+
+def test_shared_cache(tmp_path, server):
+    server.files['/foo.css'] = b'.foo {color: red}'
+    server.files['/lib.zip'] = make_zip({'scss/_a.scss': '.a {}'})
+    sources = [{'url': f'{server.url}/foo.css'}, {'url': f'{server.url}/lib.zip', 'extract': {'scss/(.+)$': 'lib/'}}]
+    download = {'shared_cache': True, 'shared_cache_dir': str(tmp_path / 'store')}
+    download_sass(make_config(tmp_path / 'a', sources, **download))
+    assert len(server.requests) == 2
+    files = downloaded_files(tmp_path / 'a' / 'libs')
+    assert files == {'foo.css': '.foo {color: red}', 'lib/_a.scss': '.a {}'}
+
+    # a second project uses the shared store without any requests
+    server.requests.clear()
+    config = make_config(tmp_path / 'b', sources, **download)
+    download_sass(config)
+    assert server.requests == []
+    assert downloaded_files(tmp_path / 'b' / 'libs') == files
+
+    # with revalidate, conditional requests are made using the validators from the store
+    (tmp_path / 'b' / 'libs' / 'foo.css').unlink()
+    download_sass(make_config(tmp_path / 'b', sources, revalidate=True, **download))
+    assert [r['path'] for r in server.requests] == ['/foo.css', '/lib.zip']
+    assert all('if-none-match' in r for r in server.requests)
+    assert downloaded_files(tmp_path / 'b' / 'libs') == files
+
+
+def test_store_prune_in_progress(tmp_path):
+    store = DownloadStore(tmp_path)
+    blobs = tmp_path / 'blobs'
+    blobs.mkdir()
+    # a file another process is adding, its url file hasn't been written yet
+    (blobs / 'a.123.tmp').write_bytes(b'x')
+    (blobs / 'b').write_bytes(b'x')
+    # left by a process which stopped before finishing, and a blob no url refers to
+    for name in ('c.456.tmp', 'd'):
+        (blobs / name).write_bytes(b'x')
+        os.utime(blobs / name, (0, 0))
+    assert store.prune(1024) == 1
+    assert sorted(p.name for p in blobs.iterdir()) == ['a.123.tmp', 'b']
+
+
+def test_store_read_only(tmp_path, mocker):
+    store = DownloadStore(tmp_path)
+    src = tmp_path / 'foo.css'
+    src.write_bytes(b'.foo {color: red}')
+    store.add('https://example.com/foo.css', src, 'abc', {})
+    mocker.patch('os.utime', side_effect=PermissionError('read only file system'))
+    entry = store.get('https://example.com/foo.css')
+    assert entry.path.read_bytes() == b'.foo {color: red}'
+
+
+def test_lock_file_stat(tmp_path, server):
+    server.files['/foo.css'] = b'.foo {color: red}'
+    config = make_config(tmp_path, [{'url': f'{server.url}/foo.css'}])
+    download_sass(config)
+    path = tmp_path / 'libs' / 'foo.css'
+    st = path.stat()
+
+    # same size and mtime, the file isn't hashed so the change isn't noticed
+    path.write_bytes(b'.foo {color: tan}')
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    server.requests.clear()
+    download_sass(config)
+    assert server.requests == []
+
+    # different mtime, the file is hashed
+    path.write_bytes(b'.foo {color: tan}')
+    download_sass(config)
+    assert len(server.requests) == 1
+    assert path.read_bytes() == b'.foo {color: red}'
+
+    # touched but unchanged, the lock file is updated with the new mtime
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    download_sass(config)
+    assert len(server.requests) == 1
+    assert f'{st.st_mtime_ns + 10 ** 9}' in config.lock_file.read_text()
+
+
+def sequential_match(extract, name):
+    for r, t in extract.items():
+        m = r.match(name)
+        if m:
+            return r, t, m.groups()
+
+
+@pytest.mark.parametrize(
+    'rules,combined',
+    [
+        ({r'lib/scss/(?P<filename>.+\.scss)$': 'a/', r'lib/(?P<filename>.+)$': 'b/', r'docs/': None}, True),
+        ({r'(lib|src)/(.+)$': 'a/', r'lib/.+\.md$': None, r'.*': 'c.css'}, True),
+        ({r'(\w+)/\1/(.+)': 'a/', r'.+': 'b/'}, False),
+        ({r'(?i)LIB/(.+)': 'a/', r'.+': 'b/'}, False),
+    ],
+)
+def test_extract_matcher(rules, combined):
+    extract = {re.compile(k): v and Path(v) for k, v in rules.items()}
+    matcher = ExtractMatcher(extract)
+    assert (matcher._combined is not None) is combined
+    names = ['lib/scss/x.scss', 'lib/x.md', 'lib/lib/y.css', 'src/a/b.scss', 'docs/readme', 'other', 'LIB/z', '']
+    for name in names:
+        m = matcher.match(name)
+        assert (m and (m[0], m[1], m[2].groups())) == sequential_match(extract, name), name
+
+
+def test_extract_unchanged(tmp_path, server):
+    server.files['/lib.zip'] = make_zip({'scss/_a.scss': '.a {}', 'scss/_b.scss': '.b {}'})
+    sources = [{'url': f'{server.url}/lib.zip', 'extract': {'scss/(.+)$': 'lib/'}}]
+    config = make_config(tmp_path, sources, revalidate=True)
+    download_sass(config)
+    a_path, b_path = tmp_path / 'libs' / 'lib' / '_a.scss', tmp_path / 'libs' / 'lib' / '_b.scss'
+    os.utime(a_path, ns=(0, 0))
+    os.utime(b_path, ns=(0, 0))
+    lock = LockCheck(tmp_path / 'libs', config.lock_file)
+    assert lock.should_download(config.download.sources[0]) is False
+
+    server.files['/lib.zip'] = make_zip({'scss/_a.scss': '.a {}', 'scss/_b.scss': '.b {color: red}'})
+    download_sass(config)
+    assert downloaded_files(tmp_path / 'libs') == {'lib/_a.scss': '.a {}', 'lib/_b.scss': '.b {color: red}'}
+    # only the changed file is written
+    assert a_path.stat().st_mtime_ns == 0
+    assert b_path.stat().st_mtime_ns != 0
+    lock = LockCheck(tmp_path / 'libs', config.lock_file)
+    assert lock.should_download(config.download.sources[0]) is False
@@ -0,0 +1,44 @@
+import re
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = 'sass', 'httpx', 'pydantic', 'yaml', 'watchgod'
+# generous so the test isn't flaky on slow CI machines, currently ~80ms
+IMPORT_BUDGET_MS = 400
+
+
+def run_python(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+
+@pytest.mark.parametrize('module', ['sasstastic', 'sasstastic.cli'])
+def test_no_heavy_imports(module):
+    code = f'import sys, {module}; print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    assert run_python('-c', code).stdout.decode().strip() == ''
+
+
+def test_import_time():
+    stderr = run_python('-X', 'importtime', '-c', 'import sasstastic.cli').stderr.decode()
+    m = re.search(r'^import time:\s+\d+ \|\s+(\d+) \| sasstastic\.cli$', stderr, flags=re.M)
+    assert m, stderr
+    assert int(m.group(1)) / 1000 < IMPORT_BUDGET_MS
+
+
+def test_compile_without_downloads(tmp_path):
+    (tmp_path / 'styles').mkdir()
+    (tmp_path / 'styles' / 'main.scss').write_text('.x {color: red}\n')
+    config_file = tmp_path / 'sasstastic.yml'
+    config_file.write_text(
+        'download:\n  dir: libs\n  sources: []\nbuild_dir: styles\noutput_dir: css\n'
+        f'compile_cache_dir: {tmp_path / "cache"}\n'
+    )
+    code = (
+        'import sys; from pathlib import Path; from sasstastic import download_and_compile, load_config; '
+        f'download_and_compile(load_config(Path({str(config_file)!r}))); '
+        'print(",".join(m for m in ("httpx", "watchgod") if m in sys.modules))'
+    )
+    assert run_python('-c', code).stdout.decode().strip() == ''
+    assert (tmp_path / 'css' / 'main.css').is_file()
+    assert list((tmp_path / 'cache').iterdir())
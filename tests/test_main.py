@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from sasstastic import ConfigModel, SasstasticError
+from sasstastic.compile import DependencyIndex
+from sasstastic.main import Rebuilder
+from sasstastic.watch import Change
+
+
+def make_rebuilder(tmp_path, mocker, *change_sets):
+    async def watch():
+        for changes in change_sets:
+            yield changes
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(10)
+
+    mocker.patch.object(Rebuilder, '_watch', side_effect=watch)
+    data = dict(download={'dir': 'libs', 'sources': []}, build_dir='styles', output_dir='css')
+    config = ConfigModel.parse_obj(tmp_path / 'sasstastic.yml', data)
+    return Rebuilder(config, None, DependencyIndex())
+
+
+async def run_for(rebuilder: Rebuilder, seconds: float):
+    try:
+        await asyncio.wait_for(rebuilder.run(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+def test_changes_coalesced(tmp_path, mocker):
+    calls = []
+
+    async def compile_changed(config, changed, *args, **kwargs):
+        calls.append(changed)
+        # slow enough to be cancelled by the second set of changes
+        await asyncio.sleep(0.05 if len(calls) == 1 else 0)
+
+    mocker.patch('sasstastic.main.compile_changed_async', side_effect=compile_changed)
+    compile_sass = mocker.patch('sasstastic.main.compile_sass_async')
+    a, b = str(tmp_path / 'a.scss'), str(tmp_path / 'b.scss')
+    rebuilder = make_rebuilder(tmp_path, mocker, {(Change.modified, a)}, {(Change.modified, b)})
+    asyncio.run(run_for(rebuilder, 0.3))
+    # the first build is cancelled, the next build includes both changes
+    assert calls == [{tmp_path / 'a.scss'}, {tmp_path / 'a.scss', tmp_path / 'b.scss'}]
+    assert compile_sass.call_count == 0
+
+
+def test_restart_keeps_changes(tmp_path, mocker):
+    calls = []
+
+    async def compile_sass(*args, **kwargs):
+        calls.append('full')
+        # slow enough to be cancelled by the second set of changes
+        await asyncio.sleep(0.05 if len(calls) == 1 else 0)
+
+    mocker.patch('sasstastic.main.compile_sass_async', side_effect=compile_sass)
+    compile_changed = mocker.patch('sasstastic.main.compile_changed_async')
+    a, b = str(tmp_path / 'a.scss'), str(tmp_path / 'b.scss')
+    rebuilder = make_rebuilder(tmp_path, mocker, {(Change.added, a)}, {(Change.modified, b)})
+    asyncio.run(run_for(rebuilder, 0.3))
+    # the file added in the cancelled build still requires a full build
+    assert calls == ['full', 'full']
+    assert compile_changed.call_count == 0
+
+
+def test_build_error(tmp_path, mocker):
+    mocker.patch('sasstastic.main.compile_changed_async', side_effect=SasstasticError('sass errors'))
+    rebuilder = make_rebuilder(tmp_path, mocker, {(Change.modified, str(tmp_path / 'a.scss'))})
+    with pytest.raises(SasstasticError):
+        asyncio.run(run_for(rebuilder, 1))
+
+
+def test_added_file_reuses_entry_points(tmp_path, mocker):
+    compile_sass = mocker.patch('sasstastic.main.compile_sass_async')
+    a, b = tmp_path / 'a.scss', tmp_path / 'b.scss'
+    rebuilder = make_rebuilder(tmp_path, mocker, {(Change.added, str(b))})
+    rebuilder._index.add(a, set(), [])
+    asyncio.run(run_for(rebuilder, 0.3))
+    assert compile_sass.call_count == 1
+    assert compile_sass.call_args[1]['entry_points'] == {a, b}
+
+
+def test_added_dir_finds_entry_points(tmp_path, mocker):
+    compile_sass = mocker.patch('sasstastic.main.compile_sass_async')
+    rebuilder = make_rebuilder(tmp_path, mocker, {(Change.added, str(tmp_path))})
+    rebuilder._index.add(tmp_path / 'a.scss', set(), [])
+    asyncio.run(run_for(rebuilder, 0.3))
+    assert compile_sass.call_count == 1
+    assert compile_sass.call_args[1]['entry_points'] is None
@@ -0,0 +1,152 @@
+import logging
+import shutil
+from pathlib import Path
+
+import pytest
+
+from sasstastic import ConfigModel, SasstasticError, compile_sass
+from sasstastic.compile import SassCompiler
+from sasstastic.remote_cache import CacheBackend
+
+
+def make_project(root: Path, **config) -> ConfigModel:
+    styles = root / 'styles'
+    (styles / '.libs').mkdir(parents=True)
+    (styles / 'main.scss').write_text('@import "a";\n@import "DL/lib";\n.x {color: red}\n')
+    (styles / '_a.scss').write_text('.a {color: blue}\n')
+    (styles / '.libs' / '_lib.scss').write_text('.lib {color: green}\n')
+    config.setdefault('compile_cache_dir', str(root / '.cache'))
+    data = dict(download={'dir': 'styles/.libs', 'sources': []}, build_dir='styles', output_dir='css', **config)
+    return ConfigModel.parse_obj(root / 'sasstastic.yml', data)
+
+
+def output_files(d: Path):
+    return {str(p.relative_to(d)): p.read_bytes() for p in sorted(d.glob('**/*')) if p.is_file()}
+
+
+class MemoryBackend(CacheBackend):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def put(self, key, data):
+        self.data[key] = data
+
+
+@pytest.mark.parametrize('dev_mode', [True, False])
+def test_directory_backend(tmp_path, mocker, dev_mode):
+    config = make_project(tmp_path, remote_cache='remote', manifest='manifest.json')
+    index1 = compile_sass(config, tmp_path / 'out', dev_mode)
+    assert len(list((tmp_path / 'remote').glob('*.tar.gz'))) == 1
+    first = output_files(tmp_path / 'out')
+    shutil.rmtree(tmp_path / 'out')
+
+    build = mocker.spy(SassCompiler, 'build')
+    index2 = compile_sass(config, tmp_path / 'out', dev_mode)
+    assert build.call_count == 0
+    assert output_files(tmp_path / 'out') == first
+    assert 'manifest.json' in first
+    # the dependency index is restored so watch mode can rebuild only affected files
+    assert index2.entry_points == index1.entry_points
+    assert index2.affected({(tmp_path / 'styles' / '_a.scss').absolute()}) == set(index1.entry_points)
+
+    # in dev mode source maps are relative to the output directory, so output can't be shared with other directories
+    compile_sass(config, tmp_path / 'other', dev_mode)
+    assert build.call_count == (1 if dev_mode else 0)
+
+
+def test_inputs_change_key(tmp_path, mocker):
+    backend = MemoryBackend()
+    config = make_project(tmp_path)
+    compile_sass(config, remote_cache=backend)
+    assert len(backend.data) == 1
+
+    build = mocker.spy(SassCompiler, 'build')
+    (tmp_path / 'styles' / '.libs' / '_lib.scss').write_text('.lib {color: black}\n')
+    compile_sass(config, remote_cache=backend)
+    assert build.call_count == 1
+    assert len(backend.data) == 2
+    assert 'black' in (tmp_path / 'css' / 'main.css').read_text()
+
+    compile_sass(config, remote_cache=backend, dev_mode=not config.dev_mode)
+    assert build.call_count == 2
+    compile_sass(make_project(tmp_path / 'other', file_hashes=True), remote_cache=backend)
+    assert build.call_count == 3
+    assert len(backend.data) == 4
+
+    # the output directory isn't an input, even when it's inside the build directory
+    compile_sass(config, tmp_path / 'styles' / 'out', False, remote_cache=backend)
+    compile_sass(config, tmp_path / 'styles' / 'out', False, remote_cache=backend)
+    assert (tmp_path / 'styles' / 'out' / 'main.css').is_file()
+    assert build.call_count == 3
+
+
+def test_not_pushed(tmp_path):
+    backend = MemoryBackend()
+    config = make_project(tmp_path, remote_cache_push=False)
+    compile_sass(config, remote_cache=backend)
+    compile_sass(config, remote_cache=backend, entry_points=[tmp_path / 'styles' / 'main.scss'])
+    compile_sass(config, remote_cache=backend, cache=False)
+    assert backend.data == {}
+
+    config = make_project(tmp_path / 'error')
+    (tmp_path / 'error' / 'styles' / 'main.scss').write_text('.x {')
+    with pytest.raises(SasstasticError):
+        compile_sass(config, remote_cache=backend)
+    assert backend.data == {}
+
+
+def test_http_backend(tmp_path, server, mocker, monkeypatch):
+    monkeypatch.setenv('CACHE_TOKEN', 'secret')
+    headers = {'Authorization': 'Bearer $CACHE_TOKEN'}
+    config = make_project(tmp_path, remote_cache=f'{server.url}/cache/', remote_cache_headers=headers)
+    compile_sass(config, tmp_path / 'out')
+    assert [(r['method'], r['authorization']) for r in server.requests] == [
+        ('GET', 'Bearer secret'),
+        ('PUT', 'Bearer secret'),
+    ]
+    path = server.requests[0]['path']
+    assert path.startswith('/cache/') and path.endswith('.tar.gz')
+    assert list(server.files) == [path]
+
+    first = output_files(tmp_path / 'out')
+    shutil.rmtree(tmp_path / 'out')
+    build = mocker.spy(SassCompiler, 'build')
+    compile_sass(config, tmp_path / 'out')
+    assert build.call_count == 0
+    assert output_files(tmp_path / 'out') == first
+
+
+def test_http_errors(tmp_path, server, caplog):
+    caplog.set_level(logging.WARNING)
+    config = make_project(tmp_path, remote_cache=server.url)
+    server.errors = [500, 403]
+    compile_sass(config)
+    assert 'main.css' in output_files(tmp_path / 'css')
+    assert server.files == {}
+    messages = [r.getMessage() for r in caplog.records]
+    assert messages == [
+        f'unable to read from the remote cache: GET {server.url}/{config_key(server)}.tar.gz failed, '
+        f'unexpected response 500',
+        f'unable to write to the remote cache: PUT {server.url}/{config_key(server)}.tar.gz failed, '
+        f'unexpected response 403',
+    ]
+
+
+def config_key(server):
+    return server.requests[0]['path'][1:-7]
+
+
+def test_invalid_output(tmp_path, mocker, caplog):
+    backend = MemoryBackend()
+    config = make_project(tmp_path)
+    compile_sass(config, remote_cache=backend)
+    key = next(iter(backend.data))
+    backend.data[key] = b'not a tar file'
+
+    build = mocker.spy(SassCompiler, 'build')
+    compile_sass(config, remote_cache=backend)
+    assert build.call_count == 1
+    assert f'invalid output in the remote cache for {key}' in caplog.text
@@ -0,0 +1,43 @@
+import re
+
+import pytest
+
+from sasstastic.replace import LiteralGroup, Replacer
+
+
+def sequential(rules, css):
+    for pattern, repl in rules.items():
+        css = re.sub(pattern, repl, css)
+    return css
+
+
+@pytest.mark.parametrize(
+    'rules,css',
+    [
+        ({r'\.foo': '.bar', 'red': 'blue', 'x': 'y'}, '.foo {color: red} .x {}'),
+        # inserted text and the text after it form a later match
+        ({'foo': 'bar', 'red': 'blue'}, 'fooed'),
+        # later literal matches text inserted by an earlier replacement
+        ({'red': 'blue', 'blue': 'green'}, '.a {color: red} .b {color: blue}'),
+        # overlapping literals
+        ({'ab': 'X', 'bc': 'Y'}, 'abc bc ab'),
+        # removed text joins neighbours into a later match
+        ({'a': '', 'bc': 'Z'}, 'bac bc'),
+        ({'colour': 'color', r'url\((.+?)\)': r'url(/static/\1)', 'color': 'c'}, 'a {colour: red; b: url(x.png)}'),
+        ({'a': 'b', '(?i)B': 'c'}, 'aB'),
+    ],
+)
+def test_matches_sequential(rules, css):
+    replacer = Replacer({re.compile('.*'): {re.compile(k): v for k, v in rules.items()}})
+    assert replacer('main.scss', css) == sequential(rules, css)
+
+
+def test_combined():
+    rules = {re.compile(r'\.foo'): '.baz', re.compile('red'): 'blue', re.compile(r'url\((.+?)\)'): r'url(/\1)'}
+    replacer = Replacer({re.compile(r'^main\.scss$'): rules, re.compile('other'): {re.compile('x'): 'y'}})
+    assert replacer('main.scss', '.foo {color: red; b: url(x.png)}') == '.baz {color: blue; b: url(/x.png)}'
+    steps = replacer._steps['main.scss']
+    assert len(steps) == 2
+    assert isinstance(steps[0], LiteralGroup)
+    assert replacer('foo.scss', '.foo {}') == '.foo {}'
+    assert replacer._steps['foo.scss'] == []
@@ -0,0 +1,68 @@
+import asyncio
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from sasstastic import SasstasticError
+from sasstastic.client import build, send_request
+from sasstastic.server import CompileServer
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='unix sockets are not available on windows')
+def test_server(tmp_path):
+    (tmp_path / 'styles' / '.libs').mkdir(parents=True)
+    (tmp_path / 'styles' / 'main.scss').write_text('@import "DL/lib";\n.x {color: red}\n')
+    (tmp_path / 'styles' / '.libs' / '_lib.scss').write_text('.lib {color: green}\n')
+    config_file = tmp_path / 'sasstastic.yml'
+    config_file.write_text('download:\n  dir: styles/.libs\n  sources: []\nbuild_dir: styles\noutput_dir: css\n')
+    # tmp_path can be longer than the maximum length of a unix socket path on macos
+    socket_dir = Path(tempfile.mkdtemp())
+    socket_path = socket_dir / 'sasstastic.sock'
+    server = CompileServer(config_file, socket_path, dev_mode=False, cache=False)
+    thread = threading.Thread(target=asyncio.run, args=(server.run(),))
+    thread.start()
+    try:
+        for _ in range(200):
+            if socket_path.exists():
+                break
+            time.sleep(0.01)
+        assert send_request(socket_path, {'command': 'ping'}, timeout=5) == {'status': 'ok'}
+        # the server builds when it starts
+        assert (tmp_path / 'css' / 'main.css').is_file()
+
+        lib = tmp_path / 'styles' / '.libs' / '_lib.scss'
+        lib.write_text('.lib {color: purple}\n')
+        response = build(socket_path, [lib], timeout=5)
+        assert response['status'] == 'ok', response
+        assert 'purple' in (tmp_path / 'css' / 'main.css').read_text()
+
+        (tmp_path / 'styles' / 'broken.scss').write_text('.x {')
+        response = build(socket_path, timeout=5)
+        assert response['status'] == 'error'
+        assert response['message'] == 'sass errors'
+
+        assert send_request(socket_path, {'command': 'foobar'}, timeout=5)['status'] == 'error'
+    finally:
+        send_request(socket_path, {'command': 'stop'}, timeout=5)
+        thread.join(5)
+    assert not thread.is_alive()
+    assert not socket_path.exists()
+    socket_dir.rmdir()
+
+
+def test_no_unix_sockets(tmp_path, monkeypatch):
+    # e.g. on windows
+    no_unix = SimpleNamespace(AF_INET=socket.AF_INET)
+    monkeypatch.setattr('sasstastic.client.socket', no_unix)
+    monkeypatch.setattr('sasstastic.server.socket', no_unix)
+    with pytest.raises(SasstasticError, match='unix sockets are not available'):
+        send_request(tmp_path / 'sasstastic.sock', {'command': 'ping'})
+    server = CompileServer(tmp_path / 'sasstastic.yml', tmp_path / 'sasstastic.sock')
+    with pytest.raises(SasstasticError, match='unix sockets are not available'):
+        asyncio.run(server.run())
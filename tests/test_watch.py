@@ -0,0 +1,164 @@
+import asyncio
+import os
+import re
+
+import pytest
+
+from sasstastic import ConfigModel, SasstasticError
+from sasstastic.watch import IN_Q_OVERFLOW, Change, InotifyWatcher, Watcher, WatchFilter
+
+
+async def next_changes(watcher: Watcher, *actions):
+    changes_iter = watcher.__aiter__()
+    next_task = asyncio.ensure_future(changes_iter.__anext__())
+    try:
+        await asyncio.sleep(0.05)
+        for action in actions:
+            action()
+            await asyncio.sleep(0.02)
+        return await asyncio.wait_for(next_task, 5)
+    finally:
+        await changes_iter.aclose()
+
+
+def touch(path, text='x'):
+    path.write_text(text)
+    # make sure the modification is visible to polling even with coarse mtimes
+    st = path.stat()
+    os.utime(path, (st.st_atime + 10, st.st_mtime + 10))
+
+
+@pytest.fixture(name='build_dir')
+def _fix_build_dir(tmp_path):
+    build_dir = tmp_path / 'styles'
+    for d in ('libs', 'css', 'node_modules'):
+        (build_dir / d).mkdir(parents=True)
+    (build_dir / 'a.scss').write_text('a')
+    (build_dir / 'b.scss').write_text('b')
+    return build_dir
+
+
+@pytest.mark.parametrize('backend', ['inotify', 'poll'])
+def test_watch_changes(build_dir, backend):
+    watcher = Watcher([build_dir], ignore_dirs=[build_dir / 'libs', build_dir / 'css'], backend=backend, debounce=0.05)
+    assert watcher.backend == backend
+
+    def change():
+        touch(build_dir / 'a.scss')
+        (build_dir / 'b.scss').unlink()
+        touch(build_dir / 'c.scss')
+        touch(build_dir / 'libs' / 'd.scss')
+        touch(build_dir / 'css' / 'c.css')
+        touch(build_dir / 'node_modules' / 'e.scss')
+        touch(build_dir / 'a.scss~')
+
+    changes = asyncio.run(next_changes(watcher, change))
+    assert changes == {
+        (Change.modified, str(build_dir / 'a.scss')),
+        (Change.deleted, str(build_dir / 'b.scss')),
+        (Change.added, str(build_dir / 'c.scss')),
+    }
+
+
+@pytest.mark.parametrize('backend', ['inotify', 'poll'])
+def test_watch_config_file(tmp_path, build_dir, backend):
+    config_file = tmp_path / 'sasstastic.yml'
+    config_file.write_text('old')
+    watcher = Watcher([config_file, build_dir], backend=backend, debounce=0.05)
+
+    def save():
+        # editors often save by writing a temporary file and renaming it
+        tmp_file = tmp_path / '.sasstastic.yml.tmp'
+        touch(tmp_file, 'new')
+        os.replace(tmp_file, config_file)
+        touch(tmp_path / 'other.txt')
+
+    changes = asyncio.run(next_changes(watcher, save))
+    assert changes == {(Change.modified, str(config_file))}
+
+
+def test_watch_ignore(build_dir):
+    watcher = Watcher([build_dir], ignore=re.compile(r'vendor|\.css$'), backend='inotify', debounce=0.05)
+
+    def change():
+        (build_dir / 'vendor').mkdir()
+        touch(build_dir / 'vendor' / 'x.scss')
+        touch(build_dir / 'x.css')
+        touch(build_dir / 'x.scss')
+
+    changes = asyncio.run(next_changes(watcher, change))
+    assert changes == {(Change.added, str(build_dir / 'x.scss'))}
+
+
+def test_inotify_new_dir(build_dir):
+    watcher = Watcher([build_dir], backend='inotify', debounce=0.05)
+    sub_dir = build_dir / 'sub' / 'deep'
+    path = sub_dir / 'x.scss'
+
+    async def run():
+        changes_iter = watcher.__aiter__()
+        sub_dir.mkdir(parents=True)
+        touch(path)
+        yield await changes_iter.__anext__()
+        # the new directory is watched
+        touch(path, 'changed')
+        yield await changes_iter.__anext__()
+        os.rename(build_dir / 'sub', build_dir / 'moved')
+        yield await changes_iter.__anext__()
+        await changes_iter.aclose()
+
+    async def collect():
+        return [changes async for changes in run()]
+
+    assert asyncio.run(asyncio.wait_for(collect(), 5)) == [
+        {(Change.added, str(path))},
+        {(Change.modified, str(path))},
+        {(Change.deleted, str(path)), (Change.added, str(build_dir / 'moved' / 'deep' / 'x.scss'))},
+    ]
+
+
+def test_inotify_debounce(build_dir):
+    watcher = Watcher([build_dir], backend='inotify', debounce=0.2)
+
+    async def run():
+        async def write_later():
+            await asyncio.sleep(0.1)
+            touch(build_dir / 'b.scss')
+
+        task = asyncio.ensure_future(write_later())
+        changes = await next_changes(watcher, lambda: touch(build_dir / 'a.scss'))
+        await task
+        return changes
+
+    # the second write happens within the debounce window so both changes are released together
+    changes = asyncio.run(run())
+    assert changes == {(Change.modified, str(build_dir / 'a.scss')), (Change.modified, str(build_dir / 'b.scss'))}
+
+
+def test_inotify_overflow(build_dir):
+    watcher = InotifyWatcher([str(build_dir)], WatchFilter())
+    try:
+        (build_dir / 'b.scss').unlink()
+        (build_dir / 'c.scss').write_text('c')
+        # events queued above are lost, all files are checked again
+        watcher._process_event(-1, IN_Q_OVERFLOW, '')
+        assert watcher.pop_changes() == {
+            (Change.modified, str(build_dir / 'a.scss')),
+            (Change.deleted, str(build_dir / 'b.scss')),
+            (Change.added, str(build_dir / 'c.scss')),
+        }
+    finally:
+        watcher.close()
+
+
+def test_inotify_unavailable(build_dir, mocker):
+    mocker.patch('sasstastic.watch.load_libc', side_effect=OSError('inotify is only available on Linux'))
+    assert Watcher([build_dir]).backend == 'poll'
+    with pytest.raises(SasstasticError, match='unable to watch files with inotify'):
+        Watcher([build_dir], backend='inotify')
+
+
+def test_invalid_backend(tmp_path):
+    data = dict(download={'dir': 'libs', 'sources': []}, build_dir='styles', output_dir='css', watch_backend='foo')
+    with pytest.raises(ValueError, match='must be one of: auto, inotify, poll'):
+        ConfigModel.parse_obj(tmp_path / 'sasstastic.yml', data)